@@ -1,33 +1,47 @@
 import os
+import sys
 import logging
 import hmac
 import hashlib
 import json
+import re
+import base64
 import secrets
+import socket
 import time
 import uuid
-import asyncio
+import functools
+import gzip
+import threading
+import select as select_module
+import queue
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote, parse_qs
 from datetime import datetime as dt, timezone, timedelta
-from decimal import Decimal
-import random
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-import pytz
+from decimal import Decimal, ROUND_HALF_UP
 
-from flask import Flask, jsonify, request as flask_request, abort as flask_abort
+from flask import Flask, Response, g, has_request_context, jsonify, stream_with_context, request as flask_request, abort as flask_abort
 from flask_cors import CORS
 from dotenv import load_dotenv
+import requests
 import telebot
 from telebot import types
-from sqlalchemy import create_engine, Column, BigInteger, String, Float, ForeignKey, DateTime
-from sqlalchemy import inspect
+from sqlalchemy import create_engine, Column, BigInteger, Integer, String, Float, ForeignKey, DateTime, Text, Index
+from sqlalchemy import event, inspect, select, insert, update, delete, text, tuple_, or_, and_, exists
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.sql import func
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.exc import IntegrityError
-from pytoniq import LiteBalancer
-from portalsmp import giftsFloors
 from werkzeug.exceptions import Unauthorized
+import game
+from metrics import MetricsRegistry, timed_call
+from game import BET_MODES_CONFIG, EMOJI_GIFTS, draw_outcome_categories, draw_free_drop_gift, conversion_value
+
+try:
+    import brotli  # optional: enables Content-Encoding: br for precomputed responses
+except ImportError:
+    brotli = None
 
 # --- Configuration --
 load_dotenv()
@@ -37,6 +51,7 @@ PORTALS_AUTH_TOKEN = os.environ.get("PORTALS_AUTH_TOKEN")
 GIFT_DEPOSIT_API_KEY = os.environ.get("GIFT_DEPOSIT_API_KEY")
 DATABASE_URL = os.environ.get("DATABASE_URL")
 RENDER_EXTERNAL_URL = os.environ.get("RENDER_EXTERNAL_URL", "https://plinko-4vm7.onrender.com")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")  # e.g. a local Bot API server or a fake one in tests
 DEPOSIT_WALLET_ADDRESS = os.environ.get("DEPOSIT_WALLET_ADDRESS")
 ADMIN_IDS_STR = os.environ.get("ADMIN_USER_IDS", "")
 REQUIRED_CHANNELS = ['@CompactTelegram', '@giftnewstoday', '@myzone196']
@@ -44,183 +59,302 @@ WEB_APP_URL = "https://vasiliy-katsyka.github.io/plinko"
 ADMIN_USER_IDS = [int(admin_id.strip()) for admin_id in ADMIN_IDS_STR.split(',') if admin_id.strip()]
 TON_TO_STARS_RATE = 250  # 1 TON = 250 Stars
 
-PLINKO_CONFIGS = {
-    'low': {
-        'rows': 8,
-        'multipliers': [4, 2, 1.2, 0.9, 0.7, 0.9, 1.2, 2, 4]
-    },
-    'medium': {
-        'rows': 12,
-        'multipliers': [18, 5, 2, 1.1, 0.8, 0.5, 0.3, 0.5, 0.8, 1.1, 2, 5, 18]
-    },
-    'high': {
-        'rows': 16,
-        'multipliers': [130, 25, 8, 2, 0.5, 0.2, 0.1, 0.1, 0, 0.1, 0.1, 0.2, 0.5, 2, 8, 25, 130]
-    }
-}
-
-BET_MODES_CONFIG = {
-    '200': {
-        'bet_amount': 200,
-        'rows': 8,
-        'slots': [
-            [600, 900], [350, 600], [200, 350], 'Ring', 'Bear', 'Ring', [200, 350], [350, 600], [600, 900]
-        ]
-    },
-    '1000': {
-        'bet_amount': 1000,
-        'rows': 8,
-        'slots': [
-            # --- UPDATED RANGES FOR 1000 STARS ---
-            [3000, 4000], [1500, 2000], [600, 1000], [400, 600], [200, 400], [400, 600], [600, 1000], [1500, 2000], [3000, 4000]
-        ]
-    },
-    '4000': {
-        'bet_amount': 4000,
-        'rows': 8,
-        'slots': [
-            # --- UPDATED RANGES FOR 4000 STARS ---
-            [7000, 20000], [4500, 7000], [3000, 4500], [1500, 3000], [1000, 1500], [1500, 3000], [3000, 4500], [4500, 7000], [7000, 20000]
-        ]
-    }
-}
-
-REGULAR_GIFTS = {
-    "5983471780763796287": {"name": "santahat", "filename": "santahat.png"},
-    "5936085638515261992": {"name": "signetring", "filename": "signetring.png"},
-    "5933671725160989227": {"name": "preciouspeach", "filename": "preciouspeach.png"},
-    "5936013938331222567": {"name": "plushpepe", "filename": "plushpepe.png"},
-    "5913442287462908725": {"name": "spicedwine", "filename": "spicedwine.png"},
-    "5915502858152706668": {"name": "jellybunny", "filename": "jellybunny.png"},
-    "5915521180483191380": {"name": "durov'scap", "filename": "durov'scap.png"},
-    "5913517067138499193": {"name": "perfumebottle", "filename": "perfumebottle.png"},
-    "5882125812596999035": {"name": "eternalrose", "filename": "eternalrose.png"},
-    "5882252952218894938": {"name": "berrybox", "filename": "berrybox.png"},
-    "5857140566201991735": {"name": "vintagecigar", "filename": "vintagecigar.png"},
-    "5846226946928673709": {"name": "magicpotion", "filename": "magicpotion.png"},
-    "5845776576658015084": {"name": "kissedfrog", "filename": "kissedfrog.png"},
-    "5825801628657124140": {"name": "hexpot", "filename": "hexpot.png"},
-    "5825480571261813595": {"name": "evileye", "filename": "evileye.png"},
-    "5841689550203650524": {"name": "sharptongue", "filename": "sharptongue.png"},
-    "5841391256135008713": {"name": "trappedheart", "filename": "trappedheart.png"},
-    "5839038009193792264": {"name": "skullflower", "filename": "skullflower.png"},
-    "5837059369300132790": {"name": "scaredcat", "filename": "scaredcat.png"},
-    "5821261908354794038": {"name": "spyagaric", "filename": "spyagaric.png"},
-    "5783075783622787539": {"name": "homemadecake", "filename": "homemadecake.png"},
-    "5933531623327795414": {"name": "genielamp", "filename": "genielamp.png"},
-    "6028426950047957932": {"name": "lunarsnake", "filename": "lunarsnake.png"},
-    "6003643167683903930": {"name": "partysparkler", "filename": "partysparkler.png"},
-    "5933590374185435592": {"name": "jesterhat", "filename": "jesterhat.png"},
-    "5821384757304362229": {"name": "witchhat", "filename": "witchhat.png"},
-    "5915733223018594841": {"name": "hangingstar", "filename": "hangingstar.png"},
-    "5915550639663874519": {"name": "lovecandle", "filename": "lovecandle.png"},
-    "6001538689543439169": {"name": "cookieheart", "filename": "cookieheart.png"},
-    "5782988952268964995": {"name": "deskcalendar", "filename": "deskcalendar.png"},
-    "6001473264306619020": {"name": "jinglebells", "filename": "jinglebells.png"},
-    "5980789805615678057": {"name": "snowmittens", "filename": "snowmittens.png"},
-    "5836780359634649414": {"name": "voodoodoll", "filename": "voodoodoll.png"},
-    "5841632504448025405": {"name": "madpumpkin", "filename": "madpumpkin.png"},
-    "5825895989088617224": {"name": "hypnolollipop", "filename": "Hynpo-Lollipop.png"},
-    "5782984811920491178": {"name": "b-daycandle", "filename": "b-daycandle.png"},
-    "5935936766358847989": {"name": "bunnymuffin", "filename": "bunnymuffin.png"},
-    "5933629604416717361": {"name": "astralshard", "filename": "astralshard.png"},
-    "5837063436634161765": {"name": "flyingbroom", "filename": "flyingbroom.png"},
-    "5841336413697606412": {"name": "crystalball", "filename": "crystalball.png"},
-    "5821205665758053411": {"name": "eternalcandle", "filename": "eternalcandle.png"},
-    "5936043693864651359": {"name": "swisswatch", "filename": "swisswatch.png"},
-    "5983484377902875708": {"name": "gingercookie", "filename": "gingercookie.png"},
-    "5879737836550226478": {"name": "minioscar", "filename": "minioscar.png"},
-    "5170594532177215681": {"name": "lolpop", "filename": "lolpop.png"},
-    "5843762284240831056": {"name": "iongem", "filename": "iongem.png"},
-    "5936017773737018241": {"name": "starnotepad", "filename": "starnotepad.png"},
-    "5868659926187901653": {"name": "lootbag", "filename": "lootbag.png"},
-    "5868348541058942091": {"name": "lovepotion", "filename": "lovepotion.png"},
-    "5868220813026526561": {"name": "toybear", "filename": "toybear.png"},
-    "5868503709637411929": {"name": "diamondring", "filename": "diamondring.png"},
-    "5167939598143193218": {"name": "sakuraflower", "filename": "sakuraflower.png"},
-    "5981026247860290310": {"name": "sleighbell", "filename": "sleighbell.png"},
-    "5897593557492957738": {"name": "tophat", "filename": "tophat.png"},
-    "5856973938650776169": {"name": "recordplayer", "filename": "recordplayer.png"},
-    "5983259145522906006": {"name": "winterwreath", "filename": "winterwreath.png"},
-    "5981132629905245483": {"name": "snowglobe", "filename": "snowglobe.png"},
-    "5846192273657692751": {"name": "electricskull", "filename": "electricskull.png"},
-    "6023752243218481939": {"name": "tamagadget", "filename": "tamagadget.png"},
-    "6003373314888696650": {"name": "candycane", "filename": "candycane.png"},
-    "5933793770951673155": {"name": "nekohelmet", "filename": "nekohelmet.png"},
-    "6005659564635063386": {"name": "jack-in-the-box", "filename": "Jack-in-the-box.png"},
-    "5773668482394620318": {"name": "easteregg", "filename": "easteregg.png"},
-    "5870661333703197240": {"name": "bondedring", "filename": "bondedring.png"},
-    "6023917088358269866": {"name": "petsnake", "filename": "petsnake.png"},
-    "6023679164349940429": {"name": "snakebox", "filename": "snakebox.png"},
-    "6003767644426076664": {"name": "xmasstocking", "filename": "xmasstocking.png"},
-    "6028283532500009446": {"name": "bigyear", "filename": "bigyear.png"},
-    "6003735372041814769": {"name": "holidaydrink", "filename": "holidaydrink.png"},
-    "5859442703032386168": {"name": "gemsignet", "filename": "gemsignet.png"},
-    "5897581235231785485": {"name": "lightsword", "filename": "lightsword.png"},
-    "5870784783948186838": {"name": "restlessjar", "filename": "restlessjar.png"},
-    "5870720080265871962": {"name": "nailbracelet", "filename": "nailbracelet.png"},
-    "5895328365971244193": {"name": "heroichelmet", "filename": "heroichelmet.png"},
-    "5895544372761461960": {"name": "bowtie", "filename": "bowtie.png"},
-    "5868455043362980631": {"name": "heartlocket", "filename": "heartlocket.png"},
-    "5871002671934079382": {"name": "lushbouquet", "filename": "lushbouquet.png"},
-    "5933543975653737112": {"name": "whipcupcake", "filename": "whipcupcake.png"},
-    "5870862540036113469": {"name": "joyfulbundle", "filename": "joyfulbundle.png"},
-    "5868561433997870501": {"name": "cupidcharm", "filename": "cupidcharm.png"},
-    "5868595669182186720": {"name": "valentinebox", "filename": "valentinebox.png"},
-    "6014591077976114307": {"name": "snoopdogg", "filename": "snoopdogg.png"},
-    "6012607142387778152": {"name": "swagbag", "filename": "swagbag.png"},
-    "6012435906336654262": {"name": "snoopcigar", "filename": "snoopcigar.png"},
-    "6014675319464657779": {"name": "lowrider", "filename": "lowrider.png"},
-    "6014697240977737490": {"name": "westsidesign", "filename": "westsidesign.png"},
-    "6042113507581755979": {"name": "stellarrocket", "filename": "stellarrocket.png"},
-    "6005880141270483700": {"name": "jollychimp", "filename": "jollychimp.png"},
-    "5998981470310368313": {"name": "moonpendant", "filename": "moonpendant.png"},
-    "5933937398953018107": {"name": "ionicdryer", "filename": "ionicdryer.png"},
-}
-
-EMOJI_GIFTS = {
-    "Heart": {"id": "5170145012310081615", "value": 15, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/gifts_emoji_by_gifts_changes_bot_AgADYEwAAiHMUUk.png?raw=true"},
-    "Bear": {"id": "5170233102089322756", "value": 15, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/gifts_emoji_by_gifts_changes_bot_AgADomAAAvRzSEk.png?raw=true"},
-    "Rose": {"id": "5168103777563050263", "value": 25, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/gifts_emoji_by_gifts_changes_bot_AgADslsAAqCxSUk.png?raw=true"},
-    "Rocket": {"id": "5170564780938756245", "value": 50, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/gifts_emoji_by_gifts_changes_bot_AgAD9lAAAsBFUUk.png?raw=true"},
-    "Bottle": {"id": "6028601630662853006", "value": 50, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/gifts_emoji_by_gifts_changes_bot_AgADA2cAAm0PqUs.png?raw=true"},
-    "Ring": {"id": "5170690322832818290", "value": 100, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/IMG_20250901_162059_844.png?raw=true"}
-}
-
-gift_floor_cache = {
-    "data": {},
-    "last_updated": 0
-}
-CACHE_DURATION_SECONDS = 900  # 15 minutes
-
-board_cache = {}
+CACHE_DURATION_SECONDS = 900  # 15 minutes, max age of the gift catalog before it is re-checked against the DB
+
 CACHE_EXPIRATION_SECONDS = 300 # 5 minutes
-withdrawal_tasks = []
+BOARD_CACHE_MAX_ENTRIES = int(os.environ.get("BOARD_CACHE_MAX_ENTRIES", 50000))
+BOARD_CACHE_MAX_BYTES = int(os.environ.get("BOARD_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+BOARD_CACHE_SWEEP_SECONDS = 60
+MAX_SEED_LENGTH = 64
+MAX_BATCH_DROPS = 100
+INVENTORY_PAGE_MAX_LIMIT = 200
+GIFT_PRICES_MAX_AGE_SECONDS = 300
+BOARD_SLOTS_CACHE_CONTROL = "public, no-cache"  # boards outlive no cache entry, so always revalidate (cheap 304)
+SUBSCRIPTION_CHECK_WORKERS = 8
+SUBSCRIBED_CACHE_SECONDS = 600
+NOT_SUBSCRIBED_CACHE_SECONDS = 20  # short, so users who just joined are let in quickly
+TON_INITIAL_SCAN_TRANSACTIONS = 200  # how far back the first sync after startup looks
+TON_SYNC_PAGE_TRANSACTIONS = 1000  # transactions per get_transactions page
+TON_SYNC_MAX_PAGES = 5  # pages per sync; a longer backlog is resumed by the next sync
+TON_REMEMBERED_TRANSACTIONS = 5000
+TON_CALL_TIMEOUT_SECONDS = 30
+TON_DEPOSIT_WATCH_SECONDS = 15
+INIT_DATA_MAX_AGE_SECONDS = int(os.environ.get("INIT_DATA_MAX_AGE_SECONDS", 86400))  # 0 disables the auth_date check
+INIT_DATA_CACHE_SECONDS = 300
+INIT_DATA_CACHE_MAX_ENTRIES = 20000
+BOARD_STORE = os.environ.get("BOARD_STORE", "memory")  # 'memory' (per worker) or 'database' (shared by all workers)
+WITHDRAWAL_LEASE_SECONDS = 300  # a claimed task goes back to the queue if it is not acked in time
+WITHDRAWAL_CLAIM_MAX_LIMIT = 100
+WITHDRAWAL_MAX_ATTEMPTS = 5  # claims without a done/failed ack before a task is given up on as 'failed'
+WITHDRAWAL_MAX_WAIT_SECONDS = 60  # longest ?wait= a long-poll may block for
+WITHDRAWAL_RECHECK_SECONDS = 5  # waiters also re-check the queue this often, to pick up expired leases
+WITHDRAWAL_STREAM_HEARTBEAT_SECONDS = 15
+WITHDRAWAL_NOTIFY_CHANNEL = "plinko_withdrawal_tasks"  # Postgres LISTEN/NOTIFY channel
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))
+WEBHOOK_QUEUE_MAX_UPDATES = int(os.environ.get("WEBHOOK_QUEUE_MAX_UPDATES", 1000))  # beyond this the webhook answers 503 and Telegram redelivers
+WEBHOOK_BATCH_SIZE = 20
+WEBHOOK_DEDUPE_UPDATES = 10000  # how many recent update_ids are remembered to drop redeliveries
+OUTBOUND_SENDER_THREADS = 4
+OUTBOUND_PER_CHAT_RATE = 1.0  # messages per second to one chat (Telegram's limit)
+OUTBOUND_PER_CHAT_BURST = 1
+OUTBOUND_GLOBAL_RATE = 30.0  # messages per second across all chats (Telegram's limit)
+OUTBOUND_GLOBAL_BURST = 30
+OUTBOUND_MAX_PENDING = 10000
+OUTBOUND_MAX_ATTEMPTS = 5
+OUTBOUND_MAX_RATE_LIMITED_ATTEMPTS = 20  # 429s are expected under load, so they get a separate, larger limit
+OUTBOUND_RETRY_BASE_SECONDS = 1.0
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+SQL_PROFILE = os.environ.get("SQL_PROFILE") == "1"  # profile every request and job (staging); admins can use X-SQL-Profile: 1
+SQL_PROFILE_DIR = os.environ.get("SQL_PROFILE_DIR", "sql_profiles")
+SQL_PROFILE_SLOW_MS = int(os.environ.get("SQL_PROFILE_SLOW_MS", 250))  # profiles at least this slow are written as reports
+SCHEDULER_LEASE_SECONDS = 30  # how long a silent leader keeps its lease (lock-table fallback) before another process takes over
+SCHEDULER_RENEW_SECONDS = 10  # the leader renews (or, on Postgres, checks its lock connection) this often; followers retry as often
+APP_ROLES = os.environ.get("APP_ROLES", "web,scheduler,setup")  # startup work create_app() does in this process
+STARTUP_ROLES = ('setup', 'scheduler', 'web')  # in the order they are started
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# --- Metrics, served in Prometheus text format at /metrics ---
+metrics = MetricsRegistry()
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "plinko_http_request_duration_seconds", "Time to produce a response, per Flask endpoint.", ["endpoint", "method"])
+HTTP_REQUESTS = metrics.counter(
+    "plinko_http_requests_total", "Responses per Flask endpoint and status code.", ["endpoint", "method", "status"])
+HTTP_REQUEST_SQL_QUERIES = metrics.histogram(
+    "plinko_http_request_sql_queries", "SQL statements executed per request.", ["endpoint"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100))
+HTTP_REQUEST_SQL_SECONDS = metrics.histogram(
+    "plinko_http_request_sql_duration_seconds", "Time spent in SQL per request.", ["endpoint"])
+SQL_QUERY_SECONDS = metrics.histogram("plinko_sql_query_duration_seconds", "Duration of every SQL statement.")
+JOB_SECONDS = metrics.histogram("plinko_job_duration_seconds", "Scheduler job run time.", ["job"])
+JOB_RUNS = metrics.counter("plinko_job_runs_total", "Scheduler job runs.", ["job", "status"])
+TELEGRAM_CALL_SECONDS = metrics.histogram("plinko_telegram_call_duration_seconds", "Telegram Bot API call latency.", ["method"])
+TELEGRAM_CALLS = metrics.counter("plinko_telegram_calls_total", "Telegram Bot API calls.", ["method", "status"])
+TON_CALL_SECONDS = metrics.histogram("plinko_ton_call_duration_seconds", "TON lite-client call latency.", ["call"])
+TON_CALLS = metrics.counter("plinko_ton_calls_total", "TON lite-client calls.", ["call", "status"])
+WITHDRAWAL_TASKS_EXHAUSTED = metrics.counter(
+    "plinko_withdrawal_tasks_exhausted_total", "Withdrawal tasks failed after WITHDRAWAL_MAX_ATTEMPTS claims without an ack.")
+GIFT_CATALOG_LOOKUPS = metrics.counter(
+    "plinko_gift_catalog_lookups_total", "Gift catalog reads served from the snapshot (hit) or after a reload check (refresh).", ["result"])
+
+class TTLCache:
+    """
+    Thread-safe LRU cache with a per-entry TTL measured on the monotonic clock and a hard
+    budget on both the number of entries and their approximate size in bytes.
+    """
+    def __init__(self, max_entries, max_bytes, ttl_seconds, sizeof=sys.getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sizeof = sizeof
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.total_bytes -= size
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] <= now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl_seconds=None):
+        """Stores value under key. Returns False if the value alone is over the byte budget."""
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return False
+        expires_at = time.monotonic() + (self.ttl_seconds if ttl_seconds is None else ttl_seconds)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at, size)
+            self.total_bytes += size
+            while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+        return True
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._remove(key)
+            return entry[0]
+
+    def sweep(self):
+        """Drops every expired entry. Returns how many were removed."""
+        now = time.monotonic()
+        with self._lock:
+            expired_keys = [key for key, (_, expires_at, _) in self._entries.items() if expires_at <= now]
+            for key in expired_keys:
+                self._remove(key)
+            self.expirations += len(expired_keys)
+        return len(expired_keys)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+def board_entry_size(entry):
+    """Approximate memory footprint of a cached board (gift dicts plus its serialized slots), used for the byte budget."""
+    slots_response = entry.slots_response
+    return (sys.getsizeof(entry) + len(slots_response.body) * 3
+            + sum(len(encoded) for encoded in slots_response.encoded.values()))
+
+board_cache = TTLCache(BOARD_CACHE_MAX_ENTRIES, BOARD_CACHE_MAX_BYTES, CACHE_EXPIRATION_SECONDS, sizeof=board_entry_size)
+
+def board_cache_key(bet_mode, seed):
+    return f"{bet_mode}:{seed}"
+
+class PrecomputedResponse:
+    """
+    A JSON body serialized and compressed once (gzip, and brotli when installed), served as-is on every
+    request with a strong ETag per encoding. Requests whose If-None-Match matches get an empty 304.
+    """
+    def __init__(self, payload, cache_control):
+        self.body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.cache_control = cache_control
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.encoded = {'gzip': gzip.compress(self.body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.encoded['br'] = brotli.compress(self.body, quality=11)
+
+    def etag_for(self, encoding):
+        return f"{self.etag}-{encoding}" if encoding else self.etag
+
+    def not_modified(self, request):
+        if_none_match = request.if_none_match
+        if if_none_match.star_tag:
+            return True
+        return any(if_none_match.contains_weak(self.etag_for(encoding)) for encoding in (None, *self.encoded))
+
+    def to_response(self, request):
+        encoding = next((name for name in ('br', 'gzip') if name in self.encoded and request.accept_encodings[name]), None)
+        headers = {
+            "ETag": f'"{self.etag_for(encoding)}"',
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if self.not_modified(request):
+            return Response(status=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(self.encoded[encoding] if encoding else self.body, status=200, headers=headers,
+                        content_type='application/json')
+
 if not DATABASE_URL:
     logger.error("DATABASE_URL is not set. Exiting.")
     exit()
 
 engine = create_engine(DATABASE_URL, pool_recycle=300)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+sql_profiler = None
+sql_profiler_lock = threading.Lock()
+
+def get_sql_profiler():
+    """The profiler is created, and its engine listeners installed, on first use: unprofiled workers never load it."""
+    global sql_profiler
+    if sql_profiler is None:
+        with sql_profiler_lock:
+            if sql_profiler is None:
+                from sql_profiler import SQLProfiler
+                sql_profiler = SQLProfiler(engine, SQL_PROFILE_DIR, SQL_PROFILE_SLOW_MS / 1000)
+    return sql_profiler
+
+def save_sql_profile(profile, always=False):
+    """Writes slow profiles, profiles with N+1 candidates (or any, if always) as reports. Returns the file name or None."""
+    n_plus_one = profile.n_plus_one()
+    if n_plus_one:
+        logger.warning(f"Possible N+1 in {profile.name}: " + "; ".join(
+            f"{candidate['count']}x {candidate['shape'][:120]}" for candidate in n_plus_one))
+    if not (always or n_plus_one or profile.is_slow):
+        return None
+    try:
+        return sql_profiler.write_report(profile)
+    except OSError as e:
+        logger.error(f"Could not write SQL profile report: {e}")
+        return None
+
+@event.listens_for(engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+@event.listens_for(engine, "after_cursor_execute")
+def record_query_time(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started_at"].pop()
+    SQL_QUERY_SECONDS.observe(elapsed)
+    if has_request_context() and "sql_queries" in g:
+        g.sql_queries += 1
+        g.sql_seconds += elapsed
+
 Base = declarative_base()
 
+MILLI_STARS_PER_STAR = 1000
+
+def to_milli_stars(stars):
+    """Converts a Stars amount (int, float, str or Decimal) to integer milli-Stars."""
+    return int((Decimal(str(stars)) * MILLI_STARS_PER_STAR).to_integral_value(rounding=ROUND_HALF_UP))
+
+def from_milli_stars(milli_stars):
+    return milli_stars / MILLI_STARS_PER_STAR
+
 # --- Database Models (balance, bet_amount, winnings are now in STARS) ---
+# BIGINT ids in Postgres; on SQLite (local runs, benchmarks) only INTEGER PRIMARY KEY auto-increments
+AutoIncrementBigInteger = BigInteger().with_variant(Integer, "sqlite")
+
 class User(Base):
     __tablename__ = "plinko_users"
     telegram_id = Column(BigInteger, primary_key=True, index=True, autoincrement=False)
     username = Column(String, nullable=True)
     first_name = Column(String, nullable=True)
-    balance = Column(Float, default=0.0, nullable=False) # Represents Stars
+    # Integer milli-Stars; only ever changed through debit_balance/credit_balance
+    balance_milli = Column(BigInteger, default=0, server_default=text("0"), nullable=False)
     last_free_drop_claim = Column(DateTime(timezone=True), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        # /add looks users up by func.lower(username)
+        Index('ix_plinko_users_lower_username', func.lower(username)),
+    )
+
+    @property
+    def balance(self):
+        """Balance in Stars, for display and API responses."""
+        return from_milli_stars(self.balance_milli or 0)
+
 class PlinkoDrop(Base):
     __tablename__ = "plinko_drops"
-    id = Column(BigInteger, primary_key=True)
+    id = Column(AutoIncrementBigInteger, primary_key=True)
     user_id = Column(BigInteger, ForeignKey("plinko_users.telegram_id"), nullable=False)
     bet_amount = Column(Float, nullable=False) # Represents Stars
     risk_level = Column(String, nullable=False)
@@ -228,9 +362,13 @@ class PlinkoDrop(Base):
     winnings = Column(Float, nullable=False) # Represents Stars
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        Index('ix_plinko_drops_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
 class Deposit(Base):
     __tablename__ = "plinko_deposits"
-    id = Column(BigInteger, primary_key=True)
+    id = Column(AutoIncrementBigInteger, primary_key=True)
     user_id = Column(BigInteger, ForeignKey("plinko_users.telegram_id"), nullable=False)
     amount = Column(Float, nullable=False) # Represents Stars credited
     deposit_type = Column(String, nullable=False) # 'TON', 'STARS', 'GIFT'
@@ -239,9 +377,16 @@ class Deposit(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     expires_at = Column(DateTime(timezone=True), nullable=True)
 
+    __table_args__ = (
+        # verify_ton_deposit: WHERE user_id = ? AND unique_comment = ? AND status = 'pending'
+        Index('ix_plinko_deposits_user_comment_status', 'user_id', 'unique_comment', 'status'),
+        # The partial index on pending expires_at is created by migration 3: dialect kwargs here would
+        # make SQLAlchemy import the Postgres dialect (and its drivers) whenever app.py is imported
+    )
+
 class UserGiftInventory(Base):
     __tablename__ = "plinko_user_gifts"
-    id = Column(BigInteger, primary_key=True)
+    id = Column(AutoIncrementBigInteger, primary_key=True)
     user_id = Column(BigInteger, ForeignKey("plinko_users.telegram_id"), nullable=False)
     gift_id = Column(String, nullable=False) # The gift's unique ID from TG
     gift_name = Column(String, nullable=False)
@@ -249,19 +394,673 @@ class UserGiftInventory(Base):
     imageUrl = Column(String, nullable=False)
     won_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        # Serves the keyset-paginated inventory: WHERE user_id = ? AND (won_at, id) < (?, ?) ORDER BY won_at DESC, id DESC
+        Index('ix_plinko_user_gifts_user_won_at_id', 'user_id', 'won_at', 'id'),
+    )
+
 class GiftFloorPrice(Base):
     __tablename__ = "plinko_gift_floor_prices"
     gift_name = Column(String, primary_key=True)  # The unique name, e.g., 'santahat'
     price_in_stars = Column(Float, nullable=False)
     last_updated = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
-Base.metadata.create_all(bind=engine)
+class WithdrawalTask(Base):
+    """Durable withdrawal queue for the userbot: queued -> leased -> done / failed."""
+    __tablename__ = "plinko_withdrawal_tasks"
+    id = Column(AutoIncrementBigInteger, primary_key=True)
+    task_id = Column(String, nullable=False, unique=True)  # UUID handed to the userbot
+    # Not a foreign key: the inventory row is deleted once the gift has been sent
+    inventory_id = Column(BigInteger, nullable=False, unique=True)
+    telegram_id = Column(BigInteger, nullable=False)
+    username = Column(String, nullable=True)
+    gift_name = Column(String, nullable=False)
+    gift_slug = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='queued')  # 'queued', 'leased', 'done', 'failed'
+    attempts = Column(Integer, nullable=False, default=0)
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    lease_token = Column(String(32), nullable=True)  # new on every claim; only its holder may ack the task
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index('ix_plinko_withdrawal_tasks_status_lease', 'status', 'lease_expires_at'),
+    )
+
+    def to_dict(self):
+        return {
+            "task_id": self.task_id,
+            "telegram_id": self.telegram_id,
+            "username": self.username,
+            "gift_name": self.gift_name,
+            "gift_slug": self.gift_slug,
+            "inventory_id": self.inventory_id,
+            "attempts": self.attempts,
+            "lease_token": self.lease_token,
+            "lease_expires_at": self.lease_expires_at.isoformat() if self.lease_expires_at else None
+        }
+
+class BoardCacheEntry(Base):
+    __tablename__ = "plinko_board_cache"
+    cache_key = Column(String, primary_key=True)  # '<bet_mode>:<seed>'
+    bet_mode = Column(String, nullable=False)
+    board = Column(Text, nullable=False)  # JSON list of the gifts on the board
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+class SchedulerLease(Base):
+    """Lock-table fallback of scheduler leader election, for databases without advisory locks (SQLite)."""
+    __tablename__ = "plinko_scheduler_leases"
+    name = Column(String(64), primary_key=True)
+    holder = Column(String(128), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+class TonSyncCursor(Base):
+    """How far the TON deposit watcher has matched the wallet's transactions, so a new scheduler leader resumes there."""
+    __tablename__ = "plinko_ton_sync_cursors"
+    address = Column(String, primary_key=True)
+    last_lt = Column(BigInteger, nullable=False)  # every transaction up to this lt was matched against open deposits
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+# --- Schema migrations: run at deploy time with `flask --app app migrate` (or `python app.py migrate`) ---
+class SchemaMigration(Base):
+    __tablename__ = "plinko_schema_migrations"
+    version = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    applied_at = Column(DateTime(timezone=True), server_default=func.now())
+
+MIGRATIONS_LOCK_KEY = 7_316_001  # pg_advisory_xact_lock key, so concurrent deploys migrate one at a time
+SCHEDULER_LOCK_KEY = 7_316_002  # pg_try_advisory_lock key held by the scheduler leader
+
+def migrate_user_balance_to_milli(conn):
+    """plinko_users.balance (Float Stars) -> plinko_users.balance_milli (integer milli-Stars)."""
+    columns = {column['name'] for column in inspect(conn).get_columns(User.__tablename__)}
+    if 'balance' not in columns:
+        return
+    if 'balance_milli' not in columns:
+        conn.execute(text("ALTER TABLE plinko_users ADD COLUMN balance_milli BIGINT NOT NULL DEFAULT 0"))
+    conn.execute(text("UPDATE plinko_users SET balance_milli = CAST(ROUND(balance * 1000) AS BIGINT)"))
+    conn.execute(text("ALTER TABLE plinko_users DROP COLUMN balance"))
+
+def create_hot_path_indexes(conn):
+    """create_all() never touches existing tables, so add the indexes declared on the hot-path models."""
+    for model in (User, PlinkoDrop, Deposit, UserGiftInventory):
+        for index in model.__table__.indexes:
+            # IF NOT EXISTS rather than checkfirst: reflection does not report expression indexes
+            conn.execute(CreateIndex(index, if_not_exists=True))
+
+def create_pending_deposit_expiry_index(conn):
+    """Only open TON deposits are ever scanned by expiry, so keep the index to those rows (same DDL on Postgres and SQLite)."""
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_plinko_deposits_pending_expires_at "
+        "ON plinko_deposits (expires_at) WHERE status = 'pending'"
+    ))
+
+def add_withdrawal_lease_token(conn):
+    """plinko_withdrawal_tasks.lease_token, which acks must match (tables created by create_all() already have it)."""
+    columns = {column['name'] for column in inspect(conn).get_columns(WithdrawalTask.__tablename__)}
+    if 'lease_token' not in columns:
+        conn.execute(text("ALTER TABLE plinko_withdrawal_tasks ADD COLUMN lease_token VARCHAR(32)"))
+
+def create_ton_sync_cursor_table(conn):
+    """create_all() already makes the table; recording it as a migration lets the startup schema check ask for it."""
+    TonSyncCursor.__table__.create(conn, checkfirst=True)
+
+# Append only: (version, name, function taking a connection). Each must be safe on a freshly created schema.
+MIGRATIONS = [
+    (1, 'user_balance_milli', migrate_user_balance_to_milli),
+    (2, 'hot_path_indexes', create_hot_path_indexes),
+    (3, 'pending_deposit_expiry_index', create_pending_deposit_expiry_index),
+    (4, 'withdrawal_lease_token', add_withdrawal_lease_token),
+    (5, 'ton_sync_cursor', create_ton_sync_cursor_table),
+]
+
+def run_migrations(bind):
+    """
+    Creates missing tables, then applies every pending migration in order inside one
+    transaction, recording each in plinko_schema_migrations. Returns the applied versions.
+    """
+    with bind.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+        Base.metadata.create_all(bind=conn)
+        applied_versions = set(conn.execute(select(SchemaMigration.version)).scalars())
+        newly_applied = []
+        for version, name, migrate in MIGRATIONS:
+            if version in applied_versions:
+                continue
+            logger.info(f"Applying schema migration {version}: {name}")
+            migrate(conn)
+            conn.execute(insert(SchemaMigration).values(version=version, name=name))
+            newly_applied.append(version)
+    logger.info(f"Schema is up to date ({len(newly_applied)} migration(s) applied).")
+    return newly_applied
+
+def pending_migrations(bind):
+    """Versions in MIGRATIONS not yet recorded in the database (all of them on an empty database)."""
+    with bind.connect() as conn:
+        if not inspect(conn).has_table(SchemaMigration.__tablename__):
+            return [version for version, _, _ in MIGRATIONS]
+        applied_versions = set(conn.execute(select(SchemaMigration.version)).scalars())
+    return [version for version, _, _ in MIGRATIONS if version not in applied_versions]
+
+def ensure_schema_is_current(bind):
+    """
+    Refuses to serve a database whose schema is behind the code (e.g. still on Float
+    balances), which would otherwise fail on every request. With RUN_MIGRATIONS_ON_STARTUP=1
+    the pending migrations are applied instead, under the migration lock.
+    """
+    pending = pending_migrations(bind)
+    if not pending:
+        return
+    if os.environ.get("RUN_MIGRATIONS_ON_STARTUP") == "1":
+        run_migrations(bind)
+        return
+    raise RuntimeError(
+        f"Database schema is behind the code: migration(s) {', '.join(map(str, pending))} pending. "
+        "Run `python app.py migrate` (or `flask --app app migrate`) first, or set RUN_MIGRATIONS_ON_STARTUP=1."
+    )
+
+def explain_hot_queries(bind):
+    """Returns {query name: plan lines} for the hot-path queries, to check they use the indexes above."""
+    hot_queries = {
+        'inventory_page': select(UserGiftInventory.id, UserGiftInventory.won_at)
+            .where(UserGiftInventory.user_id == 1)
+            .order_by(UserGiftInventory.won_at.desc(), UserGiftInventory.id.desc()).limit(50),
+        'verify_ton_deposit': select(Deposit.id)
+            .where(Deposit.user_id == 1, Deposit.unique_comment == 'plnko_00000000', Deposit.status == 'pending'),
+        'pending_deposits_by_expiry': select(Deposit.id)
+            .where(Deposit.status == 'pending', Deposit.expires_at < func.now()),
+        'admin_add_username': select(User.telegram_id).where(func.lower(User.username) == 'username'),
+        'user_drops': select(PlinkoDrop.id).where(PlinkoDrop.user_id == 1).order_by(PlinkoDrop.timestamp.desc()).limit(50),
+    }
+    plans = {}
+    with bind.connect() as conn:
+        explain = "EXPLAIN QUERY PLAN" if conn.dialect.name == 'sqlite' else "EXPLAIN"
+        for name, query in hot_queries.items():
+            sql = str(query.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+            plans[name] = [" ".join(str(col) for col in row) for row in conn.execute(text(f"{explain} {sql}"))]
+    return plans
+
+# --- Balance ledger: single-statement, race-free balance changes ---
+def debit_balance(db, user_id, amount_milli):
+    """
+    Subtracts amount_milli from the user's balance only if it covers it. Runs as one
+    conditional UPDATE, so concurrent debits cannot overdraw the balance.
+    Returns the new balance in milli-Stars, or None if the user is missing or cannot afford it.
+    """
+    stmt = (
+        update(User)
+        .where(User.telegram_id == user_id, User.balance_milli >= amount_milli)
+        .values(balance_milli=User.balance_milli - amount_milli)
+        .returning(User.balance_milli)
+        .execution_options(synchronize_session=False)
+    )
+    return db.execute(stmt).scalar_one_or_none()
+
+def credit_balance(db, user_id, amount_milli):
+    """Adds amount_milli to the user's balance. Returns the new balance in milli-Stars, or None if the user is missing."""
+    stmt = (
+        update(User)
+        .where(User.telegram_id == user_id)
+        .values(balance_milli=User.balance_milli + amount_milli)
+        .returning(User.balance_milli)
+        .execution_options(synchronize_session=False)
+    )
+    return db.execute(stmt).scalar_one_or_none()
+
+# --- Board store: seed -> board mapping shared by get_board_slots and plinko_drop ---
+class InProcessBoardStore:
+    """Keeps boards in this worker's memory. Only safe with a single worker or sticky sessions."""
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, bet_mode, seed):
+        return self.cache.get(board_cache_key(bet_mode, seed))
+
+    def get_or_create(self, bet_mode, seed, build):
+        """Returns (entry, created). build() is only called when no live board exists for the seed."""
+        key = board_cache_key(bet_mode, seed)
+        entry = self.cache.get(key)
+        if entry:
+            return entry, False
+        entry = build()
+        self.cache.set(key, entry)
+        return entry, True
+
+    def sweep(self):
+        return self.cache.sweep()
+
+    def sweep_local(self):
+        return self.cache.sweep()
+
+    def stats(self):
+        return self.cache.stats()
+
+class DatabaseBoardStore:
+    """
+    Shares boards between gunicorn workers and nodes through the plinko_board_cache table,
+    so a board served by one worker can be dropped on by any other. Boards never change once
+    written, so a local TTLCache in front of the table absorbs repeat reads.
+    """
+    def __init__(self, session_factory, local_cache, ttl_seconds):
+        self.session_factory = session_factory
+        self.local_cache = local_cache
+        self.ttl_seconds = ttl_seconds
+
+    def _remember(self, key, entry, expires_at):
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        remaining = (expires_at - dt.now(timezone.utc)).total_seconds()
+        if remaining > 0:
+            self.local_cache.set(key, entry, ttl_seconds=remaining)
+
+    def _load(self, db, key):
+        row = db.query(BoardCacheEntry).filter(
+            BoardCacheEntry.cache_key == key,
+            BoardCacheEntry.expires_at > dt.now(timezone.utc)
+        ).first()
+        if not row:
+            return None
+        entry = PreparedBoard(row.bet_mode, json.loads(row.board))
+        self._remember(key, entry, row.expires_at)
+        return entry
+
+    def get(self, bet_mode, seed):
+        key = board_cache_key(bet_mode, seed)
+        entry = self.local_cache.get(key)
+        if entry:
+            return entry
+        db = self.session_factory()
+        try:
+            return self._load(db, key)
+        finally:
+            db.close()
+
+    def get_or_create(self, bet_mode, seed, build):
+        key = board_cache_key(bet_mode, seed)
+        entry = self.local_cache.get(key)
+        if entry:
+            return entry, False
+        db = self.session_factory()
+        try:
+            entry = self._load(db, key)
+            if entry:
+                return entry, False
+            entry = build()
+            now = dt.now(timezone.utc)
+            expires_at = now + timedelta(seconds=self.ttl_seconds)
+            # An expired row for the same seed may still be around until the next sweep. Only that one
+            # may go: a live row committed by another worker meanwhile must win via the IntegrityError below
+            db.query(BoardCacheEntry).filter(
+                BoardCacheEntry.cache_key == key,
+                BoardCacheEntry.expires_at <= now
+            ).delete(synchronize_session=False)
+            db.add(BoardCacheEntry(cache_key=key, bet_mode=bet_mode, board=json.dumps(entry.board), expires_at=expires_at))
+            try:
+                db.commit()
+            except IntegrityError:
+                # Another worker stored this seed first; everyone must agree on its board
+                db.rollback()
+                existing = self._load(db, key)
+                if existing:
+                    return existing, False
+                raise
+            self._remember(key, entry, expires_at)
+            return entry, True
+        finally:
+            db.close()
+
+    def sweep_local(self):
+        return self.local_cache.sweep()
+
+    def sweep(self):
+        removed = self.local_cache.sweep()
+        db = self.session_factory()
+        try:
+            removed += db.query(BoardCacheEntry).filter(BoardCacheEntry.expires_at <= dt.now(timezone.utc)).delete(synchronize_session=False)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error sweeping expired boards: {e}")
+        finally:
+            db.close()
+        return removed
+
+    def stats(self):
+        return self.local_cache.stats()
+
+def create_board_store(kind):
+    if kind == 'database':
+        return DatabaseBoardStore(SessionLocal, board_cache, CACHE_EXPIRATION_SECONDS)
+    if kind != 'memory':
+        logger.warning(f"Unknown BOARD_STORE '{kind}', falling back to the in-process board store.")
+    return InProcessBoardStore(board_cache)
+
+board_store = create_board_store(BOARD_STORE)
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
+
+@app.before_request
+def start_request_metrics():
+    g.request_started_at = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+def record_request_metrics(status_code):
+    if "request_started_at" not in g:
+        return
+    # Endpoint names, not URL rules: the webhook's rule contains the bot token
+    endpoint = flask_request.endpoint or "unmatched"
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.pop("request_started_at"), endpoint=endpoint, method=flask_request.method)
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=flask_request.method, status=status_code)
+    HTTP_REQUEST_SQL_QUERIES.observe(g.sql_queries, endpoint=endpoint)
+    HTTP_REQUEST_SQL_SECONDS.observe(g.sql_seconds, endpoint=endpoint)
+
+@app.after_request
+def finish_request_metrics(response):
+    record_request_metrics(response.status_code)
+    return response
+
+@app.teardown_request
+def finish_failed_request_metrics(error):
+    # after_request does not run for unhandled exceptions
+    if error is not None:
+        record_request_metrics(500)
+
+def sql_profile_requested_by_admin():
+    received_key = flask_request.headers.get('X-API-Key')
+    return (flask_request.headers.get('X-SQL-Profile') == '1' and bool(GIFT_DEPOSIT_API_KEY)
+            and received_key is not None and hmac.compare_digest(received_key, GIFT_DEPOSIT_API_KEY))
+
+@app.before_request
+def start_sql_profile():
+    g.sql_profile_requested = sql_profile_requested_by_admin()
+    if SQL_PROFILE or g.sql_profile_requested:
+        get_sql_profiler().start(f"{flask_request.method} {flask_request.endpoint or 'unmatched'}")
+
+@app.after_request
+def finish_sql_profile(response):
+    profile = sql_profiler.stop() if sql_profiler else None
+    if profile:
+        report = save_sql_profile(profile, always=g.get("sql_profile_requested", False))
+        response.headers['X-SQL-Queries'] = str(profile.statement_count)
+        response.headers['X-SQL-Time-Ms'] = f"{profile.sql_seconds * 1000:.1f}"
+        response.headers['X-SQL-N-Plus-One'] = str(len(profile.n_plus_one()))
+        if report:
+            response.headers['X-SQL-Profile-Report'] = report
+    return response
+
+@app.teardown_request
+def finish_failed_sql_profile(error):
+    profile = sql_profiler.stop() if sql_profiler else None  # still active only if after_request did not run
+    if profile:
+        save_sql_profile(profile, always=True)
+
+telegram_http_sessions = threading.local()
+
+def timed_telegram_request(method, url, **kwargs):
+    """telebot request sender: one keep-alive session per thread, with every call timed per API method."""
+    session = getattr(telegram_http_sessions, "session", None)
+    if session is None:
+        session = telegram_http_sessions.session = requests.Session()
+    with timed_call(TELEGRAM_CALL_SECONDS, TELEGRAM_CALLS, method=url.rsplit('/', 1)[-1]):
+        return session.request(method, url, **kwargs)
+
+def timed_job(job_name, func):
+    """Wraps a scheduler job so its run time and outcome are recorded."""
+    @functools.wraps(func)
+    def run_job():
+        with timed_call(JOB_SECONDS, JOB_RUNS, job=job_name):
+            if not SQL_PROFILE:
+                return func()
+            with get_sql_profiler().profile(f"job:{job_name}") as profile:
+                try:
+                    return func()
+                finally:
+                    profile.finish()
+                    save_sql_profile(profile)
+    return run_job
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations."""
+    run_migrations(engine)
+
+@app.cli.command('explain-hot-queries')
+def explain_hot_queries_command():
+    """Print the query plans of the hot-path queries."""
+    for name, plan in explain_hot_queries(engine).items():
+        print(f"-- {name}")
+        print("\n".join(plan))
+
+class TokenBucket:
+    """Allows `rate` events per second with bursts of up to `capacity`. Not thread-safe, callers hold a lock."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class OutboundMessage:
+    __slots__ = ('chat_id', 'text', 'kwargs', 'attempts', 'rate_limited_attempts')
+
+    def __init__(self, chat_id, text, kwargs):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.rate_limited_attempts = 0
+
+class OutboundDispatcher:
+    """
+    Sends bot messages from background threads so handlers never wait on the Telegram API.
+    Messages to one chat go out in order, within a per-chat and a global token bucket. A 429 pauses the chat
+    for the retry_after Telegram asks for, up to max_rate_limited_attempts times per message. Other transient
+    errors are retried with exponential backoff, up to max_attempts times.
+    Plain text messages (no markup or options) that queue up for one chat are merged into one message.
+    """
+    def __init__(self, bot, threads, per_chat_rate, per_chat_burst, global_rate, global_burst, max_pending, max_attempts,
+                 max_rate_limited_attempts=OUTBOUND_MAX_RATE_LIMITED_ATTEMPTS):
+        self._bot = bot
+        self._thread_count = threads
+        self._per_chat_rate = per_chat_rate
+        self._per_chat_burst = per_chat_burst
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._max_pending = max_pending
+        self._max_attempts = max_attempts
+        self._max_rate_limited_attempts = max_rate_limited_attempts
+        self._outboxes = OrderedDict()  # chat_id -> deque of OutboundMessage, in round-robin order
+        self._chat_buckets = {}
+        self._paused_until = {}  # chat_id -> monotonic time, after a 429 or a failed attempt
+        self._in_flight = set()
+        self._condition = threading.Condition()
+        self._threads = []
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rate_limited = 0
+        self.coalesced = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        """Queues a message and returns immediately. Returns False if the queue is full and the message was dropped."""
+        with self._condition:
+            if self.pending >= self._max_pending:
+                self.dropped += 1
+                logger.warning(f"Outbound message queue is full, dropping a message to chat {chat_id}.")
+                return False
+            self._outboxes.setdefault(chat_id, deque()).append(OutboundMessage(chat_id, text, kwargs))
+            self.pending += 1
+            self._condition.notify()
+        self._ensure_started()
+        return True
+
+    def reply_to(self, message, text, **kwargs):
+        return self.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._condition:
+            if self._threads:
+                return
+            for index in range(self._thread_count):
+                thread = threading.Thread(target=self._run, name=f"outbound-sender-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _next_batch(self, now):
+        """Picks the next chat that may be sent to and pops its message(s). Returns (messages, 0) or (None, wait_seconds)."""
+        wait = None
+        global_delay = self._global_bucket.delay(now)
+        for chat_id in list(self._outboxes):
+            if chat_id in self._in_flight:
+                continue
+            bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self._per_chat_rate, self._per_chat_burst))
+            delay = max(bucket.delay(now), self._paused_until.get(chat_id, 0) - now, global_delay)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            outbox = self._outboxes.pop(chat_id)
+            messages = [outbox.popleft()]
+            if not messages[0].kwargs:
+                length = len(messages[0].text)
+                while outbox and not outbox[0].kwargs and length + 2 + len(outbox[0].text) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+                    length += 2 + len(outbox[0].text)
+                    messages.append(outbox.popleft())
+            if outbox:
+                self._outboxes[chat_id] = outbox  # back of the round-robin order
+            bucket.consume(now)
+            self._global_bucket.consume(now)
+            self._paused_until.pop(chat_id, None)
+            self._in_flight.add(chat_id)
+            return messages, 0
+        return None, wait
+
+    def _prune_buckets(self, now):
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items()
+                        if chat_id not in self._outboxes and chat_id not in self._in_flight and bucket.is_full(now)]:
+            del self._chat_buckets[chat_id]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    messages, wait = self._next_batch(time.monotonic())
+                    if messages:
+                        break
+                    self._condition.wait(wait)
+            self._deliver(messages)
+
+    def _deliver(self, messages):
+        chat_id = messages[0].chat_id
+        retry_after = None
+        permanent = False
+        error = None
+        try:
+            if len(messages) == 1:
+                self._bot.send_message(chat_id, messages[0].text, **messages[0].kwargs)
+            else:
+                self._bot.send_message(chat_id, "\n\n".join(message.text for message in messages))
+        except telebot.apihelper.ApiTelegramException as e:
+            error = e
+            if e.error_code == 429:
+                retry_after = ((e.result_json or {}).get('parameters') or {}).get('retry_after', OUTBOUND_RETRY_BASE_SECONDS)
+                logger.warning(f"Telegram rate limit for chat {chat_id}, retrying after {retry_after}s.")
+            else:
+                permanent = e.error_code < 500  # e.g. the user blocked the bot
+        except Exception as e:
+            error = e
+
+        with self._condition:
+            now = time.monotonic()
+            self._in_flight.discard(chat_id)
+            if error is None:
+                self.sent += len(messages)
+                self.coalesced += len(messages) - 1
+                retry = []
+            elif retry_after is not None:
+                self.rate_limited += 1
+                for message in messages:
+                    message.rate_limited_attempts += 1
+                retry = [message for message in messages if message.rate_limited_attempts < self._max_rate_limited_attempts]
+                if len(retry) < len(messages):
+                    logger.error(f"Giving up on {len(messages) - len(retry)} message(s) to chat {chat_id} "
+                                 f"after {self._max_rate_limited_attempts} rate limits.")
+                self.failed += len(messages) - len(retry)
+            else:
+                for message in messages:
+                    message.attempts += 1
+                retry = [] if permanent else [message for message in messages if message.attempts < self._max_attempts]
+                if len(retry) < len(messages):
+                    logger.error(f"Giving up on {len(messages) - len(retry)} message(s) to chat {chat_id}: {error}")
+                self.failed += len(messages) - len(retry)
+                retry_after = OUTBOUND_RETRY_BASE_SECONDS * 2 ** (max(message.attempts for message in messages) - 1)
+            self.pending -= len(messages) - len(retry)
+            if retry:
+                self._outboxes.setdefault(chat_id, deque()).extendleft(reversed(retry))
+                self._outboxes.move_to_end(chat_id, last=False)
+                self._paused_until[chat_id] = now + retry_after
+            if len(self._chat_buckets) > 2 * len(self._outboxes) + 1000:
+                self._prune_buckets(now)
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "pending": self.pending,
+                "chats": len(self._outboxes),
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "rate_limited": self.rate_limited,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
+
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + "/bot{0}/{1}"
+telebot.apihelper.CUSTOM_REQUEST_SENDER = timed_telegram_request
 bot = telebot.TeleBot(BOT_TOKEN, threaded=False) if BOT_TOKEN else None
+outbound = OutboundDispatcher(bot, OUTBOUND_SENDER_THREADS, OUTBOUND_PER_CHAT_RATE, OUTBOUND_PER_CHAT_BURST,
+                              OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST, OUTBOUND_MAX_PENDING, OUTBOUND_MAX_ATTEMPTS) if bot else None
+
+@functools.lru_cache(maxsize=4)
+def webapp_secret_key(bot_token):
+    """HMAC("WebAppData", bot_token): the key Mini App initData is signed with. Derived once per token."""
+    return hmac.new("WebAppData".encode(), bot_token.encode(), hashlib.sha256).digest()
+
+if BOT_TOKEN:
+    webapp_secret_key(BOT_TOKEN)
+
+# Raw initData header digest -> verified user dict. A Mini App session sends the same header on every call.
+init_data_cache = TTLCache(INIT_DATA_CACHE_MAX_ENTRIES, 16 * 1024 * 1024, INIT_DATA_CACHE_SECONDS)
 
 def validate_init_data(init_data_str, bot_token):
+    if not init_data_str or not bot_token:
+        return None
+    cache_key = hashlib.sha256(init_data_str.encode()).digest()
+    user_data = init_data_cache.get(cache_key)
+    if user_data is not None:
+        return user_data
     try:
         parsed_data = dict(parse_qs(init_data_str))
         hash_received = parsed_data.pop('hash')[0]
@@ -269,25 +1068,46 @@ def validate_init_data(init_data_str, bot_token):
         for key in sorted(parsed_data.keys()):
             data_check_string_parts.append(f"{key}={parsed_data[key][0]}")
         data_check_string = "\n".join(data_check_string_parts)
-        secret_key = hmac.new("WebAppData".encode(), bot_token.encode(), hashlib.sha256).digest()
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        if calculated_hash == hash_received:
-            user_data = json.loads(unquote(parsed_data['user'][0]))
-            return user_data
-        return None
+        calculated_hash = hmac.new(webapp_secret_key(bot_token), data_check_string.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(calculated_hash, hash_received):
+            return None
+
+        cache_seconds = INIT_DATA_CACHE_SECONDS
+        if INIT_DATA_MAX_AGE_SECONDS:
+            auth_date = int(parsed_data['auth_date'][0])
+            remaining_seconds = auth_date + INIT_DATA_MAX_AGE_SECONDS - time.time()
+            if remaining_seconds <= 0:
+                logger.warning("Rejected expired initData.")
+                return None
+            cache_seconds = min(cache_seconds, remaining_seconds)
+
+        user_data = json.loads(unquote(parsed_data['user'][0]))
+        init_data_cache.set(cache_key, user_data, ttl_seconds=cache_seconds)
+        return user_data
     except Exception as e:
         logger.error(f"InitData validation error: {e}")
         return None
 
 if bot:
+    # (user_id, channel) -> bool. Errors are never cached.
+    subscription_cache = TTLCache(100000, 16 * 1024 * 1024, SUBSCRIBED_CACHE_SECONDS)
+    subscription_check_pool = ThreadPoolExecutor(max_workers=SUBSCRIPTION_CHECK_WORKERS, thread_name_prefix="subscription-check")
+
+    def is_channel_member(user_id, channel):
+        subscribed = subscription_cache.get((user_id, channel))
+        if subscribed is not None:
+            return subscribed
+        member = bot.get_chat_member(chat_id=channel, user_id=user_id)
+        subscribed = member.status in ['creator', 'administrator', 'member']
+        subscription_cache.set((user_id, channel), subscribed,
+                               ttl_seconds=SUBSCRIBED_CACHE_SECONDS if subscribed else NOT_SUBSCRIBED_CACHE_SECONDS)
+        return subscribed
+
     def check_subscription(user_id):
-        """Checks if a user is subscribed to all required channels."""
+        """Checks if a user is subscribed to all required channels (all channels are checked concurrently)."""
         try:
-            for channel in REQUIRED_CHANNELS:
-                member = bot.get_chat_member(chat_id=channel, user_id=user_id)
-                if member.status not in ['creator', 'administrator', 'member']:
-                    return False
-            return True
+            futures = [subscription_check_pool.submit(is_channel_member, user_id, channel) for channel in REQUIRED_CHANNELS]
+            return all([future.result() for future in futures])
         except Exception as e:
             logger.error(f"Error checking subscription for user {user_id}: {e}")
             return False
@@ -300,46 +1120,46 @@ if bot:
             web_app_info = types.WebAppInfo(url=WEB_APP_URL)
             app_button = types.InlineKeyboardButton(text="🎮 Открыть Plinko", web_app=web_app_info)
             markup.add(app_button)
-            bot.send_message(message.chat.id, "Добро пожаловать в Plinko! Нажмите кнопку ниже, чтобы начать игру.", reply_markup=markup)
+            outbound.send_message(message.chat.id, "Добро пожаловать в Plinko! Нажмите кнопку ниже, чтобы начать игру.", reply_markup=markup)
         else:
             markup = types.InlineKeyboardMarkup(row_width=1)
             for i, channel in enumerate(REQUIRED_CHANNELS):
                 markup.add(types.InlineKeyboardButton(text=f"Канал {i+1}", url=f"https://t.me/{channel[1:]}"))
             markup.add(types.InlineKeyboardButton(text="✅ Проверить подписку", callback_data="check_sub"))
-            bot.send_message(message.chat.id, "Для доступа к боту, пожалуйста, подпишитесь на наши каналы:", reply_markup=markup)
+            outbound.send_message(message.chat.id, "Для доступа к боту, пожалуйста, подпишитесь на наши каналы:", reply_markup=markup)
 
     @bot.message_handler(commands=['add'])
     def add_balance_command(message):
         if message.from_user.id not in ADMIN_USER_IDS:
-            bot.reply_to(message, "Эта команда доступна только администраторам.")
+            outbound.reply_to(message, "Эта команда доступна только администраторам.")
             return
         try:
             parts = message.text.split()
             if len(parts) != 3:
-                bot.reply_to(message, "Неверный формат. Используйте: `/add @username сумма_в_Stars`", parse_mode="Markdown")
+                outbound.reply_to(message, "Неверный формат. Используйте: `/add @username сумма_в_Stars`", parse_mode="Markdown")
                 return
             target_username = parts[1].replace('@', '').strip().lower()
             amount_to_add = float(parts[2]) # Amount is now in Stars
             if amount_to_add <= 0:
-                bot.reply_to(message, "Сумма должна быть положительной.")
+                outbound.reply_to(message, "Сумма должна быть положительной.")
                 return
                 
             db = SessionLocal()
-            target_user = db.query(User).filter(func.lower(User.username) == target_username).first()
-            if not target_user:
-                bot.reply_to(message, f"Пользователь @{target_username} не найден.")
+            target_user_id = db.query(User.telegram_id).filter(func.lower(User.username) == target_username).scalar()
+            if not target_user_id:
+                outbound.reply_to(message, f"Пользователь @{target_username} не найден.")
                 return
                 
-            target_user.balance += amount_to_add
-            new_deposit = Deposit(user_id=target_user.telegram_id, amount=amount_to_add, deposit_type='GIFT', status='completed')
+            new_balance_milli = credit_balance(db, target_user_id, to_milli_stars(amount_to_add))
+            new_deposit = Deposit(user_id=target_user_id, amount=amount_to_add, deposit_type='GIFT', status='completed')
             db.add(new_deposit)
             db.commit()
             
-            bot.reply_to(message, f"✅ Успешно добавлено {amount_to_add:.2f} Stars пользователю @{target_username}. Новый баланс: {target_user.balance:.2f} Stars")
-            bot.send_message(target_user.telegram_id, f"🎉 Администратор пополнил ваш баланс на {amount_to_add:.2f} Stars!")
+            outbound.reply_to(message, f"✅ Успешно добавлено {amount_to_add:.2f} Stars пользователю @{target_username}. Новый баланс: {from_milli_stars(new_balance_milli):.2f} Stars")
+            outbound.send_message(target_user_id, f"🎉 Администратор пополнил ваш баланс на {amount_to_add:.2f} Stars!")
         except Exception as e:
             logger.error(f"Error in /add command: {e}")
-            bot.reply_to(message, "Произошла ошибка при выполнении команды.")
+            outbound.reply_to(message, "Произошла ошибка при выполнении команды.")
         finally:
             if 'db' in locals() and db.is_active:
                 db.close()
@@ -367,13 +1187,11 @@ if bot:
         balance_to_add = stars_amount
         db = SessionLocal()
         try:
-            user = db.query(User).filter(User.telegram_id == user_id).first()
-            if user:
-                user.balance += balance_to_add
+            if credit_balance(db, user_id, to_milli_stars(balance_to_add)) is not None:
                 new_deposit = Deposit(user_id=user_id, amount=balance_to_add, deposit_type='STARS', status='completed')
                 db.add(new_deposit)
                 db.commit()
-                bot.send_message(user_id, f"✅ Оплата прошла успешно! Ваш баланс пополнен на {balance_to_add} Stars.")
+                outbound.send_message(user_id, f"✅ Оплата прошла успешно! Ваш баланс пополнен на {balance_to_add} Stars.")
             else:
                 logger.warning(f"User {user_id} not found after successful Stars payment.")
         except Exception as e:
@@ -427,7 +1245,7 @@ def claim_free_drop():
         
         # --- NEW PROBABILITY LOGIC FOR FREE TRY ---
         # 95% chance for a 'Bear', 5% for a 'Ring'
-        won_gift_name = random.choices(['Bear', 'Ring'], weights=[95, 5], k=1)[0]
+        won_gift_name = draw_free_drop_gift()
         
         # Get gift details from the EMOJI_GIFTS dictionary
         gift_data = EMOJI_GIFTS[won_gift_name]
@@ -485,75 +1303,35 @@ def plinko_drop():
     if bet_mode not in BET_MODES_CONFIG:
         return jsonify({"error": "Invalid bet mode"}), 400
     
-    cached_entry = board_cache.get(seed)
+    cached_entry = board_store.get(bet_mode, seed)
 
-    if not cached_entry or (dt.utcnow() - cached_entry['timestamp']) > timedelta(seconds=CACHE_EXPIRATION_SECONDS):
+    if not cached_entry:
         logger.warning(f"STRICT CACHE MISS for seed: {seed}. Rejecting drop.")
-        if seed in board_cache:
-            del board_cache[seed]
         return jsonify({
             "error": "Ваша игровая сессия истекла. Пожалуйста, сделайте бросок еще раз."
         }), 400
 
-    # Используем данные из кэша
-    all_gifts_on_board = cached_entry['board']
-    
-    # --- FIX: Строка `del board_cache[seed]` была УДАЛЕНА отсюда. ---
+    # Используем данные из кэша: это ровно та доска, которую видел пользователь.
     # Теперь сид остается валидным для нескольких бросков.
+    prepared_board = cached_entry
 
     config = BET_MODES_CONFIG[bet_mode]
-    bet_amount = Decimal(str(config['bet_amount']))
+    bet_amount = config['bet_amount']
     
     db = SessionLocal()
     try:
-        user = db.query(User).filter(User.telegram_id == user_id).first()
-        if not user or Decimal(str(user.balance)) < bet_amount:
+        new_balance_milli = debit_balance(db, user_id, to_milli_stars(bet_amount))
+        if new_balance_milli is None:
             return jsonify({"error": "Insufficient balance"}), 400
-
-        user.balance = float(Decimal(str(user.balance)) - bet_amount)
         
-        # --- NEW PROBABILITY LOGIC ---
         # The user's requested probabilities (85, 18, 2) sum to 105.
         # We'll use them as weights to create a correct distribution.
-        outcome_category = random.choices(
-            ['lose', 'breakeven', 'win'], 
-            weights=[85, 18, 2], 
-            k=1
-        )[0]
-
-        # Generate the consistent board layout based on the seed
-        all_gifts_on_board = generate_board_gifts(bet_mode, seed)
-        
-        # Filter gifts based on the determined outcome
-        lose_gifts = [g for g in all_gifts_on_board if g['value'] < bet_amount]
-        # Allow a small tolerance for breakeven, e.g., for values like 999.9 vs 1000
-        breakeven_gifts = [g for g in all_gifts_on_board if abs(g['value'] - float(bet_amount)) < 1.0]
-        win_gifts = [g for g in all_gifts_on_board if g['value'] > bet_amount]
-
-        eligible_gifts = []
-        if outcome_category == 'lose' and lose_gifts:
-            eligible_gifts = lose_gifts
-        elif outcome_category == 'breakeven' and breakeven_gifts:
-            eligible_gifts = breakeven_gifts
-        elif outcome_category == 'win' and win_gifts:
-            eligible_gifts = win_gifts
-
-        # Fallback mechanism in case a category has no eligible gifts on the board
-        if not eligible_gifts:
-            if outcome_category == 'win': # If win is chosen but no win gifts, fallback to the best possible
-                eligible_gifts = [max(all_gifts_on_board, key=lambda g: g['value'])]
-            elif outcome_category == 'breakeven': # Fallback to closest value to bet
-                eligible_gifts = [min(all_gifts_on_board, key=lambda g: abs(g['value'] - float(bet_amount)))]
-            else: # Fallback for 'lose'
-                eligible_gifts = lose_gifts if lose_gifts else [min(all_gifts_on_board, key=lambda g: g['value'])]
-
-        # Select the final winning item
-        won_item_details = random.choice(eligible_gifts)
-
-        # Find all possible indices for the winning item on the board to ensure animation is correct
-        possible_indices = [i for i, gift in enumerate(all_gifts_on_board) if gift['id'] == won_item_details['id']]
-        final_index = random.choice(possible_indices)
-        # --- END OF NEW LOGIC ---
+        outcome_category = draw_outcome_categories(1)[0]
+
+        # Partitions and fallbacks were computed once when the board was cached
+        won_gift, final_index = prepared_board.draw(outcome_category)
+        # Copied, board entries are shared with the gift catalog
+        won_item_details = dict(won_gift)
 
         # Add the won item to the user's inventory
         new_gift_in_inventory = UserGiftInventory(
@@ -574,7 +1352,7 @@ def plinko_drop():
 
         return jsonify({
             "status": "success", 
-            "new_balance": user.balance, 
+            "new_balance": from_milli_stars(new_balance_milli), 
             "final_slot_index": final_index, 
             "won_item": won_item_details
         })
@@ -586,109 +1364,193 @@ def plinko_drop():
     finally:
         db.close()
 
-def generate_board_gifts(bet_mode, seed):
+class GiftCatalog(game.GiftCatalog):
+    """The game catalog snapshot plus its precomputed /api/get_all_gift_prices response."""
+    @functools.cached_property
+    def price_list_response(self):
+        """Built on first use, once per snapshot."""
+        return PrecomputedResponse(self.price_list(), f"public, max-age={GIFT_PRICES_MAX_AGE_SECONDS}")
+
+class PreparedBoard(game.PreparedBoard):
     """
-    Generates the complete, symmetrical list of gift objects for a given bet mode and seed.
-    This is the single source of truth for both displaying and awarding prizes.
+    A game board plus what get_board_slots returns for it, serialized once. Its ETag hashes the
+    slots, so every worker agrees on it and it changes whenever the catalog changes the board.
     """
-    config = BET_MODES_CONFIG[bet_mode]
-    master_gift_list = build_master_gift_list()
-    if not master_gift_list:
-        raise ConnectionError("Could not retrieve gift market data.")
+    def __init__(self, bet_mode, board):
+        super().__init__(bet_mode, board)
+        self.slots_response = PrecomputedResponse({"slots": self.formatted_slots()}, BOARD_SLOTS_CACHE_CONTROL)
 
-    # Use the provided seed to initialize the random number generator for deterministic results
-    seeded_random = random.Random(seed)
+def generate_board_gifts(bet_mode, seed):
+    """Generates the board for a bet mode and seed from the current gift catalog."""
+    catalog = get_gift_catalog()
+    if not catalog:
+        raise ConnectionError("Could not retrieve gift market data.")
+    return game.generate_board_gifts(bet_mode, seed, catalog)
 
-    # Determine gifts for the first half of the board
-    num_slots = len(config['slots'])
-    mid_point_index = (num_slots // 2)
-    first_half_gifts = []
-    
-    for i in range(mid_point_index + 1):
-        slot_config = config['slots'][i]
-        gift_object = None
-        if isinstance(slot_config, list):
-            min_val, max_val = slot_config
-            # This simplified call is now correct
-            gift_object = select_gift_for_range(min_val, max_val, master_gift_list, seeded_random)
-        elif isinstance(slot_config, str) and slot_config in EMOJI_GIFTS:
-            gift_data = EMOJI_GIFTS[slot_config]
-            gift_object = {
-                "id": gift_data["id"], "name": slot_config, 
-                "value": gift_data["value"], "imageUrl": gift_data["imageUrl"]
-            }
-        first_half_gifts.append(gift_object)
-    
-    # Construct the full symmetrical list by mirroring the first half
-    second_half_gifts = first_half_gifts[:-1][::-1]
-    return first_half_gifts + second_half_gifts
+gift_catalog = None
+gift_catalog_version = 0
+gift_catalog_lock = threading.Lock()
 
-def get_gift_floor_prices():
+def fetch_gift_floor_prices_from_db():
     """
     Retrieves all gift floor prices directly from the database.
-    This is now the primary source of truth for game logic.
+    Only used to (re)build the in-memory gift catalog.
     """
     db = SessionLocal()
     try:
-        prices = db.query(GiftFloorPrice).all()
+        prices = db.query(GiftFloorPrice.gift_name, GiftFloorPrice.price_in_stars).all()
         if not prices:
             logger.warning("GiftFloorPrice table is empty. Game logic may be affected.")
             return {}
-        # Return data in the same format as before { 'gift_name': price }
-        return {item.gift_name: item.price_in_stars for item in prices}
+        return {gift_name: price for gift_name, price in prices}
     finally:
         db.close()
 
-def build_master_gift_list():
+def refresh_gift_catalog(force=False):
     """
-    Combines regular gifts (with dynamic floor prices) and emoji gifts (with fixed values)
-    into a single list of gift objects. Uses the new REGULAR_GIFTS structure for precise filenames.
+    Reloads floor prices from the DB and atomically swaps in a new catalog snapshot.
+    The version is only bumped when the prices actually changed, so readers holding the
+    previous snapshot keep seeing a consistent view until they ask again.
     """
-    master_list = []
-    floor_prices_stars = get_gift_floor_prices()
+    global gift_catalog, gift_catalog_version
+    with gift_catalog_lock:
+        current = gift_catalog
+        # Another thread may have refreshed it while we were waiting for the lock
+        if not force and current is not None and time.monotonic() - current.checked_at < CACHE_DURATION_SECONDS:
+            return current
+        try:
+            floor_prices = fetch_gift_floor_prices_from_db()
+        except Exception as e:
+            if current is None:
+                raise
+            logger.error(f"Could not refresh gift catalog, keeping version {current.version}: {e}")
+            current.checked_at = time.monotonic()
+            return current
+
+        if current is not None and current.floor_prices == floor_prices:
+            current.checked_at = time.monotonic()
+            return current
+
+        gift_catalog_version += 1
+        gift_catalog = GiftCatalog(floor_prices, gift_catalog_version)
+        logger.info(f"Gift catalog version {gift_catalog.version} loaded with {len(gift_catalog)} gifts.")
+        return gift_catalog
+
+def get_gift_catalog():
+    """Returns the current gift catalog snapshot, loading it on first use or once it gets stale."""
+    catalog = gift_catalog
+    if catalog is None or time.monotonic() - catalog.checked_at >= CACHE_DURATION_SECONDS:
+        GIFT_CATALOG_LOOKUPS.inc(result="refresh")
+        return refresh_gift_catalog()
+    GIFT_CATALOG_LOOKUPS.inc(result="hit")
+    return catalog
 
-    # Add regular gifts
-    for gift_id, gift_data in REGULAR_GIFTS.items():
-        internal_name = gift_data["name"]
-        exact_filename = gift_data["filename"]
-        
-        name_key = internal_name.lower()
-        if name_key in floor_prices_stars:
-            master_list.append({
-                "id": gift_id,
-                "name": internal_name,
-                "value": floor_prices_stars[name_key],
-                # This now uses the correct folder and exact filename
-                "imageUrl": f"https://raw.githubusercontent.com/Vasiliy-katsyka/plinko/main/GiftImages/{exact_filename}"
-            })
-
-    # Add emoji gifts (this part does not need to change)
-    for gift_name, gift_data in EMOJI_GIFTS.items():
-        master_list.append({
-            "id": gift_data["id"],
-            "name": gift_name,
-            "value": gift_data["value"],
-            "imageUrl": gift_data["imageUrl"]
-        })
-    
-    return master_list
+def get_gift_floor_prices():
+    """Returns the { 'gift_name': price } mapping of the current catalog snapshot (no DB round-trip)."""
+    return get_gift_catalog().floor_prices
+
+SQLITE_INVENTORY_POSITION_FORMAT = '%Y-%m-%d %H:%M:%f'
+
+def inventory_position_column(dialect_name):
+    """
+    won_at as pages are ordered and compared by. SQLite keeps datetimes as text, and rows
+    stamped by CURRENT_TIMESTAMP ('... HH:MM:SS') and by SQLAlchemy ('... HH:MM:SS.ffffff')
+    do not compare correctly as strings, so there both are normalized to milliseconds.
+    """
+    if dialect_name == 'sqlite':
+        return func.strftime(SQLITE_INVENTORY_POSITION_FORMAT, UserGiftInventory.won_at)
+    return UserGiftInventory.won_at
+
+def inventory_position_param(dialect_name, won_at):
+    """A decoded cursor's won_at in the representation inventory_position_column() compares against."""
+    if dialect_name == 'sqlite':
+        return f"{won_at:%Y-%m-%d %H:%M:%S}.{won_at.microsecond // 1000:03d}"
+    return won_at
+
+def encode_inventory_cursor(position, inventory_id):
+    """Opaque cursor for the (position, id) of the last item of a page, position as inventory_position_column() returned it."""
+    position = position.isoformat() if isinstance(position, dt) else position
+    return base64.urlsafe_b64encode(f"{position}|{inventory_id}".encode()).decode()
+
+def decode_inventory_cursor(cursor):
+    """Raises ValueError for anything that is not a cursor produced by encode_inventory_cursor."""
+    if not isinstance(cursor, str):
+        raise ValueError("Cursor must be a string")
+    won_at_str, inventory_id_str = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return dt.fromisoformat(won_at_str), int(inventory_id_str)
 
 @app.route('/api/get_inventory', methods=['POST'])
 def get_inventory():
+    """
+    Returns the user's inventory, newest first.
+    - {"limit": N, "after": cursor}: one page of at most N items plus "next_cursor" (null on the last page).
+    - {"view": "grouped"}: one entry per gift name with its count and total value.
+    - no parameters: the whole inventory, as before.
+    """
     auth_data = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth_data: return jsonify({"error": "Auth failed"}), 401
     user_id = auth_data['id']
+    data = flask_request.get_json(silent=True) or {}
+    limit = data.get('limit')
+    after = data.get('after')
+
+    if limit is not None or after is not None:
+        try:
+            limit = int(limit) if limit is not None else INVENTORY_PAGE_MAX_LIMIT
+            after_position = decode_inventory_cursor(after) if after is not None else None
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid pagination parameters"}), 400
+        if not 1 <= limit <= INVENTORY_PAGE_MAX_LIMIT:
+            return jsonify({"error": f"Limit must be between 1 and {INVENTORY_PAGE_MAX_LIMIT}"}), 400
+
     db = SessionLocal()
     try:
-        inventory_items = db.query(UserGiftInventory).filter(UserGiftInventory.user_id == user_id).order_by(UserGiftInventory.won_at.desc()).all()
-        # Convert SQLAlchemy objects to dictionaries
+        if data.get('view') == 'grouped':
+            total_value = func.sum(UserGiftInventory.value_at_win)
+            groups = db.query(
+                UserGiftInventory.gift_name,
+                func.count(UserGiftInventory.id),
+                total_value,
+                func.min(UserGiftInventory.imageUrl)
+            ).filter(UserGiftInventory.user_id == user_id).group_by(UserGiftInventory.gift_name).order_by(total_value.desc()).all()
+            return jsonify({"groups": [{
+                "name": gift_name,
+                "count": count,
+                "total_value": value,
+                "imageUrl": image_url
+            } for gift_name, count, value, image_url in groups]})
+
+        # Only the columns we serialize, no ORM objects
+        dialect_name = db.get_bind().dialect.name
+        position = inventory_position_column(dialect_name)
+        query = db.query(
+            UserGiftInventory.id,
+            UserGiftInventory.gift_name,
+            UserGiftInventory.value_at_win,
+            UserGiftInventory.imageUrl,
+            position.label('position')
+        ).filter(UserGiftInventory.user_id == user_id).order_by(position.desc(), UserGiftInventory.id.desc())
+
+        next_cursor = None
+        if limit is None:
+            inventory_items = query.all()
+        else:
+            if after_position:
+                after_won_at, after_id = after_position
+                query = query.filter(tuple_(position, UserGiftInventory.id) < tuple_(inventory_position_param(dialect_name, after_won_at), after_id))
+            inventory_items = query.limit(limit + 1).all()
+            if len(inventory_items) > limit:
+                inventory_items = inventory_items[:limit]
+                last_item = inventory_items[-1]
+                next_cursor = encode_inventory_cursor(last_item.position, last_item.id)
+
         inventory_list = [{
             "inventory_id": item.id,
             "name": item.gift_name,
             "value": item.value_at_win,
             "imageUrl": item.imageUrl
         } for item in inventory_items]
-        return jsonify({"inventory": inventory_list})
+        return jsonify({"inventory": inventory_list, "next_cursor": next_cursor})
     finally:
         db.close()
 
@@ -715,20 +1577,35 @@ def create_withdrawal_task():
         if item_to_withdraw.gift_name in EMOJI_GIFTS:
              return jsonify({"status": "error", "message": "Emoji gifts cannot be withdrawn."}), 400
 
-        # --- THIS IS THE CRITICAL PART ---
-        # Ensure the task dictionary includes the 'inventory_id'
-        task = {
-            "task_id": str(uuid.uuid4()),
-            "telegram_id": user_id,
-            "username": username,
-            "gift_name": item_to_withdraw.gift_name,
-            "gift_slug": item_to_withdraw.gift_name.lower().replace(" ", ""),
-            "inventory_id": item_to_withdraw.id # THIS LINE IS MISSING IN YOUR DEPLOYED CODE
-        }
-        withdrawal_tasks.append(task)
+        # One task per inventory item (unique inventory_id); only a failed one may be queued again
+        task = db.query(WithdrawalTask).filter(WithdrawalTask.inventory_id == item_to_withdraw.id).first()
+        if task and task.status != 'failed':
+            return jsonify({"status": "error", "message": "Withdrawal is already in progress for this item."}), 409
+        if task:
+            task.status = 'queued'
+            task.attempts = 0
+            task.lease_expires_at = None
+            task.lease_token = None
+            task.last_error = None
+        else:
+            db.add(WithdrawalTask(
+                task_id=str(uuid.uuid4()),
+                inventory_id=item_to_withdraw.id,
+                telegram_id=user_id,
+                username=username,
+                gift_name=item_to_withdraw.gift_name,
+                gift_slug=item_to_withdraw.gift_name.lower().replace(" ", ""),
+                status='queued'
+            ))
         
-        # We do NOT delete the item here. We wait for the userbot to confirm.
-        db.commit()
+        # We do NOT delete the item here. We wait for the userbot to ack the task.
+        try:
+            notify_withdrawal_listeners(db)
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            return jsonify({"status": "error", "message": "Withdrawal is already in progress for this item."}), 409
+        withdrawal_notifier.notify()
 
         logger.info(f"Created withdrawal task for user {user_id}: Withdraw '{item_to_withdraw.gift_name}'")
         return jsonify({"status": "success", "message": "Withdrawal task created."})
@@ -737,43 +1614,286 @@ def create_withdrawal_task():
 
 @app.route('/api/get_all_gift_prices', methods=['GET'])
 def get_all_gift_prices():
-    all_gifts = []
-    
-    # Add emoji gifts with fixed prices
-    for name, data in EMOJI_GIFTS.items():
-        all_gifts.append({
-            "name": name,
-            "value": data['value'],
-            "imageUrl": data['imageUrl']
-        })
-        
-    # Add collectible gifts with dynamic floor prices
-    floor_prices = get_gift_floor_prices()
-    for gift_id, data in REGULAR_GIFTS.items():
-        normalized_name = data['name'].lower().replace("'", "")
-        if normalized_name in floor_prices:
-            all_gifts.append({
-                "name": data['name'].replace("'", " ").title(),
-                "value": floor_prices[normalized_name],
-                "imageUrl": f"https://raw.githubusercontent.com/Vasiliy-katsyka/plinko/main/GiftImages/{data['filename']}"
-            })
-
-    # Sort by value, descending
-    all_gifts.sort(key=lambda x: x['value'], reverse=True)
-    return jsonify(all_gifts)
+    """Serialized once per catalog version; clients revalidate with If-None-Match."""
+    return get_gift_catalog().price_list_response.to_response(flask_request)
+
+def fail_exhausted_withdrawal_tasks(db, claimable):
+    """Marks claimable tasks that already used WITHDRAWAL_MAX_ATTEMPTS claims as 'failed', so they stop cycling."""
+    exhausted_ids = db.execute(
+        select(WithdrawalTask.id)
+        .where(claimable, WithdrawalTask.attempts >= WITHDRAWAL_MAX_ATTEMPTS)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if not exhausted_ids:
+        return
+    db.execute(
+        update(WithdrawalTask)
+        .where(WithdrawalTask.id.in_(exhausted_ids))
+        .values(status='failed', lease_expires_at=None, lease_token=None,
+                last_error=f"Gave up after {WITHDRAWAL_MAX_ATTEMPTS} claims without a done/failed ack")
+        .execution_options(synchronize_session=False)
+    )
+    WITHDRAWAL_TASKS_EXHAUSTED.inc(len(exhausted_ids))
+    logger.warning(f"Withdrawal task(s) {exhausted_ids} failed after {WITHDRAWAL_MAX_ATTEMPTS} attempts; "
+                   "see /api/withdrawal_tasks/failed.")
+
+def claim_withdrawal_tasks(db, limit, lease_seconds):
+    """
+    Leases up to `limit` queued tasks (or leased ones whose lease ran out). FOR UPDATE SKIP LOCKED
+    lets several userbot processes claim in parallel without ever getting the same task.
+    Tasks that have been claimed WITHDRAWAL_MAX_ATTEMPTS times are failed instead of leased again.
+    Every claim gets a new lease_token, so a worker whose lease ran out can no longer ack the task.
+    """
+    now = dt.now(timezone.utc)
+    claimable = or_(
+        WithdrawalTask.status == 'queued',
+        and_(WithdrawalTask.status == 'leased', WithdrawalTask.lease_expires_at < now)
+    )
+    fail_exhausted_withdrawal_tasks(db, claimable)
+    claimable_ids = db.execute(
+        select(WithdrawalTask.id)
+        .where(claimable, WithdrawalTask.attempts < WITHDRAWAL_MAX_ATTEMPTS)
+        .order_by(WithdrawalTask.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if not claimable_ids:
+        return []
+    db.execute(
+        update(WithdrawalTask)
+        .where(WithdrawalTask.id.in_(claimable_ids))
+        .values(status='leased', lease_expires_at=now + timedelta(seconds=lease_seconds),
+                lease_token=uuid.uuid4().hex, attempts=WithdrawalTask.attempts + 1)
+        .execution_options(synchronize_session=False)
+    )
+    return db.query(WithdrawalTask).filter(WithdrawalTask.id.in_(claimable_ids)).order_by(WithdrawalTask.id).all()
+
+class TaskNotifier:
+    """Wakes up long-poll and stream waiters of this process when new tasks may be available."""
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.generation = 0
+
+    def notify(self):
+        with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+
+    def wait(self, seen_generation, timeout):
+        """Blocks until notify() is called after seen_generation was read, or timeout. Returns True if notified."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.generation != seen_generation, timeout)
+
+withdrawal_notifier = TaskNotifier()
+withdrawal_listener_lock = threading.Lock()
+withdrawal_listener_started = False
+
+def notify_withdrawal_listeners(db):
+    """Queues a Postgres NOTIFY in the current transaction, so waiters in every worker wake up on commit."""
+    if db.get_bind().dialect.name == 'postgresql':
+        db.execute(text("SELECT pg_notify(:channel, '')"), {"channel": WITHDRAWAL_NOTIFY_CHANNEL})
+
+def listen_for_withdrawal_tasks():
+    """Background thread: forwards Postgres notifications on WITHDRAWAL_NOTIFY_CHANNEL to withdrawal_notifier."""
+    while True:
+        connection = None
+        try:
+            connection = engine.raw_connection()
+            connection.detach()  # This connection lives outside the pool for good
+            dbapi_connection = connection.driver_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {WITHDRAWAL_NOTIFY_CHANNEL}")
+            while True:
+                if select_module.select([dbapi_connection], [], [], WITHDRAWAL_STREAM_HEARTBEAT_SECONDS) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                if dbapi_connection.notifies:
+                    dbapi_connection.notifies.clear()
+                    withdrawal_notifier.notify()
+        except Exception as e:
+            logger.error(f"Withdrawal task listener failed, reconnecting: {e}")
+            time.sleep(WITHDRAWAL_RECHECK_SECONDS)
+        finally:
+            if connection is not None:
+                connection.close()
+
+def ensure_withdrawal_listener():
+    """Starts the LISTEN thread on first use when running on Postgres (other databases only get in-process wake-ups)."""
+    global withdrawal_listener_started
+    if withdrawal_listener_started or engine.dialect.name != 'postgresql':
+        return
+    with withdrawal_listener_lock:
+        if not withdrawal_listener_started:
+            threading.Thread(target=listen_for_withdrawal_tasks, name="withdrawal-task-listener", daemon=True).start()
+            withdrawal_listener_started = True
+
+def claim_withdrawal_batch(limit, lease_seconds):
+    db = SessionLocal()
+    try:
+        tasks = [task.to_dict() for task in claim_withdrawal_tasks(db, limit, lease_seconds)]
+        db.commit()
+        return tasks
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def claim_withdrawal_batch_waiting(limit, lease_seconds, wait_seconds):
+    """Claims tasks, blocking up to wait_seconds until some are available."""
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        # Read the generation before claiming, so a task created in between is not missed
+        seen_generation = withdrawal_notifier.generation
+        tasks = claim_withdrawal_batch(limit, lease_seconds)
+        remaining = deadline - time.monotonic()
+        if tasks or remaining <= 0:
+            return tasks
+        withdrawal_notifier.wait(seen_generation, min(remaining, WITHDRAWAL_RECHECK_SECONDS))
+
+def withdrawal_claim_params():
+    limit = min(max(flask_request.args.get('limit', WITHDRAWAL_CLAIM_MAX_LIMIT, type=int), 1), WITHDRAWAL_CLAIM_MAX_LIMIT)
+    lease_seconds = max(flask_request.args.get('lease', WITHDRAWAL_LEASE_SECONDS, type=int), 1)
+    return limit, lease_seconds
 
 @app.route('/api/get_withdrawal_tasks', methods=['GET'])
 def get_withdrawal_tasks():
+    """
+    Claims a batch of withdrawal tasks for the userbot. Each must be acked before its lease expires.
+    With ?wait=N (max WITHDRAWAL_MAX_WAIT_SECONDS) the request long-polls until tasks arrive.
+    Long-polls hold a worker, so run gunicorn with threaded or async workers when using them.
+    """
     # Secure this endpoint for the userbot
     received_key = flask_request.headers.get('X-API-Key')
     if not GIFT_DEPOSIT_API_KEY or received_key != GIFT_DEPOSIT_API_KEY:
         raise Unauthorized("Invalid API Key")
-    
-    # Return current tasks and clear the list
-    tasks_to_process = list(withdrawal_tasks)
-    withdrawal_tasks.clear()
-    
-    return jsonify({"tasks": tasks_to_process})
+
+    limit, lease_seconds = withdrawal_claim_params()
+    wait_seconds = min(max(flask_request.args.get('wait', 0, type=int), 0), WITHDRAWAL_MAX_WAIT_SECONDS)
+
+    try:
+        if wait_seconds:
+            ensure_withdrawal_listener()
+            tasks = claim_withdrawal_batch_waiting(limit, lease_seconds, wait_seconds)
+        else:
+            tasks = claim_withdrawal_batch(limit, lease_seconds)
+        return jsonify({"tasks": tasks})
+    except Exception as e:
+        logger.error(f"Error claiming withdrawal tasks: {e}", exc_info=True)
+        return jsonify({"error": "An internal server error occurred"}), 500
+
+@app.route('/api/withdrawal_tasks/failed', methods=['GET'])
+def get_failed_withdrawal_tasks():
+    """Failed withdrawal tasks, newest first, for operators. The user can queue the item again."""
+    received_key = flask_request.headers.get('X-API-Key')
+    if not GIFT_DEPOSIT_API_KEY or received_key != GIFT_DEPOSIT_API_KEY:
+        raise Unauthorized("Invalid API Key")
+
+    limit = min(max(flask_request.args.get('limit', 50, type=int), 1), WITHDRAWAL_CLAIM_MAX_LIMIT)
+    db = SessionLocal()
+    try:
+        tasks = db.query(WithdrawalTask).filter(WithdrawalTask.status == 'failed').order_by(
+            WithdrawalTask.updated_at.desc(), WithdrawalTask.id.desc()
+        ).limit(limit).all()
+        return jsonify({"tasks": [{
+            **task.to_dict(),
+            "last_error": task.last_error,
+            "updated_at": task.updated_at.isoformat() if task.updated_at else None
+        } for task in tasks]})
+    finally:
+        db.close()
+
+@app.route('/api/withdrawal_tasks/stream', methods=['GET'])
+def stream_withdrawal_tasks():
+    """
+    Server-sent events feed for the userbot: every batch of claimed tasks is pushed as a
+    `tasks` event as soon as it is created, with comment heartbeats in between.
+    Tasks are leased exactly as with get_withdrawal_tasks and must be acked the same way.
+    """
+    received_key = flask_request.headers.get('X-API-Key')
+    if not GIFT_DEPOSIT_API_KEY or received_key != GIFT_DEPOSIT_API_KEY:
+        raise Unauthorized("Invalid API Key")
+
+    limit, lease_seconds = withdrawal_claim_params()
+    ensure_withdrawal_listener()
+
+    def generate():
+        while True:
+            try:
+                tasks = claim_withdrawal_batch_waiting(limit, lease_seconds, WITHDRAWAL_STREAM_HEARTBEAT_SECONDS)
+            except Exception as e:
+                logger.error(f"Error claiming withdrawal tasks for stream: {e}", exc_info=True)
+                yield "event: error\ndata: {}\n\n"
+                return
+            if tasks:
+                yield f"event: tasks\ndata: {json.dumps({'tasks': tasks})}\n\n"
+            else:
+                yield ": keepalive\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/ack_withdrawal_task', methods=['POST'])
+def ack_withdrawal_task():
+    """
+    Called by the userbot once it has handled a claimed task, with the lease_token it was claimed with:
+    - "done": the gift was sent; the inventory item is removed.
+    - "failed": the gift could not be sent; the item stays in the inventory.
+    - "retry": put the task back in the queue.
+    """
+    received_key = flask_request.headers.get('X-API-Key')
+    if not GIFT_DEPOSIT_API_KEY or received_key != GIFT_DEPOSIT_API_KEY:
+        raise Unauthorized("Invalid API Key")
+
+    data = flask_request.get_json() or {}
+    task_id = data.get('task_id')
+    lease_token = data.get('lease_token')
+    outcome = data.get('status')
+    if not task_id or not isinstance(lease_token, str) or outcome not in ('done', 'failed', 'retry'):
+        return jsonify({"status": "error", "message": "task_id, lease_token and a status of 'done', 'failed' or 'retry' are required."}), 400
+
+    db = SessionLocal()
+    try:
+        task = db.query(WithdrawalTask).filter(
+            WithdrawalTask.task_id == task_id,
+            WithdrawalTask.status == 'leased',
+            WithdrawalTask.lease_token == lease_token
+        ).with_for_update().first()
+        if not task:
+            if not db.query(WithdrawalTask.id).filter(WithdrawalTask.task_id == task_id).first():
+                return jsonify({"status": "error", "message": "Task not found."}), 404
+            # Already acked, never claimed, or re-leased to another worker since this lease ran out
+            return jsonify({"status": "error", "message": "Task is not leased to you (lease_token does not match)."}), 409
+
+        if outcome == 'done':
+            task.status = 'done'
+            db.query(UserGiftInventory).filter(
+                UserGiftInventory.id == task.inventory_id,
+                UserGiftInventory.user_id == task.telegram_id
+            ).delete(synchronize_session=False)
+        elif outcome == 'failed':
+            task.status = 'failed'
+            task.last_error = (data.get('error') or '')[:500] or None
+        else:
+            task.status = 'queued'
+            notify_withdrawal_listeners(db)
+        task.lease_expires_at = None
+        task.lease_token = None
+        db.commit()
+        if outcome == 'retry':
+            withdrawal_notifier.notify()
+
+        logger.info(f"Withdrawal task {task_id} ({task.gift_name} for user {task.telegram_id}) acked as {outcome}.")
+        return jsonify({"status": "success"})
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error acking withdrawal task {task_id}: {e}", exc_info=True)
+        return jsonify({"status": "error", "message": "An internal server error occurred."}), 500
+    finally:
+        db.close()
 
 @app.route('/api/public/deposit_gift', methods=['POST'])
 def public_deposit_gift():
@@ -798,12 +1918,6 @@ def public_deposit_gift():
     
     db = SessionLocal()
     try:
-        # 3. Find the user
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
-        if not user:
-            logger.warning(f"Gift deposit attempt for non-existent user: {telegram_id}")
-            return jsonify({"status": "error", "message": f"User with ID {telegram_id} not found."}), 404
-
         # --- NEW UNIFIED PRICE LOOKUP LOGIC ---
         gift_value_in_stars = None
 
@@ -826,11 +1940,16 @@ def public_deposit_gift():
             return jsonify({"status": "error", "message": f"Gift '{gift_title}' is not recognized or has no price."}), 400
         # --- END OF NEW LOGIC ---
 
-        # 5. Update user balance and log the deposit
-        user.balance += gift_value_in_stars
+        # 4. Update user balance (this also tells us whether the user exists) and log the deposit
+        new_balance_milli = credit_balance(db, telegram_id, to_milli_stars(gift_value_in_stars))
+        if new_balance_milli is None:
+            db.rollback()
+            logger.warning(f"Gift deposit attempt for non-existent user: {telegram_id}")
+            return jsonify({"status": "error", "message": f"User with ID {telegram_id} not found."}), 404
+        new_balance = from_milli_stars(new_balance_milli)
         
         new_deposit = Deposit(
-            user_id=user.telegram_id, 
+            user_id=telegram_id, 
             amount=gift_value_in_stars, 
             deposit_type='GIFT_TRANSFER', 
             status='completed'
@@ -838,13 +1957,13 @@ def public_deposit_gift():
         db.add(new_deposit)
         db.commit()
 
-        logger.info(f"Successfully processed gift '{gift_title}' for user {telegram_id}. Added {gift_value_in_stars} Stars. New balance: {user.balance}")
+        logger.info(f"Successfully processed gift '{gift_title}' for user {telegram_id}. Added {gift_value_in_stars} Stars. New balance: {new_balance}")
 
-        # 6. Return success response
+        # 5. Return success response
         return jsonify({
             "status": "success",
             "message": f"Successfully credited {gift_value_in_stars:.2f} Stars for the '{gift_title}' gift.",
-            "new_balance": user.balance,
+            "new_balance": new_balance,
             "credited_amount": gift_value_in_stars
         })
 
@@ -866,25 +1985,34 @@ def convert_gift():
 
     db = SessionLocal()
     try:
-        gift_to_convert = db.query(UserGiftInventory).filter(UserGiftInventory.id == inventory_id, UserGiftInventory.user_id == user_id).first()
-        if not gift_to_convert:
-            return jsonify({"error": "Gift not found in your inventory."}), 404
+        # Deleting with RETURNING makes the conversion happen at most once, even for concurrent requests
+        value_at_win = db.execute(
+            delete(UserGiftInventory)
+            .where(
+                UserGiftInventory.id == inventory_id,
+                UserGiftInventory.user_id == user_id,
+                # Items queued for withdrawal cannot be converted at the same time
+                ~exists().where(
+                    WithdrawalTask.inventory_id == UserGiftInventory.id,
+                    WithdrawalTask.status.in_(('queued', 'leased'))
+                )
+            )
+            .returning(UserGiftInventory.value_at_win)
+            .execution_options(synchronize_session=False)
+        ).scalar_one_or_none()
+        if value_at_win is None:
+            return jsonify({"error": "Gift not found in your inventory or it is being withdrawn."}), 404
 
-        user = db.query(User).filter(User.telegram_id == user_id).first()
-        
-        # --- CHANGE IS HERE ---
         # New: Calculate the conversion value with a 20% bonus
-        conversion_value = gift_to_convert.value_at_win * 1.20
+        converted_stars = conversion_value(value_at_win)
         
         # New: Add the boosted value to the user's balance
-        user.balance += conversion_value
-        
-        db.delete(gift_to_convert)
+        new_balance_milli = credit_balance(db, user_id, to_milli_stars(converted_stars))
         db.commit()
 
         # New: We can even notify the user of the bonus in the success message
-        success_message = f"Gift converted! You received {conversion_value:.2f} Stars (including a 20% bonus)."
-        return jsonify({"status": "success", "message": success_message, "new_balance": user.balance})
+        success_message = f"Gift converted! You received {converted_stars:.2f} Stars (including a 20% bonus)."
+        return jsonify({"status": "success", "message": success_message, "new_balance": from_milli_stars(new_balance_milli)})
     except Exception as e:
         db.rollback()
         logger.error(f"Error converting gift: {e}")
@@ -892,50 +2020,47 @@ def convert_gift():
     finally:
         db.close()
 
-@app.route('/api/get_board_slots', methods=['POST'])
+@app.route('/api/get_board_slots', methods=['GET', 'POST'])
 def get_board_slots():
-    auth_data = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
-    if not auth_data: return jsonify({"error": "Authentication failed"}), 401
-    
-    data = flask_request.get_json()
+    """
+    Returns the slots of the board for (betMode, seed), as JSON body or ?betMode=&seed= query (GET).
+    Revalidating an existing board with If-None-Match needs no auth; generating a new one does.
+    """
+    data = flask_request.args if flask_request.method == 'GET' else (flask_request.get_json() or {})
     bet_mode = data.get('betMode', '200')
     seed = data.get('seed')
 
     if bet_mode not in BET_MODES_CONFIG:
         return jsonify({"error": "Invalid bet mode"}), 400
-    
+    # The seed is client-supplied and becomes a cache key, so keep it bounded
+    if not isinstance(seed, str) or not seed or len(seed) > MAX_SEED_LENGTH:
+        return jsonify({"error": "Invalid board seed"}), 400
+
+    if flask_request.if_none_match:
+        existing_entry = board_store.get(bet_mode, seed)
+        if existing_entry and existing_entry.slots_response.not_modified(flask_request):
+            return existing_entry.slots_response.to_response(flask_request)
+
+    auth_data = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
+    if not auth_data: return jsonify({"error": "Authentication failed"}), 401
+
     try:
         # --- START: NEW "CHECK CACHE FIRST" LOGIC ---
         
-        # Step 1: Check if a board for this exact seed already exists and is not expired.
-        cached_entry = board_cache.get(seed)
-        if cached_entry and (dt.utcnow() - cached_entry['timestamp']) < timedelta(seconds=CACHE_EXPIRATION_SECONDS):
-            logger.info(f"CACHE HIT for board seed: {seed}. Returning existing board.")
-            all_gifts_on_board = cached_entry['board']
+        # Step 1: Check if a board for this exact mode and seed already exists and is not expired.
+        # Step 2: If not in the store (or expired), generate it ONCE and store it.
+        cached_entry, created = board_store.get_or_create(
+            bet_mode, seed, lambda: PreparedBoard(bet_mode, generate_board_gifts(bet_mode, seed))
+        )
+        if created:
+            logger.info(f"CACHE MISS for board seed: {seed}. Generated and cached new board.")
         else:
-            # Step 2: If not in cache (or expired), generate it ONCE and store it.
-            logger.info(f"CACHE MISS for board seed: {seed}. Generating and caching new board.")
-            all_gifts_on_board = generate_board_gifts(bet_mode, seed)
-            board_cache[seed] = {
-                'board': all_gifts_on_board,
-                'timestamp': dt.utcnow()
-            }
+            logger.info(f"CACHE HIT for board seed: {seed}. Returning existing board.")
         
         # --- END: NEW "CHECK CACHE FIRST" LOGIC ---
         
-        # Step 3: Format the response for the frontend (this runs for both cache hits and misses).
-        formatted_slots = []
-        bet_amount = BET_MODES_CONFIG[bet_mode]['bet_amount']
-        for gift in all_gifts_on_board:
-            if gift:
-                gift_value = gift.get('value', 0)
-                formatted_slots.append({
-                    "name": gift.get('name', 'Unknown'),
-                    "imageUrl": gift.get('imageUrl', ''),
-                    "value": gift_value,
-                    "multiplier": gift_value / bet_amount if bet_amount > 0 else 0
-                })
-        return jsonify({"slots": formatted_slots})
+        # Step 3: The formatted slots were serialized when the board was built.
+        return cached_entry.slots_response.to_response(flask_request)
 
     except Exception as e:
         logger.error(f"Error in get_board_slots: {e}", exc_info=True)
@@ -943,21 +2068,84 @@ def get_board_slots():
 
 @app.route('/api/plinko_drop_batch', methods=['POST'])
 def plinko_drop_batch():
-    return jsonify({"error": "This feature is currently disabled."}), 403
-
-def select_gift_for_range(min_val, max_val, gift_list, seeded_random_gen):
     """
-    Selects a gift for a price range using a seeded random generator for consistency.
+    Runs `count` drops on the cached board in one request: one balance debit for the whole
+    batch, all outcomes drawn up front, bulk inserts for the inventory and drop rows and a
+    single commit. Returns the per-drop results in order for the frontend animation.
     """
-    eligible_gifts = [g for g in gift_list if min_val <= g.get('value', 0) <= max_val]
-    
-    if not eligible_gifts:
-        # Fallback remains the same
-        mid_point = (min_val + max_val) / 2
-        return min(gift_list, key=lambda g: abs(g.get('value', 0) - mid_point))
-        
-    # Simply return the next random choice from the seeded generator
-    return seeded_random_gen.choice(eligible_gifts)
+    auth_data = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
+    if not auth_data: return jsonify({"error": "Authentication failed"}), 401
+
+    user_id = auth_data['id']
+    data = flask_request.get_json() or {}
+    bet_mode = data.get('betMode')
+    seed = data.get('seed')
+    try:
+        count = int(data.get('count', 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid drop count"}), 400
+
+    if not seed:
+        return jsonify({"error": "Missing board seed for drop"}), 400
+    if bet_mode not in BET_MODES_CONFIG:
+        return jsonify({"error": "Invalid bet mode"}), 400
+    if not 1 <= count <= MAX_BATCH_DROPS:
+        return jsonify({"error": f"Drop count must be between 1 and {MAX_BATCH_DROPS}"}), 400
+
+    prepared_board = board_store.get(bet_mode, seed)
+    if not prepared_board:
+        logger.warning(f"STRICT CACHE MISS for seed: {seed}. Rejecting batch drop.")
+        return jsonify({
+            "error": "Ваша игровая сессия истекла. Пожалуйста, сделайте бросок еще раз."
+        }), 400
+
+    bet_amount = BET_MODES_CONFIG[bet_mode]['bet_amount']
+
+    db = SessionLocal()
+    try:
+        new_balance_milli = debit_balance(db, user_id, to_milli_stars(bet_amount) * count)
+        if new_balance_milli is None:
+            return jsonify({"error": "Insufficient balance"}), 400
+
+        outcome_categories = draw_outcome_categories(count)
+        draws = [prepared_board.draw(category) for category in outcome_categories]
+
+        inventory_ids = db.execute(
+            insert(UserGiftInventory).returning(UserGiftInventory.id, sort_by_parameter_order=True),
+            [{
+                "user_id": user_id,
+                "gift_id": str(gift.get('id', 'N/A')),
+                "gift_name": gift.get('name'),
+                "value_at_win": float(gift.get('value')),
+                "imageUrl": gift.get('imageUrl')
+            } for gift, _ in draws]
+        ).scalars().all()
+        db.execute(insert(PlinkoDrop), [{
+            "user_id": user_id,
+            "bet_amount": float(bet_amount),
+            "risk_level": f"mode_{bet_mode}",
+            "multiplier_won": 0,
+            "winnings": 0
+        }] * count)
+        db.commit()
+
+        drops = [{
+            "final_slot_index": final_index,
+            "won_item": dict(gift, inventory_id=inventory_id)
+        } for (gift, final_index), inventory_id in zip(draws, inventory_ids)]
+
+        return jsonify({
+            "status": "success",
+            "new_balance": from_milli_stars(new_balance_milli),
+            "drops": drops
+        })
+
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error during Plinko batch drop for user {user_id}: {e}", exc_info=True)
+        return jsonify({"error": "An internal server error occurred"}), 500
+    finally:
+        db.close()
 
 @app.route('/api/initiate_ton_deposit', methods=['POST'])
 def initiate_ton_deposit():
@@ -973,19 +2161,57 @@ def initiate_ton_deposit():
     finally:
         db.close()
 
+def upsert_floor_prices(db, floors_in_stars):
+    """
+    Writes floor prices with a single INSERT ... ON CONFLICT (gift_name) DO UPDATE that only
+    touches rows whose price actually changed. Falls back to per-row merges on databases
+    without ON CONFLICT. Returns the number of rows inserted or updated.
+    """
+    if not floors_in_stars:
+        return 0
+    rows = [{"gift_name": name, "price_in_stars": price} for name, price in floors_in_stars.items()]
+    dialect_name = db.get_bind().dialect.name
+    if dialect_name not in ('postgresql', 'sqlite'):
+        written = 0
+        existing = dict(db.query(GiftFloorPrice.gift_name, GiftFloorPrice.price_in_stars).all())
+        for row in rows:
+            if existing.get(row["gift_name"]) != row["price_in_stars"]:
+                db.merge(GiftFloorPrice(**row))
+                written += 1
+        return written
+
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    insert_stmt = dialect_insert(GiftFloorPrice).values(rows)
+    upsert_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=[GiftFloorPrice.gift_name],
+        set_={"price_in_stars": insert_stmt.excluded.price_in_stars, "last_updated": func.now()},
+        where=GiftFloorPrice.price_in_stars.is_distinct_from(insert_stmt.excluded.price_in_stars)
+    ).returning(GiftFloorPrice.gift_name)
+    return len(db.execute(upsert_stmt).all())
+
+def fetch_portals_floors():
+    """Floor prices in TON by gift name. portalsmp pulls in pyrogram, so it is only imported when prices are synced."""
+    from portalsmp import giftsFloors
+    return giftsFloors(authData=PORTALS_AUTH_TOKEN)
+
 def update_floor_prices_in_db():
     """
     Fetches latest floor prices from the Portals API and updates the database.
     This function is intended to be run by a scheduler.
     """
     logger.info("Scheduler starting job: update_floor_prices_in_db")
+    job_started = time.perf_counter()
     db = SessionLocal()
     try:
         if not PORTALS_AUTH_TOKEN:
             logger.warning("PORTALS_AUTH_TOKEN not set. Skipping floor price update.")
             return
 
-        all_floors_ton = giftsFloors(authData=PORTALS_AUTH_TOKEN)
+        all_floors_ton = fetch_portals_floors()
+        fetch_seconds = time.perf_counter() - job_started
         if not all_floors_ton:
             logger.error("Failed to retrieve data from Portals API during scheduled update.")
             return
@@ -995,16 +2221,19 @@ def update_floor_prices_in_db():
             for name, price in all_floors_ton.items()
         }
 
-        # "Upsert" logic: Update existing records or insert new ones
-        for name, price in floors_in_stars.items():
-            record = db.query(GiftFloorPrice).filter_by(gift_name=name).first()
-            if record:
-                record.price_in_stars = price  # Update
-            else:
-                db.add(GiftFloorPrice(gift_name=name, price_in_stars=price))  # Insert
-        
+        db_started = time.perf_counter()
+        rows_written = upsert_floor_prices(db, floors_in_stars)
         db.commit()
-        logger.info(f"Successfully updated/inserted {len(floors_in_stars)} gift floor prices in the database.")
+        db_seconds = time.perf_counter() - db_started
+
+        logger.info(
+            f"Floor price sync: {len(floors_in_stars)} prices fetched, {rows_written} inserted/updated, "
+            f"{len(floors_in_stars) - rows_written} unchanged. Portals {fetch_seconds:.3f}s, "
+            f"DB {db_seconds * 1000:.1f}ms, total {time.perf_counter() - job_started:.3f}s."
+        )
+        if rows_written:
+            catalog = refresh_gift_catalog(force=True)
+            logger.info(f"Gift catalog is now at version {catalog.version}.")
 
     except Exception as e:
         logger.error(f"An error occurred during scheduled floor price update: {e}", exc_info=True)
@@ -1012,8 +2241,218 @@ def update_floor_prices_in_db():
     finally:
         db.close()
 
+DEPOSIT_COMMENT_PATTERN = re.compile(r"plnko_[0-9a-f]{8}")
+
+def decode_deposit_comment(tx):
+    """Returns the deposit comment carried by an incoming transaction, or None."""
+    if not tx.in_msg or not tx.in_msg.body:
+        return None
+    try:
+        cmt_slice = tx.in_msg.body.begin_parse()
+        if cmt_slice.remaining_bits >= 32 and cmt_slice.load_uint(32) == 0:
+            return cmt_slice.load_snake_string()
+        # Not a plain text comment: look for our comment format anywhere in the raw body
+        match = DEPOSIT_COMMENT_PATTERN.search(tx.in_msg.body.to_boc().decode('utf-8', 'ignore'))
+        return match.group(0) if match else None
+    except Exception:
+        return None
+
+class TonDepositWatcher:
+    """
+    Owns one long-lived lite-client, driven by a dedicated event-loop thread, and an index of
+    the deposit wallet's recent incoming transactions by comment. Each sync only fetches
+    transactions newer than the last seen logical time (lt), so checking a deposit is a
+    dict lookup plus, at most, the handful of transactions that arrived since the last sync.
+    A backlog larger than one sync can fetch is paged backwards from the newest transaction;
+    last_lt only advances once the pages reach it, until then the sync resumes from the
+    oldest transaction fetched so far.
+    client_factory must return an object with async start_up(), get_transactions() and
+    close_all() (a pytoniq LiteBalancer, or a fake in tests).
+    """
+    def __init__(self, address, client_factory, remembered=TON_REMEMBERED_TRANSACTIONS):
+        self.address = address
+        self.client_factory = client_factory
+        self.remembered = remembered
+        self.last_lt = 0  # every transaction up to this lt is indexed
+        self.catch_up = None  # (newest lt, from_lt, from_hash) while a backlog is being paged
+        self.transactions_by_comment = OrderedDict()  # comment -> {"lt": ..., "value_nanoton": ...}
+        self._client = None
+        self._loop = None
+        self._sync_lock = threading.Lock()
+
+    def _run(self, coro):
+        import asyncio  # only processes that sync deposits pay for it
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name="ton-lite-client", daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout=TON_CALL_TIMEOUT_SECONDS)
+
+    async def _fetch_transactions(self, count, to_lt, from_lt=None, from_hash=None):
+        if self._client is None:
+            client = self.client_factory()
+            await client.start_up()
+            self._client = client
+        return await self._client.get_transactions(self.address, count=count, from_lt=from_lt, from_hash=from_hash, to_lt=to_lt)
+
+    async def _close_client(self):
+        client, self._client = self._client, None
+        if client:
+            await client.close_all()
+
+    def _fetch_page(self, count, from_lt, from_hash):
+        try:
+            with timed_call(TON_CALL_SECONDS, TON_CALLS, call="get_transactions"):
+                return self._run(self._fetch_transactions(count, self.last_lt, from_lt, from_hash))
+        except Exception:
+            # Drop the (possibly broken) connection; the next sync reconnects
+            try:
+                self._run(self._close_client())
+            except Exception as close_error:
+                logger.warning(f"Error closing TON lite-client: {close_error}")
+            raise
+
+    def _index(self, txs):
+        # Transactions come newest first
+        for tx in reversed(txs):
+            comment = decode_deposit_comment(tx)
+            value_nanoton = getattr(tx.in_msg.info, 'value_coins', None) if tx.in_msg else None
+            if comment and value_nanoton:
+                self.transactions_by_comment[comment] = {"lt": tx.lt, "value_nanoton": value_nanoton}
+        while len(self.transactions_by_comment) > self.remembered:
+            self.transactions_by_comment.popitem(last=False)
+
+    def sync(self):
+        """Indexes transactions newer than last_lt, page by page. Returns how many were fetched."""
+        with self._sync_lock:
+            if not self.last_lt:
+                # First sync of a wallet with no saved cursor: only look back a bounded distance
+                txs = self._fetch_page(TON_INITIAL_SCAN_TRANSACTIONS, None, None)
+                self._index(txs)
+                self.last_lt = txs[0].lt if txs else 0
+                return len(txs)
+
+            newest_lt, from_lt, from_hash = self.catch_up or (None, None, None)
+            fetched = 0
+            for _ in range(TON_SYNC_MAX_PAGES):
+                txs = self._fetch_page(TON_SYNC_PAGE_TRANSACTIONS, from_lt, from_hash)
+                self._index(txs)
+                fetched += len(txs)
+                if txs and newest_lt is None:
+                    newest_lt = txs[0].lt
+                oldest = txs[-1] if txs else None
+                if oldest is None or len(txs) < TON_SYNC_PAGE_TRANSACTIONS or oldest.prev_trans_lt <= self.last_lt:
+                    # Reached last_lt: everything up to newest_lt is indexed now
+                    self.last_lt = max(self.last_lt, newest_lt or 0)
+                    self.catch_up = None
+                    return fetched
+                from_lt, from_hash = oldest.prev_trans_lt, oldest.prev_trans_hash
+            self.catch_up = (newest_lt, from_lt, from_hash)
+            logger.warning(
+                f"TON deposit sync fetched {fetched} transactions without reaching lt {self.last_lt}; "
+                f"the next sync resumes from lt {from_lt}."
+            )
+            return fetched
+
+    def find(self, comment, refresh=True):
+        """Returns the indexed transaction for a deposit comment, syncing first unless refresh is False."""
+        if refresh:
+            self.sync()
+        return self.transactions_by_comment.get(comment)
+
+    def close(self):
+        if self._loop is not None:
+            self._run(self._close_client())
+
+def create_ton_lite_client():
+    from pytoniq import LiteBalancer  # only the deposit watcher needs it
+    return LiteBalancer.from_mainnet_config(trust_level=2)
+
+ton_deposit_watcher = TonDepositWatcher(DEPOSIT_WALLET_ADDRESS, create_ton_lite_client)
+
+def load_ton_sync_cursor(address):
+    """The last_lt persisted by process_ton_deposits, or 0 if the wallet was never synced."""
+    db = SessionLocal()
+    try:
+        return db.query(TonSyncCursor.last_lt).filter(TonSyncCursor.address == address).scalar() or 0
+    finally:
+        db.close()
+
+def save_ton_sync_cursor(db, address, last_lt):
+    cursor = db.query(TonSyncCursor).filter(TonSyncCursor.address == address).with_for_update().first()
+    if cursor:
+        cursor.last_lt = max(cursor.last_lt, last_lt)
+    else:
+        db.add(TonSyncCursor(address=address, last_lt=last_lt))
+
+def process_ton_deposits():
+    """
+    Scheduler job: pulls new wallet transactions, credits every pending TON deposit whose
+    comment showed up (in one transaction, with one query for all open deposits) and marks
+    the remaining overdue ones as expired in bulk. Deposits land even if the user closed the app.
+
+    The watcher's last_lt is saved in the same transaction as the credits. A restarted process, or
+    a new scheduler leader, pages back to it instead of only scanning the newest transactions, and
+    nothing expires until the transactions since then have all been matched.
+    """
+    if not DEPOSIT_WALLET_ADDRESS:
+        return
+    caught_up = False
+    try:
+        if not ton_deposit_watcher.last_lt:
+            ton_deposit_watcher.last_lt = load_ton_sync_cursor(DEPOSIT_WALLET_ADDRESS)
+        ton_deposit_watcher.sync()
+        caught_up = ton_deposit_watcher.catch_up is None
+    except Exception as e:
+        # Still credit what is indexed below; expiry waits until a sync gets through
+        logger.error(f"TON deposit watcher could not sync wallet transactions: {e}")
+
+    now = dt.now(timezone.utc)
+    db = SessionLocal()
+    try:
+        open_deposits = db.query(Deposit.id, Deposit.user_id, Deposit.unique_comment).filter(
+            Deposit.status == 'pending', Deposit.deposit_type == 'TON'
+        ).all()
+
+        credited = 0
+        for deposit_id, user_id, comment in open_deposits:
+            tx = ton_deposit_watcher.transactions_by_comment.get(comment)
+            if not tx:
+                continue
+            stars_credited = Decimal(tx['value_nanoton']) / Decimal('1e9') * Decimal(str(TON_TO_STARS_RATE))
+            # Conditional on still being pending, so a deposit can only ever be credited once
+            claimed = db.execute(
+                update(Deposit)
+                .where(Deposit.id == deposit_id, Deposit.status == 'pending')
+                .values(status='completed', amount=float(stars_credited))
+                .returning(Deposit.id)
+                .execution_options(synchronize_session=False)
+            ).scalar_one_or_none()
+            if claimed:
+                credit_balance(db, user_id, to_milli_stars(stars_credited))
+                credited += 1
+
+        expired = 0
+        if caught_up:
+            expired = db.execute(
+                update(Deposit)
+                .where(Deposit.status == 'pending', Deposit.expires_at < now)
+                .values(status='expired')
+                .execution_options(synchronize_session=False)
+            ).rowcount
+        if ton_deposit_watcher.last_lt:
+            save_ton_sync_cursor(db, DEPOSIT_WALLET_ADDRESS, ton_deposit_watcher.last_lt)
+        db.commit()
+        if credited or expired:
+            logger.info(f"TON deposit watcher: {credited} deposit(s) credited, {expired} expired.")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error processing TON deposits: {e}", exc_info=True)
+    finally:
+        db.close()
+
 @app.route('/api/verify_ton_deposit', methods=['POST'])
 def verify_ton_deposit():
+    """Reports the status of a TON deposit. Crediting is done by the process_ton_deposits job."""
     auth_data = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth_data: return jsonify({"error": "Auth failed"}), 401
     
@@ -1023,55 +2462,21 @@ def verify_ton_deposit():
     db = SessionLocal()
     
     try:
-        pdep = db.query(Deposit).filter(Deposit.user_id == user_id, Deposit.unique_comment == comment, Deposit.status == 'pending').first()
-        if not pdep: return jsonify({"status": "not_found", "message": "Deposit request not found or already processed."})
-        if pdep.expires_at < dt.now(timezone.utc):
-            pdep.status = 'expired'; db.commit(); return jsonify({"status": "expired", "message": "Deposit request has expired."})
-        
-        loop = asyncio.new_event_loop(); asyncio.set_event_loop(loop)
-        tx = loop.run_until_complete(check_blockchain_for_tx(comment)); loop.close()
-        
-        if tx:
-            amount_in_ton = Decimal(tx.in_msg.info.value_coins) / Decimal('1e9')
-            stars_credited = amount_in_ton * Decimal(str(TON_TO_STARS_RATE))
-
-            user = db.query(User).filter(User.telegram_id == user_id).first()
-            user.balance = float(Decimal(str(user.balance)) + stars_credited)
-            
-            pdep.status = 'completed'
-            pdep.amount = float(stars_credited) # Store credited Stars amount
-            db.commit()
-            
-            message_to_user = f"Успешно зачислено {float(stars_credited):.2f} Stars (из {float(amount_in_ton):.4f} TON)!"
-            return jsonify({"status": "success", "message": message_to_user, "new_balance": user.balance})
-        else:
-            return jsonify({"status": "pending", "message": "Транзакция пока не найдена. Подождите немного и попробуйте снова."})
-
+        deposit = db.query(Deposit.status, Deposit.amount).filter(Deposit.user_id == user_id, Deposit.unique_comment == comment).first()
+        if not deposit:
+            return jsonify({"status": "not_found", "message": "Deposit request not found or already processed."})
+        if deposit.status == 'completed':
+            balance_milli = db.query(User.balance_milli).filter(User.telegram_id == user_id).scalar()
+            message_to_user = f"Успешно зачислено {deposit.amount:.2f} Stars!"
+            return jsonify({"status": "success", "message": message_to_user, "new_balance": from_milli_stars(balance_milli or 0)})
+        if deposit.status == 'expired':
+            return jsonify({"status": "expired", "message": "Deposit request has expired."})
+        return jsonify({"status": "pending", "message": "Транзакция пока не найдена. Подождите немного и попробуйте снова."})
     except Exception as e:
         logger.error(f"Error during deposit verification: {e}")
-        if db.is_active: db.rollback()
         return jsonify({"status": "error", "message": "Произошла непредвиденная ошибка во время проверки."}), 500
     finally:
-        if db.is_active: db.close()
-
-async def check_blockchain_for_tx(comment):
-    provider = None
-    try:
-        provider = LiteBalancer.from_mainnet_config(trust_level=2)
-        await provider.start_up()
-        txs = await provider.get_transactions(DEPOSIT_WALLET_ADDRESS, count=200)
-        for tx in txs:
-            if tx.in_msg and tx.in_msg.body:
-                try:
-                    tx_comment_body = tx.in_msg.body.to_boc().decode('utf-8', 'ignore')
-                    if comment in tx_comment_body: return tx
-                    cmt_slice = tx.in_msg.body.begin_parse()
-                    if cmt_slice.remaining_bits >= 32 and cmt_slice.load_uint(32) == 0:
-                        if cmt_slice.load_snake_string() == comment: return tx
-                except: continue
-        return None
-    finally:
-        if provider: await provider.close_all()
+        db.close()
 
 @app.route('/api/create_stars_invoice', methods=['POST'])
 def create_stars_invoice():
@@ -1106,40 +2511,477 @@ def initial_populate_prices():
             # This can happen if the database/table doesn't exist yet.
             logger.error(f"Error during initial price population check (might be normal on first run): {e}")
 
-def setup_telegram_webhook(flask_app):
+UPDATE_CHAT_MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+UPDATE_USER_FIELDS = ('callback_query', 'inline_query', 'chosen_inline_result', 'shipping_query',
+                      'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request')
+
+def update_route(update):
+    """Returns (kind, chat_id) of a Telegram update; chat_id falls back to the sender, then to the update itself."""
+    for field in UPDATE_CHAT_MESSAGE_FIELDS:
+        message = getattr(update, field, None)
+        if message is not None:
+            return field, message.chat.id
+    for field in UPDATE_USER_FIELDS:
+        item = getattr(update, field, None)
+        if item is not None:
+            from_user = getattr(item, 'from_user', None)
+            return field, from_user.id if from_user else update.update_id
+    return 'other', update.update_id
+
+class UpdateDispatcher:
+    """
+    Hands webhook updates to a pool of worker threads so the webhook can answer Telegram right away.
+    Each chat is pinned to one worker, which keeps its updates in order. Workers drain their queue in batches
+    of up to batch_size updates. Redelivered update_ids are dropped. At most max_pending updates are queued.
+    """
+    def __init__(self, process_updates, workers, max_pending, batch_size, dedupe_size):
+        self._process_updates = process_updates
+        self._queues = [queue.Queue() for _ in range(max(workers, 1))]
+        self._max_pending = max_pending
+        self._batch_size = batch_size
+        self._dedupe_size = dedupe_size
+        self._seen_update_ids = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        self.pending = 0
+        self.processed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.failed = 0
+        self.latency_total_seconds = 0.0
+        self.latency_max_seconds = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index, worker_queue in enumerate(self._queues):
+                thread = threading.Thread(target=self._run, args=(worker_queue,), name=f"webhook-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, update):
+        """Queues an update. Returns False if the queue is full and the update should be redelivered later."""
+        with self._lock:
+            if update.update_id in self._seen_update_ids:
+                self.duplicates += 1
+                return True
+            if self.pending >= self._max_pending:
+                self.rejected += 1
+                return False
+            self._seen_update_ids[update.update_id] = None
+            if len(self._seen_update_ids) > self._dedupe_size:
+                self._seen_update_ids.popitem(last=False)
+            self.pending += 1
+        kind, chat_id = update_route(update)
+        self._queues[hash(chat_id) % len(self._queues)].put((kind, update, time.monotonic()))
+        return True
+
+    def _run(self, worker_queue):
+        while True:
+            items = [worker_queue.get()]
+            while len(items) < self._batch_size:
+                try:
+                    items.append(worker_queue.get_nowait())
+                except queue.Empty:
+                    break
+            # telebot groups a batch by update type, so only consecutive updates of one kind are batched together.
+            run = []
+            for item in items:
+                if run and run[0][0] != item[0]:
+                    self._process_run(run)
+                    run = []
+                run.append(item)
+            self._process_run(run)
+
+    def _process_run(self, run):
+        try:
+            self._process_updates([update for _, update, _ in run])
+        except Exception as e:
+            logger.error(f"Error processing {len(run)} webhook update(s): {e}", exc_info=True)
+            with self._lock:
+                self.failed += len(run)
+        finished_at = time.monotonic()
+        with self._lock:
+            self.pending -= len(run)
+            self.processed += len(run)
+            for _, _, queued_at in run:
+                latency = finished_at - queued_at
+                self.latency_total_seconds += latency
+                self.latency_max_seconds = max(self.latency_max_seconds, latency)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self.pending,
+                "queue_depths": [worker_queue.qsize() for worker_queue in self._queues],
+                "processed": self.processed,
+                "duplicates": self.duplicates,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "latency_avg_seconds": self.latency_total_seconds / self.processed if self.processed else 0.0,
+                "latency_max_seconds": self.latency_max_seconds,
+            }
+
+update_dispatcher = UpdateDispatcher(bot.process_new_updates if bot else None, WEBHOOK_WORKERS,
+                                     WEBHOOK_QUEUE_MAX_UPDATES, WEBHOOK_BATCH_SIZE, WEBHOOK_DEDUPE_UPDATES)
+
+@app.route('/api/webhook_stats', methods=['GET'])
+def webhook_stats_api():
+    """Queue depth and processing latency of incoming Telegram updates in this worker."""
+    received_key = flask_request.headers.get('X-API-Key')
+    if not GIFT_DEPOSIT_API_KEY or received_key != GIFT_DEPOSIT_API_KEY:
+        raise Unauthorized("Invalid API Key")
+    return jsonify(update_dispatcher.stats())
+
+def webhook_handler():
+    if flask_request.headers.get('content-type') == 'application/json':
+        json_string = flask_request.get_data().decode('utf-8')
+        update = telebot.types.Update.de_json(json_string)
+        if not update_dispatcher.submit(update):
+            logger.warning("Webhook update queue is full, asking Telegram to redeliver.")
+            return '', 503
+        return '', 200
+    flask_abort(403)
+
+# Registered at import (cheap, no threads) so every way of serving `app` has the route; the web role starts the workers
+if bot:
+    app.add_url_rule(f'/{BOT_TOKEN}', 'webhook_handler', webhook_handler, methods=['POST'])
+
+def set_telegram_webhook():
+    """Points Telegram at this deployment. One call per deploy is enough, not one per worker."""
     if not bot: return
-    WEBHOOK_PATH = f'/{BOT_TOKEN}'
-    FULL_WEBHOOK_URL = f"{RENDER_EXTERNAL_URL}{WEBHOOK_PATH}"
-    @flask_app.route(WEBHOOK_PATH, methods=['POST'])
-    def webhook_handler():
-        if flask_request.headers.get('content-type') == 'application/json':
-            json_string = flask_request.get_data().decode('utf-8')
-            update = telebot.types.Update.de_json(json_string)
-            bot.process_new_updates([update])
-            return '', 200
-        flask_abort(403)
+    FULL_WEBHOOK_URL = f"{RENDER_EXTERNAL_URL}/{BOT_TOKEN}"
     try:
         bot.remove_webhook(); bot.set_webhook(url=FULL_WEBHOOK_URL)
         logger.info(f"Webhook set to {FULL_WEBHOOK_URL}")
     except Exception as e:
         logger.error(f"Error setting webhook: {e}")
 
-scheduler = BackgroundScheduler(timezone=pytz.timezone('Europe/Moscow')) 
-scheduler.add_job(
-    func=update_floor_prices_in_db,
-    trigger=CronTrigger(hour=23, minute=8), # Runs daily at 23:00 (11 PM)
-    id='update_floor_prices_job',
-    name='Update gift floor prices from Portals API',
-    replace_existing=True
-)
-scheduler.start()
-logger.info("APScheduler started. Price update job is scheduled for 23:00 UTC+3.")
+def cache_stats_samples(stat):
+    caches = {"board": board_store.stats, "init_data": init_data_cache.stats}
+    if bot:
+        caches["subscription"] = subscription_cache.stats
+    return [({"cache": name}, stats()[stat]) for name, stats in caches.items()]
+
+for cache_stat, cache_stat_type in (("entries", "gauge"), ("bytes", "gauge"), ("hits", "counter"), ("misses", "counter"),
+                                    ("evictions", "counter"), ("expirations", "counter")):
+    metrics.callback(
+        f"plinko_cache_{cache_stat}" + ("_total" if cache_stat_type == "counter" else ""),
+        f"Cache {cache_stat} (board store, initData and subscription caches of this worker).",
+        functools.partial(cache_stats_samples, cache_stat), cache_stat_type,
+    )
+metrics.callback("plinko_gift_catalog_version", "Version of the loaded gift catalog snapshot.",
+                 lambda: [({}, gift_catalog.version)] if gift_catalog else [])
+metrics.callback("plinko_gift_catalog_gifts", "Gifts in the loaded gift catalog snapshot.",
+                 lambda: [({}, len(gift_catalog))] if gift_catalog else [])
+metrics.callback("plinko_gift_catalog_age_seconds", "Seconds since the gift catalog was last checked against the DB.",
+                 lambda: [({}, time.monotonic() - gift_catalog.checked_at)] if gift_catalog else [])
+metrics.callback("plinko_webhook_updates_pending", "Telegram updates queued or being processed.",
+                 lambda: [({}, update_dispatcher.stats()["pending"])])
+metrics.callback("plinko_outbound_messages_pending", "Bot messages waiting to be sent.",
+                 lambda: [({}, outbound.stats()["pending"])] if outbound else [])
+metrics.callback("plinko_scheduler_leader", "1 if this process is the elected scheduler leader (scheduler role only).",
+                 lambda: [({}, int(scheduler_leader.is_leader))] if scheduler else [])
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics of this worker."""
+    received_key = flask_request.headers.get('X-API-Key')
+    if not GIFT_DEPOSIT_API_KEY or received_key != GIFT_DEPOSIT_API_KEY:
+        raise Unauthorized("Invalid API Key")
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+SQLITE_LEASE_CLOCK_FORMAT = '%Y-%m-%d %H:%M:%f'  # how SQLAlchemy stores DateTime on SQLite, to millisecond precision
 
-initial_populate_prices()
+def database_clock(dialect_name, offset_seconds=0):
+    """The database's current time plus offset_seconds, as SQL: every node then reads lease deadlines off one clock."""
+    if dialect_name == 'sqlite':
+        return func.strftime(SQLITE_LEASE_CLOCK_FORMAT, 'now', f'{offset_seconds:+g} seconds')
+    return func.now() + timedelta(seconds=offset_seconds) if offset_seconds else func.now()
 
-if BOT_TOKEN:
-    setup_telegram_webhook(app)
+class SchedulerLeader:
+    """
+    Elects one process, across all workers and nodes, to run the scheduled jobs.
+
+    On Postgres the leader holds the session advisory lock SCHEDULER_LOCK_KEY on a dedicated
+    connection and checks that connection every renew_seconds; if the process dies or the
+    connection drops, Postgres releases the lock and the next follower to retry takes over.
+    Other databases use a lease row in plinko_scheduler_leases that the leader renews; a
+    follower takes over once the lease has not been renewed for lease_seconds. Lease deadlines
+    are set and compared with the database's clock, so skew between nodes does not matter.
+
+    Leadership is only trusted for lease_seconds after the last successful renewal, so a
+    leader that loses its database stops starting jobs before anyone else can start them.
+    """
+    def __init__(self, engine, name='scheduler', lock_key=SCHEDULER_LOCK_KEY,
+                 lease_seconds=SCHEDULER_LEASE_SECONDS, renew_seconds=SCHEDULER_RENEW_SECONDS):
+        self.engine = engine
+        self.name = name
+        self.lock_key = lock_key
+        self.lease_seconds = lease_seconds
+        self.renew_seconds = renew_seconds
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.use_advisory_lock = engine.dialect.name == 'postgresql'
+        self._lock_connection = None
+        self._valid_until = 0.0  # monotonic deadline of the current leadership, 0 when following
+        self._stopped = threading.Event()
+        self._thread = None
+        self.elections_won = 0
+
+    @property
+    def is_leader(self):
+        return time.monotonic() < self._valid_until
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="scheduler-leader-election", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops campaigning and hands leadership over right away instead of after the lease runs out."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.renew_seconds)
+        self._step_down()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            was_leader = self.is_leader
+            started = time.monotonic()
+            try:
+                held = self._renew() if was_leader else self._acquire()
+            except Exception as e:
+                logger.error(f"Scheduler leader election failed ({'renewing' if was_leader else 'acquiring'}): {e}")
+                held = False
+            if held:
+                self._valid_until = started + self.lease_seconds
+                if not was_leader:
+                    self.elections_won += 1
+                    logger.info(f"{self.holder} is now the scheduler leader.")
+            elif was_leader:
+                logger.warning(f"{self.holder} lost scheduler leadership.")
+                self._step_down()
+            self._stopped.wait(self.renew_seconds)
+
+    def _acquire(self):
+        if self.use_advisory_lock:
+            connection = self.engine.raw_connection()
+            connection.detach()  # Holds the lock for as long as this process leads, outside the pool
+            try:
+                dbapi_connection = connection.driver_connection
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_try_advisory_lock(%s)", (self.lock_key,))
+                    acquired = cursor.fetchone()[0]
+            except Exception:
+                connection.close()
+                raise
+            if not acquired:
+                connection.close()
+                return False
+            self._lock_connection = connection
+            return True
+
+        now = database_clock(self.engine.dialect.name)
+        expires_at = database_clock(self.engine.dialect.name, self.lease_seconds)
+        with self.engine.begin() as conn:
+            taken_over = conn.execute(
+                update(SchedulerLease)
+                .where(SchedulerLease.name == self.name, or_(SchedulerLease.holder == self.holder, SchedulerLease.expires_at <= now))
+                .values(holder=self.holder, expires_at=expires_at)
+            ).rowcount
+            if taken_over:
+                return True
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(insert(SchedulerLease).values(name=self.name, holder=self.holder, expires_at=expires_at))
+            return True
+        except IntegrityError:
+            return False  # Someone else holds a live lease
+
+    def _renew(self):
+        if self.use_advisory_lock:
+            # The lock lives exactly as long as the session; a working connection means it is still ours
+            with self._lock_connection.driver_connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        with self.engine.begin() as conn:
+            return conn.execute(
+                update(SchedulerLease)
+                .where(SchedulerLease.name == self.name, SchedulerLease.holder == self.holder)
+                .values(expires_at=database_clock(self.engine.dialect.name, self.lease_seconds))
+            ).rowcount == 1
+
+    def _step_down(self):
+        self._valid_until = 0.0
+        try:
+            if self._lock_connection is not None:
+                connection, self._lock_connection = self._lock_connection, None
+                connection.close()  # Ends the session, which releases the advisory lock
+            elif not self.use_advisory_lock:
+                with self.engine.begin() as conn:
+                    conn.execute(delete(SchedulerLease).where(SchedulerLease.name == self.name, SchedulerLease.holder == self.holder))
+        except Exception as e:
+            logger.warning(f"Error releasing scheduler leadership: {e}")
+
+scheduler_leader = SchedulerLeader(engine)
+
+def leader_only(job_name, func):
+    """Wraps a scheduled job so it only runs in the elected leader; every other process skips it."""
+    @functools.wraps(func)
+    def run_if_leader():
+        if not scheduler_leader.is_leader:
+            JOB_RUNS.inc(job=job_name, status="skipped")
+            return None
+        return func()
+    return run_if_leader
+
+def create_scheduler():
+    """
+    The background jobs. APScheduler is only imported by processes with the scheduler role.
+    Every such process schedules them, but only the elected leader runs them: wrap new jobs in leader_only().
+    """
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.triggers.cron import CronTrigger
+    import pytz
+
+    scheduler = BackgroundScheduler(timezone=pytz.timezone('Europe/Moscow'))
+    scheduler.add_job(
+        func=leader_only('update_floor_prices', timed_job('update_floor_prices', update_floor_prices_in_db)),
+        trigger=CronTrigger(hour=23, minute=8), # Runs daily at 23:00 (11 PM)
+        id='update_floor_prices_job',
+        name='Update gift floor prices from Portals API',
+        replace_existing=True
+    )
+    scheduler.add_job(
+        func=leader_only('sweep_board_cache', timed_job('sweep_board_cache', board_store.sweep)),
+        trigger='interval',
+        seconds=BOARD_CACHE_SWEEP_SECONDS,
+        id='sweep_board_cache_job',
+        name='Evict expired boards from the board cache',
+        replace_existing=True
+    )
+    scheduler.add_job(
+        func=leader_only('process_ton_deposits', timed_job('process_ton_deposits', process_ton_deposits)),
+        trigger='interval',
+        seconds=TON_DEPOSIT_WATCH_SECONDS,
+        id='process_ton_deposits_job',
+        name='Credit incoming TON deposits and expire stale ones',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+    return scheduler
+
+scheduler = None
+started_roles = set()
+startup_lock = threading.Lock()
+
+def run_setup(migrate=os.environ.get("RUN_MIGRATIONS_ON_STARTUP") == "1"):
+    """One-time setup of a deploy: migrations (opt-in), the initial price list and the Telegram webhook."""
+    if migrate:
+        run_migrations(engine)
+    initial_populate_prices()
+    set_telegram_webhook()
+
+def sweep_local_board_cache_forever():
+    """Every worker sweeps its own in-process boards; the scheduler's job also clears the shared table."""
+    while True:
+        time.sleep(BOARD_CACHE_SWEEP_SECONDS)
+        try:
+            board_store.sweep_local()
+        except Exception as e:
+            logger.error(f"Error sweeping the local board cache: {e}")
+
+def start_scheduler():
+    global scheduler
+    scheduler_leader.start()
+    scheduler = create_scheduler()
+    scheduler.start()
+    logger.info("APScheduler started. Price update job is scheduled for 23:00 UTC+3.")
+
+def create_app(roles=None):
+    """
+    Does the startup work of `roles` (default: the APP_ROLES env var) once per process and returns the app.
+    Importing app.py does none of it, so it stays cheap for every gunicorn worker.
+
+      web        serves the Telegram webhook, starts the update workers and sweeps this worker's boards
+      scheduler  runs the background jobs
+      setup      one-time setup, see run_setup()
+
+        gunicorn "app:create_app()"                         # APP_ROLES=web for web workers
+        APP_ROLES=scheduler,setup python app.py scheduler   # or one process that does the rest
+
+    `gunicorn app:app` still serves the web role: start_app_roles() starts it on a worker's first request.
+    """
+    if roles is None:
+        roles = APP_ROLES.split(',')
+    roles = {role.strip() for role in roles if role.strip()}
+    unknown = roles - set(STARTUP_ROLES)
+    if unknown:
+        raise ValueError(f"Unknown app roles: {', '.join(sorted(unknown))}")
+    with startup_lock:
+        for role in STARTUP_ROLES:
+            if role not in roles or role in started_roles:
+                continue
+            if role != 'setup' and not started_roles - {'setup'}:
+                ensure_schema_is_current(engine)  # before the first role that serves or writes data
+            if role == 'setup':
+                run_setup()
+            elif role == 'scheduler':
+                start_scheduler()
+            elif role == 'web':
+                update_dispatcher.start()
+                threading.Thread(target=sweep_local_board_cache_forever, name="board-cache-sweeper", daemon=True).start()
+            started_roles.add(role)
+            logger.info(f"Started app role '{role}'.")
+    return app
+
+@app.before_request
+def start_app_roles():
+    """
+    Servers that load `app` directly never call create_app(), so a worker starts the web role on its first request.
+    Only the web role: the scheduler and one-time setup never run inside a user's request. Until the role has
+    started (say the schema is behind the code) every request answers 503 and the next one tries again.
+    """
+    if 'web' in started_roles or app.testing:
+        return
+    try:
+        create_app(['web'])
+    except Exception as e:
+        logger.error(f"Web role failed to start, answering 503: {e}")
+        return jsonify({"error": "Service is starting up, try again shortly."}), 503
+
+@app.cli.command('setup')
+def setup_command():
+    """Apply migrations, populate the initial prices and set the Telegram webhook."""
+    run_setup(migrate=True)
+
+@app.cli.command('scheduler')
+def scheduler_command():
+    """Run the background jobs in the foreground."""
+    run_scheduler_forever()
+
+def run_scheduler_forever():
+    create_app(['scheduler'])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        scheduler.shutdown()
+        scheduler_leader.stop()
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['migrate']:
+        run_migrations(engine)
+        sys.exit(0)
+    if sys.argv[1:] == ['setup']:
+        run_setup(migrate=True)
+        sys.exit(0)
+    if sys.argv[1:] == ['scheduler']:
+        run_scheduler_forever()
+        sys.exit(0)
+    create_app()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
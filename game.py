@@ -0,0 +1,347 @@
+"""
+Plinko game rules: bet modes, gift lists, board generation and outcome selection.
+
+Pure functions and data only (no Flask, DB or Telegram), so the web app and offline
+tools such as rtp_simulator.py run exactly the same game logic.
+"""
+import bisect
+import random
+import time
+
+PLINKO_CONFIGS = {
+    'low': {
+        'rows': 8,
+        'multipliers': [4, 2, 1.2, 0.9, 0.7, 0.9, 1.2, 2, 4]
+    },
+    'medium': {
+        'rows': 12,
+        'multipliers': [18, 5, 2, 1.1, 0.8, 0.5, 0.3, 0.5, 0.8, 1.1, 2, 5, 18]
+    },
+    'high': {
+        'rows': 16,
+        'multipliers': [130, 25, 8, 2, 0.5, 0.2, 0.1, 0.1, 0, 0.1, 0.1, 0.2, 0.5, 2, 8, 25, 130]
+    }
+}
+
+BET_MODES_CONFIG = {
+    '200': {
+        'bet_amount': 200,
+        'rows': 8,
+        'slots': [
+            [600, 900], [350, 600], [200, 350], 'Ring', 'Bear', 'Ring', [200, 350], [350, 600], [600, 900]
+        ]
+    },
+    '1000': {
+        'bet_amount': 1000,
+        'rows': 8,
+        'slots': [
+            # --- UPDATED RANGES FOR 1000 STARS ---
+            [3000, 4000], [1500, 2000], [600, 1000], [400, 600], [200, 400], [400, 600], [600, 1000], [1500, 2000], [3000, 4000]
+        ]
+    },
+    '4000': {
+        'bet_amount': 4000,
+        'rows': 8,
+        'slots': [
+            # --- UPDATED RANGES FOR 4000 STARS ---
+            [7000, 20000], [4500, 7000], [3000, 4500], [1500, 3000], [1000, 1500], [1500, 3000], [3000, 4500], [4500, 7000], [7000, 20000]
+        ]
+    }
+}
+
+# Weights for the outcome category of a paid drop
+DROP_OUTCOMES = ['lose', 'breakeven', 'win']
+DROP_OUTCOME_WEIGHTS = [85, 18, 2]
+
+# Free try: the emoji gift won and its weight
+FREE_DROP_GIFTS = ['Bear', 'Ring']
+FREE_DROP_WEIGHTS = [95, 5]
+
+# Converting a won gift back to Stars pays its value plus this bonus
+CONVERSION_BONUS_MULTIPLIER = 1.20
+
+REGULAR_GIFTS = {
+    "5983471780763796287": {"name": "santahat", "filename": "santahat.png"},
+    "5936085638515261992": {"name": "signetring", "filename": "signetring.png"},
+    "5933671725160989227": {"name": "preciouspeach", "filename": "preciouspeach.png"},
+    "5936013938331222567": {"name": "plushpepe", "filename": "plushpepe.png"},
+    "5913442287462908725": {"name": "spicedwine", "filename": "spicedwine.png"},
+    "5915502858152706668": {"name": "jellybunny", "filename": "jellybunny.png"},
+    "5915521180483191380": {"name": "durov'scap", "filename": "durov'scap.png"},
+    "5913517067138499193": {"name": "perfumebottle", "filename": "perfumebottle.png"},
+    "5882125812596999035": {"name": "eternalrose", "filename": "eternalrose.png"},
+    "5882252952218894938": {"name": "berrybox", "filename": "berrybox.png"},
+    "5857140566201991735": {"name": "vintagecigar", "filename": "vintagecigar.png"},
+    "5846226946928673709": {"name": "magicpotion", "filename": "magicpotion.png"},
+    "5845776576658015084": {"name": "kissedfrog", "filename": "kissedfrog.png"},
+    "5825801628657124140": {"name": "hexpot", "filename": "hexpot.png"},
+    "5825480571261813595": {"name": "evileye", "filename": "evileye.png"},
+    "5841689550203650524": {"name": "sharptongue", "filename": "sharptongue.png"},
+    "5841391256135008713": {"name": "trappedheart", "filename": "trappedheart.png"},
+    "5839038009193792264": {"name": "skullflower", "filename": "skullflower.png"},
+    "5837059369300132790": {"name": "scaredcat", "filename": "scaredcat.png"},
+    "5821261908354794038": {"name": "spyagaric", "filename": "spyagaric.png"},
+    "5783075783622787539": {"name": "homemadecake", "filename": "homemadecake.png"},
+    "5933531623327795414": {"name": "genielamp", "filename": "genielamp.png"},
+    "6028426950047957932": {"name": "lunarsnake", "filename": "lunarsnake.png"},
+    "6003643167683903930": {"name": "partysparkler", "filename": "partysparkler.png"},
+    "5933590374185435592": {"name": "jesterhat", "filename": "jesterhat.png"},
+    "5821384757304362229": {"name": "witchhat", "filename": "witchhat.png"},
+    "5915733223018594841": {"name": "hangingstar", "filename": "hangingstar.png"},
+    "5915550639663874519": {"name": "lovecandle", "filename": "lovecandle.png"},
+    "6001538689543439169": {"name": "cookieheart", "filename": "cookieheart.png"},
+    "5782988952268964995": {"name": "deskcalendar", "filename": "deskcalendar.png"},
+    "6001473264306619020": {"name": "jinglebells", "filename": "jinglebells.png"},
+    "5980789805615678057": {"name": "snowmittens", "filename": "snowmittens.png"},
+    "5836780359634649414": {"name": "voodoodoll", "filename": "voodoodoll.png"},
+    "5841632504448025405": {"name": "madpumpkin", "filename": "madpumpkin.png"},
+    "5825895989088617224": {"name": "hypnolollipop", "filename": "Hynpo-Lollipop.png"},
+    "5782984811920491178": {"name": "b-daycandle", "filename": "b-daycandle.png"},
+    "5935936766358847989": {"name": "bunnymuffin", "filename": "bunnymuffin.png"},
+    "5933629604416717361": {"name": "astralshard", "filename": "astralshard.png"},
+    "5837063436634161765": {"name": "flyingbroom", "filename": "flyingbroom.png"},
+    "5841336413697606412": {"name": "crystalball", "filename": "crystalball.png"},
+    "5821205665758053411": {"name": "eternalcandle", "filename": "eternalcandle.png"},
+    "5936043693864651359": {"name": "swisswatch", "filename": "swisswatch.png"},
+    "5983484377902875708": {"name": "gingercookie", "filename": "gingercookie.png"},
+    "5879737836550226478": {"name": "minioscar", "filename": "minioscar.png"},
+    "5170594532177215681": {"name": "lolpop", "filename": "lolpop.png"},
+    "5843762284240831056": {"name": "iongem", "filename": "iongem.png"},
+    "5936017773737018241": {"name": "starnotepad", "filename": "starnotepad.png"},
+    "5868659926187901653": {"name": "lootbag", "filename": "lootbag.png"},
+    "5868348541058942091": {"name": "lovepotion", "filename": "lovepotion.png"},
+    "5868220813026526561": {"name": "toybear", "filename": "toybear.png"},
+    "5868503709637411929": {"name": "diamondring", "filename": "diamondring.png"},
+    "5167939598143193218": {"name": "sakuraflower", "filename": "sakuraflower.png"},
+    "5981026247860290310": {"name": "sleighbell", "filename": "sleighbell.png"},
+    "5897593557492957738": {"name": "tophat", "filename": "tophat.png"},
+    "5856973938650776169": {"name": "recordplayer", "filename": "recordplayer.png"},
+    "5983259145522906006": {"name": "winterwreath", "filename": "winterwreath.png"},
+    "5981132629905245483": {"name": "snowglobe", "filename": "snowglobe.png"},
+    "5846192273657692751": {"name": "electricskull", "filename": "electricskull.png"},
+    "6023752243218481939": {"name": "tamagadget", "filename": "tamagadget.png"},
+    "6003373314888696650": {"name": "candycane", "filename": "candycane.png"},
+    "5933793770951673155": {"name": "nekohelmet", "filename": "nekohelmet.png"},
+    "6005659564635063386": {"name": "jack-in-the-box", "filename": "Jack-in-the-box.png"},
+    "5773668482394620318": {"name": "easteregg", "filename": "easteregg.png"},
+    "5870661333703197240": {"name": "bondedring", "filename": "bondedring.png"},
+    "6023917088358269866": {"name": "petsnake", "filename": "petsnake.png"},
+    "6023679164349940429": {"name": "snakebox", "filename": "snakebox.png"},
+    "6003767644426076664": {"name": "xmasstocking", "filename": "xmasstocking.png"},
+    "6028283532500009446": {"name": "bigyear", "filename": "bigyear.png"},
+    "6003735372041814769": {"name": "holidaydrink", "filename": "holidaydrink.png"},
+    "5859442703032386168": {"name": "gemsignet", "filename": "gemsignet.png"},
+    "5897581235231785485": {"name": "lightsword", "filename": "lightsword.png"},
+    "5870784783948186838": {"name": "restlessjar", "filename": "restlessjar.png"},
+    "5870720080265871962": {"name": "nailbracelet", "filename": "nailbracelet.png"},
+    "5895328365971244193": {"name": "heroichelmet", "filename": "heroichelmet.png"},
+    "5895544372761461960": {"name": "bowtie", "filename": "bowtie.png"},
+    "5868455043362980631": {"name": "heartlocket", "filename": "heartlocket.png"},
+    "5871002671934079382": {"name": "lushbouquet", "filename": "lushbouquet.png"},
+    "5933543975653737112": {"name": "whipcupcake", "filename": "whipcupcake.png"},
+    "5870862540036113469": {"name": "joyfulbundle", "filename": "joyfulbundle.png"},
+    "5868561433997870501": {"name": "cupidcharm", "filename": "cupidcharm.png"},
+    "5868595669182186720": {"name": "valentinebox", "filename": "valentinebox.png"},
+    "6014591077976114307": {"name": "snoopdogg", "filename": "snoopdogg.png"},
+    "6012607142387778152": {"name": "swagbag", "filename": "swagbag.png"},
+    "6012435906336654262": {"name": "snoopcigar", "filename": "snoopcigar.png"},
+    "6014675319464657779": {"name": "lowrider", "filename": "lowrider.png"},
+    "6014697240977737490": {"name": "westsidesign", "filename": "westsidesign.png"},
+    "6042113507581755979": {"name": "stellarrocket", "filename": "stellarrocket.png"},
+    "6005880141270483700": {"name": "jollychimp", "filename": "jollychimp.png"},
+    "5998981470310368313": {"name": "moonpendant", "filename": "moonpendant.png"},
+    "5933937398953018107": {"name": "ionicdryer", "filename": "ionicdryer.png"},
+}
+
+EMOJI_GIFTS = {
+    "Heart": {"id": "5170145012310081615", "value": 15, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/gifts_emoji_by_gifts_changes_bot_AgADYEwAAiHMUUk.png?raw=true"},
+    "Bear": {"id": "5170233102089322756", "value": 15, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/gifts_emoji_by_gifts_changes_bot_AgADomAAAvRzSEk.png?raw=true"},
+    "Rose": {"id": "5168103777563050263", "value": 25, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/gifts_emoji_by_gifts_changes_bot_AgADslsAAqCxSUk.png?raw=true"},
+    "Rocket": {"id": "5170564780938756245", "value": 50, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/gifts_emoji_by_gifts_changes_bot_AgAD9lAAAsBFUUk.png?raw=true"},
+    "Bottle": {"id": "6028601630662853006", "value": 50, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/gifts_emoji_by_gifts_changes_bot_AgADA2cAAm0PqUs.png?raw=true"},
+    "Ring": {"id": "5170690322832818290", "value": 100, "imageUrl": "https://github.com/Vasiliy-katsyka/gifthunter/blob/main/IMG_20250901_162059_844.png?raw=true"}
+}
+
+GIFT_IMAGE_BASE_URL = "https://raw.githubusercontent.com/Vasiliy-katsyka/plinko/main/GiftImages/"
+
+class GiftCatalog:
+    """
+    Immutable snapshot of every gift that can appear on a board: regular gifts with their
+    floor prices plus the fixed-value emoji gifts, kept sorted by value so that a price
+    range can be resolved with two bisects instead of a scan over the whole list.
+    """
+    def __init__(self, floor_prices, version):
+        self.version = version
+        self.floor_prices = dict(floor_prices)
+        self.checked_at = time.monotonic()
+
+        gifts = []
+        for gift_id, gift_data in REGULAR_GIFTS.items():
+            name_key = gift_data["name"].lower()
+            if name_key in self.floor_prices:
+                gifts.append({
+                    "id": gift_id,
+                    "name": gift_data["name"],
+                    "value": self.floor_prices[name_key],
+                    "imageUrl": f"{GIFT_IMAGE_BASE_URL}{gift_data['filename']}"
+                })
+        for gift_name, gift_data in EMOJI_GIFTS.items():
+            gifts.append({
+                "id": gift_data["id"],
+                "name": gift_name,
+                "value": gift_data["value"],
+                "imageUrl": gift_data["imageUrl"]
+            })
+
+        gifts.sort(key=lambda g: g["value"])
+        self.gifts = tuple(gifts)
+        self.values = [g["value"] for g in self.gifts]
+
+    def __len__(self):
+        return len(self.gifts)
+
+    def price_list(self):
+        """Every gift with its price, most valuable first, as listed by /api/get_all_gift_prices."""
+        all_gifts = []
+
+        # Add emoji gifts with fixed prices
+        for name, data in EMOJI_GIFTS.items():
+            all_gifts.append({
+                "name": name,
+                "value": data['value'],
+                "imageUrl": data['imageUrl']
+            })
+
+        # Add collectible gifts with dynamic floor prices
+        for gift_id, data in REGULAR_GIFTS.items():
+            normalized_name = data['name'].lower().replace("'", "")
+            if normalized_name in self.floor_prices:
+                all_gifts.append({
+                    "name": data['name'].replace("'", " ").title(),
+                    "value": self.floor_prices[normalized_name],
+                    "imageUrl": f"{GIFT_IMAGE_BASE_URL}{data['filename']}"
+                })
+
+        # Sort by value, descending
+        all_gifts.sort(key=lambda x: x['value'], reverse=True)
+        return all_gifts
+
+    def range_bounds(self, min_val, max_val):
+        """Returns the [lo, hi) index bounds of gifts whose value lies within [min_val, max_val]."""
+        return bisect.bisect_left(self.values, min_val), bisect.bisect_right(self.values, max_val)
+
+    def closest_to(self, target):
+        """Returns the gift whose value is closest to target (the lower one on ties)."""
+        pos = bisect.bisect_left(self.values, target)
+        if pos == 0:
+            return self.gifts[0]
+        if pos == len(self.values):
+            return self.gifts[-1]
+        before, after = self.gifts[pos - 1], self.gifts[pos]
+        return after if after["value"] - target < target - before["value"] else before
+
+class PreparedBoard:
+    """
+    A generated board together with its lose/breakeven/win partitions (fallbacks already
+    applied) and a gift id -> slot indices map, so awarding a prize is O(1).
+    """
+    def __init__(self, bet_mode, board):
+        self.bet_mode = bet_mode
+        self.board = board
+        bet_amount = BET_MODES_CONFIG[bet_mode]['bet_amount']
+
+        lose_gifts = [g for g in board if g['value'] < bet_amount]
+        # Allow a small tolerance for breakeven, e.g., for values like 999.9 vs 1000
+        breakeven_gifts = [g for g in board if abs(g['value'] - bet_amount) < 1.0]
+        win_gifts = [g for g in board if g['value'] > bet_amount]
+
+        # Fallback mechanism in case a category has no eligible gifts on the board:
+        # win -> the best possible gift, breakeven -> closest value to bet, lose -> the cheapest gift
+        self.outcome_gifts = {
+            'lose': lose_gifts or [min(board, key=lambda g: g['value'])],
+            'breakeven': breakeven_gifts or [min(board, key=lambda g: abs(g['value'] - bet_amount))],
+            'win': win_gifts or [max(board, key=lambda g: g['value'])],
+        }
+
+        self.slot_indices = {}
+        for i, gift in enumerate(board):
+            self.slot_indices.setdefault(gift['id'], []).append(i)
+
+    def draw(self, outcome_category, rng=random):
+        """Picks the won gift for an outcome category and one of the slots it sits in (for the animation)."""
+        gift = rng.choice(self.outcome_gifts[outcome_category])
+        return gift, rng.choice(self.slot_indices[gift['id']])
+
+    def formatted_slots(self):
+        """The slots as shown by the Mini App: name, image, value and multiplier of the bet."""
+        bet_amount = BET_MODES_CONFIG[self.bet_mode]['bet_amount']
+        formatted_slots = []
+        for gift in self.board:
+            if gift:
+                gift_value = gift.get('value', 0)
+                formatted_slots.append({
+                    "name": gift.get('name', 'Unknown'),
+                    "imageUrl": gift.get('imageUrl', ''),
+                    "value": gift_value,
+                    "multiplier": gift_value / bet_amount if bet_amount > 0 else 0
+                })
+        return formatted_slots
+
+def generate_board_gifts(bet_mode, seed, catalog):
+    """
+    Generates the complete, symmetrical list of gift objects for a given bet mode, seed and catalog.
+    This is the single source of truth for both displaying and awarding prizes.
+    """
+    config = BET_MODES_CONFIG[bet_mode]
+
+    # Use the provided seed to initialize the random number generator for deterministic results
+    seeded_random = random.Random(seed)
+
+    # Determine gifts for the first half of the board
+    num_slots = len(config['slots'])
+    mid_point_index = (num_slots // 2)
+    first_half_gifts = []
+    
+    for i in range(mid_point_index + 1):
+        slot_config = config['slots'][i]
+        gift_object = None
+        if isinstance(slot_config, list):
+            min_val, max_val = slot_config
+            gift_object = select_gift_for_range(min_val, max_val, catalog, seeded_random)
+        elif isinstance(slot_config, str) and slot_config in EMOJI_GIFTS:
+            gift_data = EMOJI_GIFTS[slot_config]
+            gift_object = {
+                "id": gift_data["id"], "name": slot_config, 
+                "value": gift_data["value"], "imageUrl": gift_data["imageUrl"]
+            }
+        first_half_gifts.append(gift_object)
+    
+    # Construct the full symmetrical list by mirroring the first half
+    second_half_gifts = first_half_gifts[:-1][::-1]
+    return first_half_gifts + second_half_gifts
+
+def select_gift_for_range(min_val, max_val, catalog, seeded_random_gen):
+    """
+    Selects a gift for a price range using a seeded random generator for consistency.
+    The catalog is sorted by value, so the eligible gifts are the contiguous slice [lo, hi).
+    """
+    lo, hi = catalog.range_bounds(min_val, max_val)
+
+    if lo == hi:
+        # Fallback remains the same: the gift closest to the middle of the range
+        return catalog.closest_to((min_val + max_val) / 2)
+
+    # Simply return the next random choice from the seeded generator
+    return catalog.gifts[seeded_random_gen.randrange(lo, hi)]
+
+def draw_outcome_categories(count, rng=random):
+    """Draws the outcome category of `count` paid drops."""
+    return rng.choices(DROP_OUTCOMES, weights=DROP_OUTCOME_WEIGHTS, k=count)
+
+def draw_free_drop_gift(rng=random):
+    """Returns the name of the emoji gift won by a free try."""
+    return rng.choices(FREE_DROP_GIFTS, weights=FREE_DROP_WEIGHTS, k=1)[0]
+
+def conversion_value(value_at_win):
+    """Stars credited for converting a won gift back to balance."""
+    return value_at_win * CONVERSION_BONUS_MULTIPLIER
@@ -0,0 +1,338 @@
+"""
+End-to-end load test for the Plinko API with local stand-ins for Telegram, Portals and TON.
+
+Boots app.py against a local database (a temporary SQLite file by default, or any
+--database-url such as a scratch Postgres), seeds synthetic users, inventory and prices,
+and drives concurrent user flows through Flask test clients:
+
+    open app (user_data, get_all_gift_prices) -> board -> N drops -> inventory -> convert -> TON deposit
+
+initData headers are signed with a test bot token, Portals' giftsFloors returns synthetic
+floors and the TON lite-client is a fake that "pays" every deposit the flows initiate, so
+no network access is needed. Reports latency histograms, requests per second and DB query
+counts per endpoint.
+
+    python loadtest.py --users 200 --concurrency 16 --drops 10
+    python loadtest.py --database-url postgresql://localhost/plinko_bench --output bench.json
+    python loadtest.py --compare bench.json   # exit 1 if an endpoint got slower or chattier
+"""
+import argparse
+import bisect
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from urllib.parse import quote, urlencode
+
+BOT_TOKEN = "123456:loadtest"
+DEPOSIT_WALLET_ADDRESS = "EQLoadTestDepositWallet"
+FIRST_USER_ID = 9_000_000_000
+DEFAULT_USERS = 100
+DEFAULT_CONCURRENCY = 8
+DEFAULT_DROPS = 5
+DEFAULT_INVENTORY = 50  # pre-seeded items per user
+STARTING_BALANCE_STARS = 1_000_000
+TON_JOB_INTERVAL_SECONDS = 0.5  # how often the stand-in scheduler runs process_ton_deposits
+TON_CREDIT_TIMEOUT_SECONDS = 20  # a paid deposit not credited by then counts as an error
+TON_VERIFY_POLL_SECONDS = 0.1  # how often a flow polls verify_ton_deposit while waiting, like the frontend
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+REGRESSION_THRESHOLD = 0.25  # allowed relative p99 increase for --compare
+QUERY_REGRESSION_THRESHOLD = 0.5  # allowed increase of mean queries per request for --compare
+
+def sign_init_data(user, bot_token=BOT_TOKEN):
+    """Builds an X-Telegram-Init-Data value the way the Telegram client signs it."""
+    fields = {"auth_date": str(int(time.time())), "query_id": "loadtest", "user": json.dumps(user)}
+    data_check_string = "\n".join(f"{key}={fields[key]}" for key in sorted(fields))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields, quote_via=quote)
+
+def fake_gifts_floors(authData=None):
+    """Stand-in for app.fetch_portals_floors (portalsmp.giftsFloors): stable synthetic floors in TON for every regular gift."""
+    import game
+    rng = random.Random("floors")
+    return {gift["name"]: round(rng.uniform(0.6, 100.0), 3) for gift in game.REGULAR_GIFTS.values()}
+
+class FakeTonLedger:
+    """Deposits the flows have 'paid'; FakeLiteClient reports them as incoming wallet transactions."""
+    def __init__(self):
+        self.transactions = []  # newest first, like the lite-client
+        self._lock = threading.Lock()
+        self._next_lt = 1
+
+    def pay(self, comment, value_nanoton):
+        body = SimpleNamespace(begin_parse=lambda: FakeCommentSlice(comment))
+        with self._lock:
+            previous = self.transactions[0] if self.transactions else None
+            tx = SimpleNamespace(lt=self._next_lt, hash=f"tx{self._next_lt}".encode(),
+                                 prev_trans_lt=previous.lt if previous else 0, prev_trans_hash=previous.hash if previous else b"",
+                                 in_msg=SimpleNamespace(body=body, info=SimpleNamespace(value_coins=value_nanoton)))
+            self._next_lt += 1
+            self.transactions.insert(0, tx)
+
+class FakeCommentSlice:
+    def __init__(self, comment):
+        self.comment = comment
+        self.remaining_bits = 32 + 8 * len(comment)
+
+    def load_uint(self, bits):
+        return 0  # text comment op code
+
+    def load_snake_string(self):
+        return self.comment
+
+class FakeLiteClient:
+    """Stand-in for pytoniq's LiteBalancer, serving transactions from a FakeTonLedger."""
+    ledger = FakeTonLedger()
+
+    async def start_up(self):
+        pass
+
+    async def get_transactions(self, address, count, from_lt=None, from_hash=None, to_lt=0):
+        """Newest first, starting at from_lt (the newest transaction if None) and stopping above to_lt."""
+        return [tx for tx in self.ledger.transactions if tx.lt > to_lt and (from_lt is None or tx.lt <= from_lt)][:count]
+
+    async def close_all(self):
+        pass
+
+def boot_app(database_url):
+    """Imports app.py against database_url with every external service replaced by a local stand-in."""
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["DEPOSIT_WALLET_ADDRESS"] = DEPOSIT_WALLET_ADDRESS
+    # No webhook registration and no Portals call from the web role
+    os.environ.pop("BOT_TOKEN", None)
+    os.environ.pop("PORTALS_AUTH_TOKEN", None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    app.run_migrations(app.engine)
+    app.create_app(["web"])  # like a gunicorn worker; the harness runs the jobs it needs itself
+
+    app.BOT_TOKEN = BOT_TOKEN
+    app.fetch_portals_floors = fake_gifts_floors
+    app.PORTALS_AUTH_TOKEN = "loadtest"
+    app.ton_deposit_watcher.client_factory = FakeLiteClient
+    app.update_floor_prices_in_db()
+    return app
+
+class QueryCounter:
+    """Counts SQL statements per thread through engine events."""
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self._local = threading.local()
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    def take(self):
+        count, self._local.count = getattr(self._local, "count", 0), 0
+        return count
+
+def seed_database(app, users, inventory_per_user):
+    """Inserts synthetic users with a balance and a pre-won inventory."""
+    from sqlalchemy import insert
+    catalog = app.get_gift_catalog()
+    rng = random.Random("inventory")
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + users))
+    db = app.SessionLocal()
+    try:
+        db.execute(insert(app.User), [{
+            "telegram_id": user_id, "username": f"loadtest{user_id}", "first_name": "Load",
+            "balance_milli": app.to_milli_stars(STARTING_BALANCE_STARS),
+        } for user_id in user_ids])
+        if inventory_per_user:
+            rows = []
+            for user_id in user_ids:
+                for gift in rng.choices(catalog.gifts, k=inventory_per_user):
+                    rows.append({"user_id": user_id, "gift_id": str(gift["id"]), "gift_name": gift["name"],
+                                 "value_at_win": float(gift["value"]), "imageUrl": gift["imageUrl"]})
+            db.execute(insert(app.UserGiftInventory), rows)
+        db.commit()
+    finally:
+        db.close()
+    return user_ids
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)  # endpoint -> [(latency_seconds, status, queries, failed)]
+
+    def record(self, endpoint, latency_seconds, status, queries, failed=False):
+        """failed marks a response that is an error for the flow even though its status is not (e.g. a deposit never credited)."""
+        with self._lock:
+            self.samples[endpoint].append((latency_seconds, status, queries, failed or status >= 400))
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summarize(samples, wall_seconds):
+    latencies_ms = sorted(latency * 1000 for latency, _, _, _ in samples)
+    queries = [count for _, _, count, _ in samples]
+    counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    for value in latencies_ms:
+        counts[bisect.bisect_left(LATENCY_BUCKETS_MS, value)] += 1
+    histogram = dict(zip([f"<={bound}" for bound in LATENCY_BUCKETS_MS] + ["+Inf"], counts))
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for _, _, _, failed in samples if failed),
+        "rps": len(samples) / wall_seconds if wall_seconds else 0.0,
+        "latency_ms": {
+            "mean": sum(latencies_ms) / len(latencies_ms),
+            "p50": percentile(latencies_ms, 0.50),
+            "p90": percentile(latencies_ms, 0.90),
+            "p99": percentile(latencies_ms, 0.99),
+            "max": latencies_ms[-1],
+        },
+        "histogram_ms": histogram,
+        "db_queries": {"mean": sum(queries) / len(queries), "max": max(queries)},
+    }
+
+def run_flow(app, user_id, drops, recorder, counter, rng):
+    """One user session: open the app, load a board, drop, look at the inventory, convert a gift, deposit TON."""
+    client = app.app.test_client()
+    headers = {"X-Telegram-Init-Data": sign_init_data({"id": user_id, "username": f"loadtest{user_id}", "first_name": "Load"})}
+
+    def call(endpoint, method, path, expect=None, **kwargs):
+        """Makes and records one request; expect(json) returning False records it as an error."""
+        counter.take()
+        started = time.perf_counter()
+        response = client.open(path, method=method, headers=headers, **kwargs)
+        latency = time.perf_counter() - started
+        failed = expect is not None and not expect(response.get_json(silent=True) or {})
+        recorder.record(endpoint, latency, response.status_code, counter.take(), failed)
+        return response
+
+    def wait_until_credited(comment):
+        """Polls like the frontend (unrecorded) until the TON job has credited the deposit, or the timeout."""
+        deadline = time.monotonic() + TON_CREDIT_TIMEOUT_SECONDS
+        while time.monotonic() < deadline:
+            status = (client.post("/api/verify_ton_deposit", headers=headers, json={"comment": comment}).get_json() or {}).get("status")
+            if status != "pending":
+                return
+            time.sleep(TON_VERIFY_POLL_SECONDS)
+
+    call("user_data", "POST", "/api/user_data", json={})
+    call("get_all_gift_prices", "GET", "/api/get_all_gift_prices")
+    bet_mode = rng.choice(list(app.BET_MODES_CONFIG))
+    seed = f"{rng.getrandbits(48):012x}"
+    call("get_board_slots", "GET", "/api/get_board_slots", query_string={"betMode": bet_mode, "seed": seed})
+    for _ in range(drops):
+        call("plinko_drop", "POST", "/api/plinko_drop", json={"betMode": bet_mode, "seed": seed})
+    page = call("get_inventory", "POST", "/api/get_inventory", json={"limit": 60}).get_json() or {}
+    items = page.get("inventory") or []
+    if items:
+        call("convert_gift", "POST", "/api/convert_gift", json={"inventory_id": items[-1]["inventory_id"]})
+    deposit = call("initiate_ton_deposit", "POST", "/api/initiate_ton_deposit", json={}).get_json() or {}
+    if deposit.get("comment"):
+        FakeLiteClient.ledger.pay(deposit["comment"], 1_000_000_000)
+        wait_until_credited(deposit["comment"])
+        # Timed once credited: the path a user sees after paying, not the "pending" answer before the job runs
+        call("verify_ton_deposit", "POST", "/api/verify_ton_deposit", json={"comment": deposit["comment"]},
+             expect=lambda data: data.get("status") == "success")
+
+def run_ton_job(app, stop):
+    """Stands in for the scheduler: credits the fake TON payments while the flows run."""
+    while not stop.wait(TON_JOB_INTERVAL_SECONDS):
+        app.process_ton_deposits()
+
+def run(database_url, users, concurrency, drops, inventory_per_user, seed):
+    app = boot_app(database_url)
+    user_ids = seed_database(app, users, inventory_per_user)
+    counter = QueryCounter(app.engine)
+    recorder = Recorder()
+    stop = threading.Event()
+    ton_job = threading.Thread(target=run_ton_job, args=(app, stop), daemon=True)
+    ton_job.start()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(run_flow, app, user_id, drops, recorder, counter, random.Random(f"{seed}-{user_id}"))
+                   for user_id in user_ids]
+        for future in futures:
+            future.result()
+    wall_seconds = time.perf_counter() - started
+    stop.set()
+    ton_job.join()
+
+    all_samples = [sample for samples in recorder.samples.values() for sample in samples]
+    return {
+        "settings": {"database": app.engine.dialect.name, "users": users, "concurrency": concurrency,
+                     "drops": drops, "inventory_per_user": inventory_per_user, "seed": seed},
+        "wall_seconds": wall_seconds,
+        "total": summarize(all_samples, wall_seconds),
+        "endpoints": {endpoint: summarize(samples, wall_seconds) for endpoint, samples in sorted(recorder.samples.items())},
+    }
+
+def compare(report, baseline, threshold=REGRESSION_THRESHOLD, query_threshold=QUERY_REGRESSION_THRESHOLD):
+    """Returns human-readable regressions of report against a saved baseline."""
+    problems = []
+    for endpoint, current in report["endpoints"].items():
+        previous = baseline["endpoints"].get(endpoint)
+        if previous is None:
+            continue
+        old_p99, new_p99 = previous["latency_ms"]["p99"], current["latency_ms"]["p99"]
+        if old_p99 and new_p99 > old_p99 * (1 + threshold):
+            problems.append(f"{endpoint}: p99 {old_p99:.1f}ms -> {new_p99:.1f}ms")
+        old_queries, new_queries = previous["db_queries"]["mean"], current["db_queries"]["mean"]
+        if new_queries > old_queries + query_threshold:
+            problems.append(f"{endpoint}: {old_queries:.1f} -> {new_queries:.1f} queries per request")
+        if current["errors"] > previous["errors"]:
+            problems.append(f"{endpoint}: {previous['errors']} -> {current['errors']} errors")
+    return problems
+
+def format_report(report):
+    lines = [f"{report['settings']['database']}, {report['settings']['users']} users, "
+             f"concurrency {report['settings']['concurrency']}, {report['wall_seconds']:.2f}s, "
+             f"{report['total']['rps']:.0f} req/s overall",
+             f"{'endpoint':<22}{'reqs':>7}{'err':>5}{'rps':>8}{'mean':>8}{'p50':>8}{'p90':>8}{'p99':>8}{'max':>8}{'queries':>9}"]
+    for endpoint, stats in report["endpoints"].items():
+        latency = stats["latency_ms"]
+        lines.append(f"{endpoint:<22}{stats['requests']:>7}{stats['errors']:>5}{stats['rps']:>8.0f}"
+                     f"{latency['mean']:>8.1f}{latency['p50']:>8.1f}{latency['p90']:>8.1f}{latency['p99']:>8.1f}"
+                     f"{latency['max']:>8.1f}{stats['db_queries']['mean']:>9.1f}")
+    lines.append("(latencies in ms, queries = mean SQL statements per request)")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end load test for the Plinko API.")
+    parser.add_argument("--database-url", help="database to run against (default: a temporary SQLite file)")
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--drops", type=int, default=DEFAULT_DROPS, help="drops per user session")
+    parser.add_argument("--inventory", type=int, default=DEFAULT_INVENTORY, help="pre-seeded inventory items per user")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", metavar="PATH", help="write the report as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="compare with a saved report, exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="allowed relative p99 increase")
+    args = parser.parse_args(argv)
+
+    database_url = args.database_url
+    if not database_url:
+        # The timeout lets concurrent writers wait for SQLite's database lock instead of failing
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='plinko-loadtest-'), 'plinko.db')}?timeout=30"
+
+    report = run(database_url, args.users, args.concurrency, args.drops, args.inventory, args.seed)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(report, json.load(f), args.threshold)
+        for problem in problems:
+            print(f"Regression: {problem}", file=sys.stderr)
+        return 1 if problems else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""
+A small, dependency-free metrics registry rendered in the Prometheus text exposition format.
+
+    registry = MetricsRegistry()
+    requests_total = registry.counter("app_requests_total", "Requests served.", ["endpoint", "status"])
+    requests_total.inc(endpoint="index", status="200")
+    print(registry.render())
+
+Counters and histograms are updated in place under a lock; callback metrics read their
+samples (e.g. cache stats) only when the registry is rendered.
+"""
+import abc
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+class Metric(abc.ABC):
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abc.abstractmethod
+    def samples(self):
+        """Yields (sample_name, ((label, value), ...), value)."""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(f"{name}{format_labels(labels)} {format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values):
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+        for key, values in sorted(series):
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket", labels + (("le", format_value(float(bound))),), cumulative
+            yield f"{self.name}_count", labels, cumulative
+            yield f"{self.name}_sum", labels, values[-1]
+
+class CallbackMetric(Metric):
+    """A gauge or counter whose samples come from callback() -> iterable of (labels dict, value) at render time."""
+    def __init__(self, name, documentation, callback, metric_type="gauge"):
+        super().__init__(name, documentation)
+        self.metric_type = metric_type
+        self.callback = callback
+
+    def samples(self):
+        for labels, value in self.callback():
+            yield self.name, tuple(sorted(labels.items())), value
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, callback, metric_type="gauge"):
+        return self.register(CallbackMetric(name, documentation, callback, metric_type))
+
+    def render(self):
+        parts = []
+        for metric in self._metrics:
+            try:
+                parts.append(metric.render())
+            except Exception as e:
+                # One failing callback must not take the whole scrape down
+                parts.append(f"# {metric.name} unavailable: {type(e).__name__}")
+        return "\n".join(parts) + "\n"
+
+@contextlib.contextmanager
+def timed_call(histogram, counter, **labels):
+    """Observes the duration of the block in histogram and counts it in counter with status="ok" or "error"."""
+    started = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+        counter.inc(status=status, **labels)
@@ -0,0 +1,243 @@
+"""
+Monte Carlo return-to-player (RTP) simulator for the Plinko bet modes.
+
+Boards are generated with the real game.generate_board_gifts and drops use the real
+lose/breakeven/win weights and fallbacks of game.PreparedBoard; only the sampling of
+drops is vectorized with NumPy, so tens of millions of drops per mode take seconds.
+
+    python rtp_simulator.py --prices prices.json
+    python rtp_simulator.py --database-url "$DATABASE_URL" --drops 50000000
+    python rtp_simulator.py --prices prices.json --save-baseline rtp_baseline.json
+    python rtp_simulator.py --check-baseline rtp_baseline.json
+
+The prices file maps gift names to floor prices in Stars ({"plushpepe": 512000, ...}),
+the same shape as the plinko_gift_floor_prices table. A baseline stores the prices and
+settings it was made with, so --check-baseline replays exactly the same boards and fails
+(exit code 1) when a change to the game math moves the RTP of any mode.
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+import game
+
+DEFAULT_BOARDS = 10000  # distinct seeds per mode; each board is dropped on many times
+DEFAULT_DROPS = 10_000_000  # per mode
+DEFAULT_SEED = 0
+CHUNK_DROPS = 2_000_000  # drops sampled per NumPy batch, bounds memory use
+TAIL_MULTIPLIERS = (1, 2, 5, 10)
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+TOP_GIFTS = 10
+BASELINE_TOLERANCE = 0.002  # allowed absolute change of a mode's RTP
+
+def load_prices_from_file(path):
+    with open(path) as f:
+        return {name.lower(): float(price) for name, price in json.load(f).items()}
+
+def load_prices_from_db(database_url):
+    from sqlalchemy import create_engine, text
+    engine = create_engine(database_url)
+    try:
+        with engine.connect() as conn:
+            rows = conn.execute(text("SELECT gift_name, price_in_stars FROM plinko_gift_floor_prices")).all()
+    finally:
+        engine.dispose()
+    return {gift_name: float(price) for gift_name, price in rows}
+
+class BoardTable:
+    """
+    The outcome partitions of many boards of one bet mode as padded NumPy arrays:
+    gift_ids[board, category, i] is the catalog index of the i-th eligible gift and
+    counts[board, category] how many there are.
+    """
+    def __init__(self, bet_mode, catalog, boards, seed):
+        self.bet_mode = bet_mode
+        self.bet_amount = game.BET_MODES_CONFIG[bet_mode]['bet_amount']
+        gift_index = {gift['id']: i for i, gift in enumerate(catalog.gifts)}
+
+        partitions = []
+        for board_number in range(boards):
+            prepared = game.PreparedBoard(
+                bet_mode, game.generate_board_gifts(bet_mode, f"rtp-{seed}-{board_number}", catalog)
+            )
+            partitions.append([[gift_index[gift['id']] for gift in prepared.outcome_gifts[category]]
+                               for category in game.DROP_OUTCOMES])
+
+        width = max(len(gifts) for board in partitions for gifts in board)
+        self.gift_ids = np.zeros((boards, len(game.DROP_OUTCOMES), width), dtype=np.int32)
+        self.counts = np.zeros((boards, len(game.DROP_OUTCOMES)), dtype=np.int64)
+        for b, board in enumerate(partitions):
+            for c, gifts in enumerate(board):
+                self.gift_ids[b, c, :len(gifts)] = gifts
+                self.counts[b, c] = len(gifts)
+
+def outcome_probabilities():
+    weights = np.asarray(game.DROP_OUTCOME_WEIGHTS, dtype=np.float64)
+    return weights / weights.sum()
+
+def exact_rtp(table, values):
+    """Expected payout per Star bet over the boards of the table, without sampling noise."""
+    category_means = np.where(
+        np.arange(table.gift_ids.shape[2]) < table.counts[:, :, None], values[table.gift_ids], 0.0
+    ).sum(axis=2) / table.counts
+    return float((category_means @ outcome_probabilities()).mean() / table.bet_amount)
+
+def simulate_hits(table, drops, rng, gift_count):
+    """Samples `drops` drops on uniformly chosen boards. Returns the hit count of every catalog gift."""
+    probabilities = outcome_probabilities()
+    hits = np.zeros(gift_count, dtype=np.int64)
+    remaining = drops
+    while remaining:
+        n = min(remaining, CHUNK_DROPS)
+        boards = rng.integers(len(table.counts), size=n)
+        categories = rng.choice(len(probabilities), size=n, p=probabilities)
+        picks = (rng.random(n) * table.counts[boards, categories]).astype(np.int64)
+        hits += np.bincount(table.gift_ids[boards, categories, picks], minlength=gift_count)
+        remaining -= n
+    return hits
+
+def summarize(table, catalog, values, hits, elapsed_seconds):
+    """RTP, variance, tails and per-gift hit rates of one mode from its gift hit counts."""
+    drops = int(hits.sum())
+    multipliers = values / table.bet_amount
+    hit_rates = hits / drops
+    mean = float(hit_rates @ multipliers)
+    variance = float(hit_rates @ (multipliers - mean) ** 2)
+
+    # Payouts are discrete (one value per gift), so quantiles follow from the sorted hit rates
+    order = np.argsort(multipliers, kind='stable')
+    cumulative = np.cumsum(hit_rates[order])
+    quantiles = {str(q): float(multipliers[order][np.searchsorted(cumulative, q)]) for q in QUANTILES}
+
+    top = np.argsort(-hits, kind='stable')[:TOP_GIFTS]
+    return {
+        "bet_amount": table.bet_amount,
+        "boards": len(table.counts),
+        "drops": drops,
+        "rtp": mean,
+        "rtp_exact": exact_rtp(table, values),
+        "rtp_if_converted": mean * game.CONVERSION_BONUS_MULTIPLIER,
+        "house_edge": 1 - mean,
+        "multiplier_variance": variance,
+        "multiplier_std": variance ** 0.5,
+        "multiplier_quantiles": quantiles,
+        "multiplier_max": float(multipliers[hits > 0].max()),
+        "tail_probabilities": {f">={k}x": float(hit_rates[multipliers >= k].sum()) for k in TAIL_MULTIPLIERS},
+        "top_gifts": [{
+            "name": catalog.gifts[i]["name"],
+            "value": float(values[i]),
+            "hit_rate": float(hit_rates[i]),
+            "payout_share": float(hits[i] * values[i] / (hits @ values)),
+        } for i in top if hits[i]],
+        "drops_per_second": drops / elapsed_seconds if elapsed_seconds else None,
+    }
+
+def free_drop_expected_value():
+    weights = np.asarray(game.FREE_DROP_WEIGHTS, dtype=np.float64)
+    values = np.asarray([game.EMOJI_GIFTS[name]["value"] for name in game.FREE_DROP_GIFTS], dtype=np.float64)
+    return float(weights @ values / weights.sum())
+
+def run(prices, modes=None, boards=DEFAULT_BOARDS, drops=DEFAULT_DROPS, seed=DEFAULT_SEED):
+    """Simulates every bet mode (or just `modes`) for a {gift_name: price} snapshot and returns the report."""
+    catalog = game.GiftCatalog(prices, version=0)
+    values = np.asarray(catalog.values, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    report = {
+        "settings": {"boards": boards, "drops": drops, "seed": seed},
+        "modes": {},
+        "free_drop_expected_value": free_drop_expected_value(),
+    }
+    for bet_mode in modes or game.BET_MODES_CONFIG:
+        table = BoardTable(bet_mode, catalog, boards, seed)
+        started = time.perf_counter()
+        hits = simulate_hits(table, drops, rng, len(catalog))
+        report["modes"][bet_mode] = summarize(table, catalog, values, hits, time.perf_counter() - started)
+    return report
+
+def compare_with_baseline(report, baseline, tolerance):
+    """Returns a list of human-readable regressions (empty if every mode is within tolerance)."""
+    problems = []
+    for bet_mode, actual in report["modes"].items():
+        expected = baseline["modes"].get(bet_mode)
+        if expected is None:
+            continue
+        delta = actual["rtp_exact"] - expected["rtp_exact"]
+        if abs(delta) > tolerance:
+            problems.append(f"mode {bet_mode}: RTP {expected['rtp_exact']:.4%} -> {actual['rtp_exact']:.4%} ({delta:+.4%})")
+    return problems
+
+def format_report(report):
+    lines = []
+    for bet_mode, mode in report["modes"].items():
+        lines.append(f"== Mode {bet_mode} (bet {mode['bet_amount']} Stars, {mode['boards']} boards, {mode['drops']:,} drops)")
+        lines.append(f"RTP {mode['rtp']:.4%} (exact {mode['rtp_exact']:.4%}, if converted {mode['rtp_if_converted']:.4%}), "
+                     f"house edge {mode['house_edge']:.4%}")
+        lines.append(f"Multiplier std {mode['multiplier_std']:.4f}, max {mode['multiplier_max']:.2f}x, quantiles "
+                     + ", ".join(f"p{float(q) * 100:g}={v:.2f}x" for q, v in mode["multiplier_quantiles"].items()))
+        lines.append("Tails " + ", ".join(f"P({k})={p:.4%}" for k, p in mode["tail_probabilities"].items()))
+        for gift in mode["top_gifts"]:
+            lines.append(f"  {gift['name']:<20} {gift['value']:>10.2f}  hit {gift['hit_rate']:.4%}  payout share {gift['payout_share']:.2%}")
+        if mode["drops_per_second"]:
+            lines.append(f"({mode['drops_per_second']:,.0f} drops/s)")
+        lines.append("")
+    lines.append(f"Free drop expected value: {report['free_drop_expected_value']:.2f} Stars")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Monte Carlo RTP simulator for the Plinko bet modes.")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--prices", help="JSON file mapping gift names to floor prices in Stars")
+    source.add_argument("--database-url", help="read prices from plinko_gift_floor_prices")
+    parser.add_argument("--modes", nargs="+", choices=list(game.BET_MODES_CONFIG), help="bet modes to simulate (default: all)")
+    parser.add_argument("--boards", type=int, help=f"boards per mode (default {DEFAULT_BOARDS})")
+    parser.add_argument("--drops", type=int, help=f"drops per mode (default {DEFAULT_DROPS:,})")
+    parser.add_argument("--seed", type=int, help=f"random seed (default {DEFAULT_SEED})")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--save-baseline", metavar="PATH", help="write the report and its prices as a regression baseline")
+    parser.add_argument("--check-baseline", metavar="PATH", help="re-run a baseline's prices and settings, exit 1 if an RTP moved")
+    parser.add_argument("--tolerance", type=float, default=BASELINE_TOLERANCE, help="allowed absolute RTP change for --check-baseline")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.check_baseline:
+        with open(args.check_baseline) as f:
+            baseline = json.load(f)
+
+    if args.prices:
+        prices = load_prices_from_file(args.prices)
+    elif args.database_url:
+        prices = load_prices_from_db(args.database_url)
+    elif baseline:
+        prices = baseline["prices"]
+    else:
+        parser.error("one of --prices, --database-url or --check-baseline is required")
+    if not prices:
+        parser.error("no gift prices found")
+
+    settings = baseline["settings"] if baseline else {}
+    report = run(
+        prices,
+        modes=args.modes or (list(baseline["modes"]) if baseline else None),
+        boards=args.boards or settings.get("boards", DEFAULT_BOARDS),
+        drops=args.drops or settings.get("drops", DEFAULT_DROPS),
+        seed=args.seed if args.seed is not None else settings.get("seed", DEFAULT_SEED),
+    )
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({**report, "prices": prices}, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.save_baseline}", file=sys.stderr)
+
+    if baseline:
+        problems = compare_with_baseline(report, baseline, args.tolerance)
+        for problem in problems:
+            print(f"RTP regression: {problem}", file=sys.stderr)
+        return 1 if problems else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
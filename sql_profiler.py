@@ -0,0 +1,160 @@
+"""
+Opt-in SQL profiler: records every statement a request (or job) runs, with its timing and the
+application call site that issued it, flags statement shapes repeated within one unit of work
+as N+1 candidates and writes slow or suspicious units of work as JSON reports.
+
+    profiler = SQLProfiler(engine, "sql_profiles", slow_seconds=0.25)
+    with profiler.profile("job:update_floor_prices") as profile:
+        ...
+    if profile.is_slow or profile.n_plus_one():
+        profiler.write_report(profile)
+
+Profiles are per thread, so concurrent requests never mix their statements. Capturing
+stacks is not free; keep it off in production and enable it in staging or per request.
+"""
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+
+DEFAULT_REPEAT_THRESHOLD = 3  # identical statement shapes per unit of work before it is flagged as N+1
+DEFAULT_STACK_DEPTH = 6
+DEFAULT_MAX_STATEMENTS = 500  # statements kept per profile; the rest are only counted
+
+WHITESPACE = re.compile(r"\s+")
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+NAMED_PLACEHOLDER = re.compile(r"%\(\w+\)s")
+PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+def statement_shape(statement):
+    """Normalizes a statement so that runs differing only in literals, parameters or IN-list length compare equal."""
+    shape = WHITESPACE.sub(" ", statement).strip()
+    shape = STRING_LITERAL.sub("?", shape)
+    shape = NAMED_PLACEHOLDER.sub("?", shape)
+    shape = NUMBER_LITERAL.sub("?", shape)
+    return PLACEHOLDER_LIST.sub("(?)", shape)
+
+class Profile:
+    def __init__(self, name, slow_seconds, repeat_threshold, max_statements):
+        self.name = name
+        self.slow_seconds = slow_seconds
+        self.repeat_threshold = repeat_threshold
+        self.max_statements = max_statements
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.duration_seconds = None
+        self.statements = []
+        self.statement_count = 0
+        self.sql_seconds = 0.0
+        self._shapes = {}  # shape -> [count, total seconds, set of call sites]
+
+    def add(self, statement, seconds, stack, rows):
+        self.statement_count += 1
+        self.sql_seconds += seconds
+        shape = statement_shape(statement)
+        stats = self._shapes.setdefault(shape, [0, 0.0, set()])
+        stats[0] += 1
+        stats[1] += seconds
+        if stack:
+            stats[2].add(" <- ".join(reversed(stack[-2:])))
+        if len(self.statements) < self.max_statements:
+            self.statements.append({"sql": statement, "duration_ms": seconds * 1000, "rows": rows, "stack": stack})
+
+    def finish(self):
+        self.duration_seconds = time.perf_counter() - self.started
+
+    @property
+    def is_slow(self):
+        return self.duration_seconds is not None and self.duration_seconds >= self.slow_seconds
+
+    def n_plus_one(self):
+        """Statement shapes run at least repeat_threshold times, most frequent first."""
+        return sorted((
+            {"shape": shape, "count": count, "total_ms": seconds * 1000, "call_sites": sorted(call_sites)}
+            for shape, (count, seconds, call_sites) in self._shapes.items() if count >= self.repeat_threshold
+        ), key=lambda candidate: -candidate["count"])
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": (self.duration_seconds or 0) * 1000,
+            "sql_ms": self.sql_seconds * 1000,
+            "statement_count": self.statement_count,
+            "n_plus_one": self.n_plus_one(),
+            "statements": self.statements,
+            "statements_truncated": self.statement_count > len(self.statements),
+        }
+
+class SQLProfiler:
+    def __init__(self, engine, report_dir, slow_seconds, repeat_threshold=DEFAULT_REPEAT_THRESHOLD,
+                 stack_depth=DEFAULT_STACK_DEPTH, max_statements=DEFAULT_MAX_STATEMENTS, source_root=None):
+        self.report_dir = report_dir
+        self.slow_seconds = slow_seconds
+        self.repeat_threshold = repeat_threshold
+        self.stack_depth = stack_depth
+        self.max_statements = max_statements
+        self.source_root = os.path.abspath(source_root or os.path.dirname(__file__))
+        self._local = threading.local()
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    @property
+    def active(self):
+        return getattr(self._local, "profile", None)
+
+    def start(self, name):
+        self._local.profile = Profile(name, self.slow_seconds, self.repeat_threshold, self.max_statements)
+        return self._local.profile
+
+    def stop(self):
+        profile, self._local.profile = self.active, None
+        if profile:
+            profile.finish()
+        return profile
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        profile = self.start(name)
+        try:
+            yield profile
+        finally:
+            self.stop()
+
+    def _call_site(self):
+        """The innermost application frames (outside SQLAlchemy and this module), as 'file:line in function'."""
+        frames = [
+            frame for frame in traceback.extract_stack()[:-3]
+            if frame.filename.startswith(self.source_root) and os.path.abspath(frame.filename) != os.path.abspath(__file__)
+        ]
+        return [f"{os.path.relpath(frame.filename, self.source_root)}:{frame.lineno} in {frame.name}"
+                for frame in frames[-self.stack_depth:]]
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.active:
+            conn.info.setdefault("profiler_started_at", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = self.active
+        if not profile or not conn.info.get("profiler_started_at"):
+            return
+        seconds = time.perf_counter() - conn.info["profiler_started_at"].pop()
+        rows = len(parameters) if executemany else None
+        profile.add(statement, seconds, self._call_site(), rows)
+
+    def write_report(self, profile):
+        """Writes the profile as JSON into report_dir and returns the file name."""
+        os.makedirs(self.report_dir, exist_ok=True)
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", profile.name).strip("_")
+        file_name = f"{profile.started_at.strftime('%Y%m%dT%H%M%S')}-{safe_name}-{uuid.uuid4().hex[:8]}.json"
+        with open(os.path.join(self.report_dir, file_name), "w") as f:
+            json.dump(profile.to_dict(), f, indent=2)
+        return file_name
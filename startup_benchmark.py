@@ -0,0 +1,148 @@
+"""
+Startup benchmark for a web worker: how long `import app` and create_app(["web"]) take in a
+fresh interpreter, and whether importing had side effects it should not have.
+
+Each run starts a new Python process against a throwaway SQLite database (no network), so the
+numbers are what a cold gunicorn worker pays. Flask, SQLAlchemy and telebot are imported and
+timed first; the budget applies to app.py's own import on top of them, the part this repo
+controls. Fails (exit code 1) when that exceeds the budget, when the import starts threads or
+a scheduler, or when it pulls in one of the modules only the jobs need.
+
+    python startup_benchmark.py
+    python startup_benchmark.py --runs 20 --budget-ms 60 --json
+    python startup_benchmark.py --top 15   # the slowest imports, from python -X importtime
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+DEFAULT_RUNS = 7
+DEFAULT_BUDGET_MS = 75  # median import of app.py itself, on top of the frameworks below
+DEFAULT_TOP = 10
+LAZY_MODULES = ("portalsmp", "pyrogram", "pytoniq", "apscheduler", "numpy", "sql_profiler")
+
+FRAMEWORK_MODULES = ("flask", "flask_cors", "sqlalchemy", "sqlalchemy.orm", "telebot", "requests")
+
+PROBE = """
+import importlib, json, sys, threading, time
+started = time.perf_counter()
+for name in %r:
+    importlib.import_module(name)
+frameworks_imported = time.perf_counter()
+import app
+imported = time.perf_counter()
+report = {
+    "frameworks_ms": (frameworks_imported - started) * 1000,
+    "import_ms": (imported - frameworks_imported) * 1000,
+    "threads_after_import": threading.active_count(),
+    "scheduler_after_import": app.scheduler is not None,
+    "roles_after_import": sorted(app.started_roles),
+    "lazy_modules_loaded": [name for name in %r if name in sys.modules],
+}
+app.run_migrations(app.engine)  # create_app() refuses an unmigrated database
+created = time.perf_counter()
+app.create_app(["web"])
+report["create_app_ms"] = (time.perf_counter() - created) * 1000
+print(json.dumps(report))
+""" % (FRAMEWORK_MODULES, LAZY_MODULES)
+
+def probe_env(database_url):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    # Nothing that would reach Telegram, Portals or TON
+    # and nothing that would make every run recompile app.py instead of loading its .pyc
+    for name in ("BOT_TOKEN", "PORTALS_AUTH_TOKEN", "RUN_MIGRATIONS_ON_STARTUP", "SQL_PROFILE", "PYTHONDONTWRITEBYTECODE"):
+        env.pop(name, None)
+    return env
+
+def run_probe(app_dir, env):
+    result = subprocess.run([sys.executable, "-c", PROBE], cwd=app_dir, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def slowest_imports(app_dir, env, top):
+    """(cumulative ms, module) of the slowest top-level imports of app.py, from python -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=app_dir, env=env,
+                            capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Two spaces of indent = imported directly by app.py
+        if name.startswith("   ") and not name.startswith("    ") or name.strip() == "app":
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+def run(runs=DEFAULT_RUNS, top=DEFAULT_TOP):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        env = probe_env(f"sqlite:///{os.path.join(tmp, 'startup.db')}")
+        run_probe(app_dir, env)  # warm-up: writes .pyc files, fills the OS page cache
+        probes = [run_probe(app_dir, env) for _ in range(runs)]
+        imports = slowest_imports(app_dir, env, top) if top else []
+    frameworks_ms = [probe["frameworks_ms"] for probe in probes]
+    import_ms = [probe["import_ms"] for probe in probes]
+    create_ms = [probe["create_app_ms"] for probe in probes]
+    return {
+        "runs": runs,
+        "frameworks_ms_median": statistics.median(frameworks_ms),
+        "import_ms_median": statistics.median(import_ms),
+        "import_ms_min": min(import_ms),
+        "import_ms_max": max(import_ms),
+        "create_app_web_ms_median": statistics.median(create_ms),
+        "threads_after_import": max(probe["threads_after_import"] for probe in probes),
+        "scheduler_after_import": any(probe["scheduler_after_import"] for probe in probes),
+        "roles_after_import": probes[-1]["roles_after_import"],
+        "lazy_modules_loaded": sorted({name for probe in probes for name in probe["lazy_modules_loaded"]}),
+        "slowest_imports": [{"module": name, "cumulative_ms": ms} for ms, name in imports],
+    }
+
+def check(report, budget_ms):
+    """Returns a list of human-readable problems (empty if startup is fast and side-effect free)."""
+    problems = []
+    if report["import_ms_median"] > budget_ms:
+        problems.append(f"import app took {report['import_ms_median']:.1f}ms (median), budget is {budget_ms:g}ms")
+    if report["threads_after_import"] > 1:
+        problems.append(f"import app started {report['threads_after_import'] - 1} thread(s)")
+    if report["scheduler_after_import"]:
+        problems.append("import app created the scheduler")
+    if report["roles_after_import"]:
+        problems.append(f"import app started roles: {', '.join(report['roles_after_import'])}")
+    if report["lazy_modules_loaded"]:
+        problems.append(f"import app loaded {', '.join(report['lazy_modules_loaded'])}")
+    return problems
+
+def format_report(report):
+    lines = [
+        f"frameworks: median {report['frameworks_ms_median']:.1f}ms",
+        f"import app: median {report['import_ms_median']:.1f}ms "
+        f"(min {report['import_ms_min']:.1f}ms, max {report['import_ms_max']:.1f}ms, {report['runs']} runs)",
+        f"create_app(['web']): median {report['create_app_web_ms_median']:.1f}ms",
+    ]
+    if report["slowest_imports"]:
+        lines.append("Slowest imports (cumulative):")
+        lines.extend(f"  {entry['module']:<24} {entry['cumulative_ms']:>8.1f}ms" for entry in report["slowest_imports"])
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the cold start of a Plinko web worker.")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help=f"fresh interpreters to time (default {DEFAULT_RUNS})")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS,
+                        help=f"fail if app.py's median own import time exceeds this (default {DEFAULT_BUDGET_MS})")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP, help="slowest imports to list, 0 to skip")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = run(args.runs, args.top)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    problems = check(report, args.budget_ms)
+    for problem in problems:
+        print(f"Startup regression: {problem}", file=sys.stderr)
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py reads its configuration at import time: a throwaway SQLite database, no Telegram, Portals or TON
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'tests.db')}"
+for name in ("BOT_TOKEN", "PORTALS_AUTH_TOKEN", "RUN_MIGRATIONS_ON_STARTUP", "SQL_PROFILE"):
+    os.environ.pop(name, None)
+
+from loadtest import BOT_TOKEN, sign_init_data
+
+@pytest.fixture(scope="session")
+def app_module():
+    import app
+    app.run_migrations(app.engine)
+    app.BOT_TOKEN = BOT_TOKEN
+    app.app.testing = True  # no create_app() roles on the first request
+    return app
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+@pytest.fixture
+def auth_headers():
+    def headers(user_id):
+        return {"X-Telegram-Init-Data": sign_init_data({"id": user_id, "username": f"user{user_id}", "first_name": "Test"})}
+    return headers
+
+class FakeClock:
+    """Moves time.time() and time.monotonic() forward on demand."""
+    def __init__(self, monkeypatch):
+        self.offset = 0.0
+        real_time, real_monotonic = time.time, time.monotonic
+        monkeypatch.setattr(time, "time", lambda: real_time() + self.offset)
+        monkeypatch.setattr(time, "monotonic", lambda: real_monotonic() + self.offset)
+
+    def advance(self, seconds):
+        self.offset += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    return FakeClock(monkeypatch)
@@ -0,0 +1,73 @@
+import threading
+from decimal import Decimal
+
+def add_user(app, user_id, balance_milli):
+    db = app.SessionLocal()
+    try:
+        db.add(app.User(telegram_id=user_id, username=f"user{user_id}", balance_milli=balance_milli))
+        db.commit()
+    finally:
+        db.close()
+
+def balance_milli(app, user_id):
+    db = app.SessionLocal()
+    try:
+        return db.query(app.User.balance_milli).filter(app.User.telegram_id == user_id).scalar()
+    finally:
+        db.close()
+
+def test_concurrent_debits_never_overdraw(app_module):
+    add_user(app_module, 5001, app_module.to_milli_stars(10))
+    results = []
+    start = threading.Barrier(20)
+
+    def debit_one_star():
+        db = app_module.SessionLocal()
+        try:
+            start.wait()
+            new_balance = app_module.debit_balance(db, 5001, app_module.to_milli_stars(1))
+            db.commit()
+            results.append(new_balance)
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=debit_one_star) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    succeeded = [result for result in results if result is not None]
+    assert len(results) == 20
+    assert len(succeeded) == 10
+    assert sorted(succeeded) == [app_module.to_milli_stars(stars) for stars in range(10)]
+    assert balance_milli(app_module, 5001) == 0
+
+def test_debit_of_missing_user_or_more_than_the_balance_changes_nothing(app_module):
+    add_user(app_module, 5002, 500)
+    db = app_module.SessionLocal()
+    try:
+        assert app_module.debit_balance(db, 5002, 501) is None
+        assert app_module.debit_balance(db, 5999, 1) is None
+        assert app_module.credit_balance(db, 5999, 1) is None
+        db.commit()
+    finally:
+        db.close()
+    assert balance_milli(app_module, 5002) == 500
+
+def test_credits_and_balance_round_trip_exactly(app_module):
+    add_user(app_module, 5003, 0)
+    db = app_module.SessionLocal()
+    try:
+        # 0.1 + 0.2 Stars, a thousand times: float addition would drift
+        for _ in range(1000):
+            app_module.credit_balance(db, 5003, app_module.to_milli_stars(Decimal("0.1")))
+            app_module.credit_balance(db, 5003, app_module.to_milli_stars(0.2))
+        db.commit()
+        user = db.get(app_module.User, 5003)
+        assert user.balance_milli == 300_000
+        assert user.balance == 300.0
+    finally:
+        db.close()
+    assert app_module.to_milli_stars(app_module.from_milli_stars(123_457)) == 123_457
+    assert app_module.to_milli_stars("0.0005") == 1  # half a milli-Star rounds up
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+BET_MODE = "200"
+
+@pytest.fixture
+def stores(app_module):
+    """Two database board stores with their own local caches, like two gunicorn workers."""
+    def store():
+        local_cache = app_module.TTLCache(100, 16 * 1024 * 1024, 60, sizeof=app_module.board_entry_size)
+        return app_module.DatabaseBoardStore(app_module.SessionLocal, local_cache, 60)
+    return store(), store()
+
+def build(app, seed):
+    return lambda: app.PreparedBoard(BET_MODE, app.generate_board_gifts(BET_MODE, seed))
+
+def must_not_build():
+    raise AssertionError("the board was built twice")
+
+def test_board_built_by_one_worker_is_served_by_another(app_module, stores):
+    first, second = stores
+
+    entry, created = first.get_or_create(BET_MODE, "shared-seed-1", build(app_module, "shared-seed-1"))
+    assert created
+
+    assert second.get(BET_MODE, "shared-seed-1").board == entry.board
+    second.local_cache.pop(app_module.board_cache_key(BET_MODE, "shared-seed-1"))
+    other_entry, created = second.get_or_create(BET_MODE, "shared-seed-1", must_not_build)
+    assert not created
+    assert other_entry.board == entry.board
+
+def test_concurrent_builds_agree_on_the_first_stored_board(app_module, stores):
+    first, second = stores
+    stored = {}
+
+    def build_while_the_other_worker_stores():
+        # The first worker commits its board while the second one is still building
+        stored["entry"], _ = first.get_or_create(BET_MODE, "shared-seed-2", build(app_module, "shared-seed-2"))
+        return app_module.PreparedBoard(BET_MODE, list(reversed(stored["entry"].board)))
+
+    entry, created = second.get_or_create(BET_MODE, "shared-seed-2", build_while_the_other_worker_stores)
+
+    assert not created
+    assert entry.board == stored["entry"].board
+
+def test_expired_row_for_the_seed_is_replaced(app_module, stores):
+    first, second = stores
+    stale = first.get_or_create(BET_MODE, "shared-seed-3", build(app_module, "shared-seed-3"))[0]
+    db = app_module.SessionLocal()
+    try:
+        db.query(app_module.BoardCacheEntry).filter(
+            app_module.BoardCacheEntry.cache_key == app_module.board_cache_key(BET_MODE, "shared-seed-3")
+        ).update({"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1), "board": "[]"})
+        db.commit()
+    finally:
+        db.close()
+
+    entry, created = second.get_or_create(BET_MODE, "shared-seed-3", build(app_module, "shared-seed-3"))
+
+    assert created
+    assert entry.board == stale.board
+    assert second.get(BET_MODE, "shared-seed-3").board == stale.board
+    assert first.sweep() == 0  # the replacement row is live
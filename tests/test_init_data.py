@@ -0,0 +1,45 @@
+import hashlib
+import hmac
+import json
+import time
+from urllib.parse import quote, urlencode
+
+from loadtest import BOT_TOKEN
+
+USER = {"id": 4001, "username": "user4001", "first_name": "Test"}
+
+def signed_init_data(auth_date, user=USER, bot_token=BOT_TOKEN):
+    fields = {"auth_date": str(int(auth_date)), "query_id": "tests", "user": json.dumps(user)}
+    data_check_string = "\n".join(f"{key}={fields[key]}" for key in sorted(fields))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields, quote_via=quote)
+
+def test_valid_init_data_returns_the_user(app_module):
+    assert app_module.validate_init_data(signed_init_data(time.time()), BOT_TOKEN) == USER
+
+def test_init_data_older_than_the_max_age_is_rejected(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "INIT_DATA_MAX_AGE_SECONDS", 3600)
+    assert app_module.validate_init_data(signed_init_data(time.time() - 3601), BOT_TOKEN) is None
+    assert app_module.validate_init_data(signed_init_data(time.time() - 3500), BOT_TOKEN) == USER
+
+def test_hash_mismatch_is_rejected(app_module):
+    init_data = signed_init_data(time.time())
+    tampered = init_data.replace("user4001", "user4002")
+    assert app_module.validate_init_data(tampered, BOT_TOKEN) is None
+    assert app_module.validate_init_data(signed_init_data(time.time(), bot_token="1:other"), BOT_TOKEN) is None
+    assert app_module.validate_init_data(init_data.split("&hash=")[0], BOT_TOKEN) is None
+
+def test_cached_init_data_expires_with_auth_date(app_module, monkeypatch, clock):
+    monkeypatch.setattr(app_module, "INIT_DATA_MAX_AGE_SECONDS", 3600)
+    # 60 seconds of validity left, far less than INIT_DATA_CACHE_SECONDS
+    init_data = signed_init_data(time.time() - 3540)
+    assert app_module.validate_init_data(init_data, BOT_TOKEN) == USER
+    hits = app_module.init_data_cache.hits
+
+    clock.advance(30)
+    assert app_module.validate_init_data(init_data, BOT_TOKEN) == USER
+    assert app_module.init_data_cache.hits == hits + 1
+
+    clock.advance(31)
+    assert app_module.validate_init_data(init_data, BOT_TOKEN) is None
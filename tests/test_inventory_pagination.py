@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import insert
+
+def add_inventory(app, user_id, won_ats):
+    """Inserts one item per won_at; None leaves won_at to the database default (CURRENT_TIMESTAMP)."""
+    db = app.SessionLocal()
+    try:
+        db.add(app.User(telegram_id=user_id, username=f"user{user_id}"))
+        db.flush()
+        for won_at in won_ats:
+            values = {"user_id": user_id, "gift_id": "1", "gift_name": "Bear", "value_at_win": 15.0, "imageUrl": "bear.png"}
+            if won_at is not None:
+                values["won_at"] = won_at
+            db.execute(insert(app.UserGiftInventory).values(**values))
+        db.commit()
+    finally:
+        db.close()
+
+def fetch_all_pages(client, headers, limit):
+    ids, cursor = [], None
+    for _ in range(100):
+        body = {"limit": limit} if cursor is None else {"limit": limit, "after": cursor}
+        response = client.post("/api/get_inventory", json=body, headers=headers)
+        assert response.status_code == 200
+        data = response.get_json()
+        ids.extend(item["inventory_id"] for item in data["inventory"])
+        cursor = data["next_cursor"]
+        if cursor is None:
+            return ids
+    raise AssertionError("next_cursor never ran out")
+
+def test_pages_with_shared_won_at_return_every_item_once(app_module, client, auth_headers):
+    user_id = 1001
+    shared = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(minutes=5)
+    # Database-stamped rows (usually one second), explicit rows sharing one timestamp, and distinct ones
+    add_inventory(app_module, user_id, [None] * 12 + [shared] * 10 + [shared + timedelta(microseconds=500 * i) for i in range(8)])
+    headers = auth_headers(user_id)
+
+    everything = client.post("/api/get_inventory", json={}, headers=headers).get_json()["inventory"]
+    paged = fetch_all_pages(client, headers, limit=7)
+
+    assert len(everything) == 30
+    assert paged == [item["inventory_id"] for item in everything]
+    assert len(set(paged)) == 30
+
+def test_invalid_cursor_is_rejected(app_module, client, auth_headers):
+    headers = auth_headers(1002)
+    for after in (123, ["x"], "not-a-cursor", ""):
+        response = client.post("/api/get_inventory", json={"limit": 5, "after": after}, headers=headers)
+        assert response.status_code == 400, after
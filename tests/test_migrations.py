@@ -0,0 +1,28 @@
+from sqlalchemy import create_engine, inspect, text
+
+def test_withdrawal_lease_token_is_added_to_an_existing_table(app_module, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE plinko_withdrawal_tasks (id INTEGER PRIMARY KEY, task_id VARCHAR NOT NULL)"))
+        app_module.add_withdrawal_lease_token(conn)
+        app_module.add_withdrawal_lease_token(conn)  # idempotent
+    columns = {column["name"] for column in inspect(engine).get_columns("plinko_withdrawal_tasks")}
+    assert "lease_token" in columns
+
+def test_float_balances_are_migrated_to_milli_stars(app_module, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'float.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE plinko_users (telegram_id BIGINT PRIMARY KEY, username VARCHAR, "
+                          "first_name VARCHAR, balance FLOAT NOT NULL, last_free_drop_claim DATETIME, created_at DATETIME)"))
+        conn.execute(text("INSERT INTO plinko_users (telegram_id, balance) VALUES (1, 12.345), (2, 0.1), (3, 0)"))
+
+    applied = app_module.run_migrations(engine)
+
+    assert applied == [version for version, _, _ in app_module.MIGRATIONS]
+    assert app_module.pending_migrations(engine) == []
+    columns = {column["name"] for column in inspect(engine).get_columns("plinko_users")}
+    assert "balance" not in columns and "balance_milli" in columns
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT telegram_id, balance_milli FROM plinko_users ORDER BY telegram_id")).all()
+    assert [tuple(row) for row in rows] == [(1, 12_345), (2, 100), (3, 0)]
+    assert app_module.run_migrations(engine) == []
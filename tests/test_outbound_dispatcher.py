@@ -0,0 +1,67 @@
+import threading
+import time
+
+import telebot
+
+def rate_limited(retry_after):
+    return telebot.apihelper.ApiTelegramException("sendMessage", None, {
+        "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": retry_after}})
+
+class FakeBot:
+    """Raises the queued errors in turn, then succeeds; records when each send happened."""
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            self.calls.append((time.monotonic(), chat_id, text))
+            if self.errors:
+                raise self.errors.pop(0)
+
+def dispatcher(app, bot, **kwargs):
+    return app.OutboundDispatcher(bot, threads=2, per_chat_rate=1000, per_chat_burst=1000, global_rate=1000,
+                                  global_burst=1000, max_pending=100, max_attempts=3, **kwargs)
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_rate_limited_message_is_resent_after_retry_after(app_module):
+    bot = FakeBot([rate_limited(0.3)])
+    outbound = dispatcher(app_module, bot)
+
+    outbound.send_message(42, "hello")
+
+    wait_until(lambda: outbound.sent == 1)
+    (first_at, _, _), (second_at, chat_id, text) = bot.calls
+    assert (chat_id, text) == (42, "hello")
+    assert second_at - first_at >= 0.3
+    assert outbound.rate_limited == 1
+    assert outbound.pending == 0
+
+def test_message_is_dropped_after_max_rate_limited_attempts(app_module):
+    bot = FakeBot([rate_limited(0.01) for _ in range(10)])
+    outbound = dispatcher(app_module, bot, max_rate_limited_attempts=3)
+
+    outbound.send_message(42, "hello")
+
+    wait_until(lambda: outbound.failed == 1)
+    time.sleep(0.1)
+    assert len(bot.calls) == 3
+    assert outbound.rate_limited == 3
+    assert outbound.sent == 0
+    assert outbound.pending == 0
+
+def test_rate_limits_do_not_use_up_the_attempts_for_other_errors(app_module):
+    bot = FakeBot([rate_limited(0.01), rate_limited(0.01), rate_limited(0.01)])
+    outbound = dispatcher(app_module, bot)  # max_attempts=3
+
+    outbound.send_message(42, "hello")
+
+    wait_until(lambda: outbound.sent == 1)
+    assert len(bot.calls) == 4
+    assert outbound.failed == 0
@@ -0,0 +1,82 @@
+import pytest
+
+BET_MODE = "200"
+
+def add_user(app, user_id, stars):
+    db = app.SessionLocal()
+    try:
+        db.add(app.User(telegram_id=user_id, username=f"user{user_id}", balance_milli=app.to_milli_stars(stars)))
+        db.commit()
+    finally:
+        db.close()
+
+def user_rows(app, user_id):
+    """(balance in Stars, inventory ids, number of drop rows) of a user."""
+    db = app.SessionLocal()
+    try:
+        balance = db.get(app.User, user_id).balance
+        inventory_ids = sorted(inventory_id for inventory_id, in db.query(app.UserGiftInventory.id).filter(
+            app.UserGiftInventory.user_id == user_id))
+        drops = db.query(app.PlinkoDrop).filter(app.PlinkoDrop.user_id == user_id).count()
+        return balance, inventory_ids, drops
+    finally:
+        db.close()
+
+def load_board(client, headers, seed):
+    response = client.get("/api/get_board_slots", query_string={"betMode": BET_MODE, "seed": seed}, headers=headers)
+    assert response.status_code == 200
+
+def test_batch_debits_once_and_writes_one_row_per_drop(app_module, client, auth_headers, monkeypatch):
+    bet = app_module.BET_MODES_CONFIG[BET_MODE]["bet_amount"]
+    add_user(app_module, 6001, bet * 10)
+    headers = auth_headers(6001)
+    load_board(client, headers, "batch-seed-1")
+    debits = []
+    debit_balance = app_module.debit_balance
+    monkeypatch.setattr(app_module, "debit_balance", lambda *args: debits.append(args) or debit_balance(*args))
+
+    response = client.post("/api/plinko_drop_batch", json={"betMode": BET_MODE, "seed": "batch-seed-1", "count": 7},
+                           headers=headers)
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert len(debits) == 1 and debits[0][2] == app_module.to_milli_stars(bet) * 7
+    assert data["new_balance"] == bet * 3
+    assert len(data["drops"]) == 7
+    balance, inventory_ids, drops = user_rows(app_module, 6001)
+    assert balance == bet * 3
+    assert drops == 7
+    assert sorted(drop["won_item"]["inventory_id"] for drop in data["drops"]) == inventory_ids
+
+def test_batch_the_balance_cannot_cover_is_rejected_without_writing(app_module, client, auth_headers):
+    bet = app_module.BET_MODES_CONFIG[BET_MODE]["bet_amount"]
+    add_user(app_module, 6002, bet * 2)
+    headers = auth_headers(6002)
+    load_board(client, headers, "batch-seed-2")
+
+    response = client.post("/api/plinko_drop_batch", json={"betMode": BET_MODE, "seed": "batch-seed-2", "count": 3},
+                           headers=headers)
+
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Insufficient balance"
+    assert user_rows(app_module, 6002) == (bet * 2, [], 0)
+
+@pytest.mark.parametrize("user_id, body", [
+    (6101, {"betMode": BET_MODE, "count": 1}),  # no seed
+    (6102, {"betMode": BET_MODE, "seed": "never-loaded", "count": 1}),  # board not in the cache
+    (6103, {"betMode": "7", "seed": "batch-seed-3", "count": 1}),
+    (6104, {"betMode": BET_MODE, "seed": "batch-seed-3", "count": 0}),
+    (6105, {"betMode": BET_MODE, "seed": "batch-seed-3", "count": 101}),  # over MAX_BATCH_DROPS
+    (6106, {"betMode": BET_MODE, "seed": "batch-seed-3", "count": "many"}),
+    (6107, {"betMode": BET_MODE, "seed": "batch-seed-3", "count": None}),
+])
+def test_bad_seeds_and_counts_are_rejected(app_module, client, auth_headers, user_id, body):
+    bet = app_module.BET_MODES_CONFIG[BET_MODE]["bet_amount"]
+    add_user(app_module, user_id, bet * 200)
+    headers = auth_headers(user_id)
+    load_board(client, headers, "batch-seed-3")
+
+    response = client.post("/api/plinko_drop_batch", json=body, headers=headers)
+
+    assert response.status_code == 400
+    assert user_rows(app_module, user_id) == (bet * 200, [], 0)
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+def leader(app, name):
+    return app.SchedulerLeader(app.engine, name=name, lease_seconds=30)
+
+def test_live_lease_cannot_be_taken_and_an_expired_one_can(app_module):
+    first, second = leader(app_module, "test-election"), leader(app_module, "test-election")
+    assert first._acquire()
+    assert first._acquire()  # re-acquiring its own lease
+    assert not second._acquire()
+
+    # The first holder stops renewing; the lease runs out on the database's clock
+    with app_module.engine.begin() as conn:
+        conn.execute(text("UPDATE plinko_scheduler_leases SET expires_at = strftime('%Y-%m-%d %H:%M:%f', 'now', '-1 seconds') "
+                          "WHERE name = 'test-election'"))
+    assert second._acquire()
+    assert not first._renew()
+    assert second._renew()
+
+def test_lease_deadline_comes_from_the_database_clock(app_module, monkeypatch):
+    class SkewedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.now(tz) + timedelta(hours=1)
+
+    first, second = leader(app_module, "test-skew"), leader(app_module, "test-skew")
+    assert first._acquire()
+    # A process whose clock runs an hour ahead must not see the live lease as expired
+    monkeypatch.setattr(app_module, "dt", SkewedDatetime)
+    assert not second._acquire()
+    with app_module.engine.connect() as conn:
+        expires_at = conn.execute(text("SELECT expires_at FROM plinko_scheduler_leases WHERE name = 'test-skew'")).scalar()
+    remaining = datetime.fromisoformat(expires_at).replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)
+    assert timedelta(seconds=25) < remaining <= timedelta(seconds=30)
+
+def test_step_down_releases_the_lease(app_module):
+    first, second = leader(app_module, "test-handover"), leader(app_module, "test-handover")
+    assert first._acquire()
+    first._step_down()
+    assert second._acquire()
+
+def test_database_clock_compiles_for_sqlite_and_postgres(app_module):
+    from sqlalchemy.dialects import postgresql, sqlite
+    assert "strftime" in str(app_module.database_clock("sqlite", 30).compile(dialect=sqlite.dialect()))
+    assert str(app_module.database_clock("postgresql").compile(dialect=postgresql.dialect())) == "now()"
+    assert "now() +" in str(app_module.database_clock("postgresql", 30).compile(dialect=postgresql.dialect()))
@@ -0,0 +1,11 @@
+def test_requests_get_503_until_the_web_role_starts(app_module, client, monkeypatch):
+    def schema_behind(bind):
+        raise RuntimeError("Database schema is behind the code")
+
+    monkeypatch.setattr(app_module, "ensure_schema_is_current", schema_behind)
+    monkeypatch.setattr(app_module.app, "testing", False)
+    monkeypatch.setattr(app_module, "started_roles", set())
+    for _ in range(2):
+        response = client.get("/api/get_all_gift_prices")
+        assert response.status_code == 503
+    assert app_module.started_roles == set()
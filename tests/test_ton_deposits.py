@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta, timezone
+
+from loadtest import FakeLiteClient, FakeTonLedger
+
+NANOTON = 1_000_000_000
+
+def restart_watcher(app, monkeypatch, client_class):
+    """A fresh watcher, as after a restart or a scheduler leader handover."""
+    watcher = app.TonDepositWatcher(app.DEPOSIT_WALLET_ADDRESS, client_class)
+    monkeypatch.setattr(app, "ton_deposit_watcher", watcher)
+    return watcher
+
+def add_pending_deposit(app, user_id, comment, expires_at):
+    db = app.SessionLocal()
+    try:
+        if not db.get(app.User, user_id):
+            db.add(app.User(telegram_id=user_id, username=f"user{user_id}"))
+        db.add(app.Deposit(user_id=user_id, amount=0, deposit_type='TON', status='pending',
+                           unique_comment=comment, expires_at=expires_at))
+        db.commit()
+    finally:
+        db.close()
+
+def deposit_status(app, comment):
+    db = app.SessionLocal()
+    try:
+        return db.query(app.Deposit.status).filter(app.Deposit.unique_comment == comment).scalar()
+    finally:
+        db.close()
+
+def test_deposit_paid_while_no_leader_was_syncing_is_credited_not_expired(app_module, monkeypatch):
+    class LiteClient(FakeLiteClient):
+        ledger = FakeTonLedger()
+
+    monkeypatch.setattr(app_module, "DEPOSIT_WALLET_ADDRESS", "EQTestGapWallet")
+    monkeypatch.setattr(app_module, "TON_INITIAL_SCAN_TRANSACTIONS", 20)
+    monkeypatch.setattr(app_module, "TON_SYNC_PAGE_TRANSACTIONS", 10)
+    monkeypatch.setattr(app_module, "TON_SYNC_MAX_PAGES", 2)
+    for index in range(30):
+        LiteClient.ledger.pay(f"before-{index}", NANOTON)
+    restart_watcher(app_module, monkeypatch, LiteClient)
+    app_module.process_ton_deposits()
+    assert app_module.load_ton_sync_cursor("EQTestGapWallet") == 30
+
+    # The leader goes away; meanwhile an overdue deposit is paid, then 50 more transactions arrive
+    add_pending_deposit(app_module, 7001, "gap-deposit", datetime.now(timezone.utc) - timedelta(minutes=1))
+    LiteClient.ledger.pay("gap-deposit", 2 * NANOTON)
+    for index in range(50):
+        LiteClient.ledger.pay(f"after-{index}", NANOTON)
+
+    watcher = restart_watcher(app_module, monkeypatch, LiteClient)
+    app_module.process_ton_deposits()
+    # Two pages of ten do not reach the saved cursor: nothing may expire yet
+    assert watcher.catch_up is not None
+    assert deposit_status(app_module, "gap-deposit") == "pending"
+    for _ in range(3):
+        app_module.process_ton_deposits()
+
+    assert deposit_status(app_module, "gap-deposit") == "completed"
+    assert app_module.load_ton_sync_cursor("EQTestGapWallet") == 81
@@ -0,0 +1,51 @@
+def test_least_recently_used_entry_is_evicted_first(app_module):
+    cache = app_module.TTLCache(max_entries=2, max_bytes=10_000, ttl_seconds=60, sizeof=lambda value: 1)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "b" is now the least recently used
+
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+def test_entries_expire_after_their_ttl(app_module, clock):
+    cache = app_module.TTLCache(max_entries=10, max_bytes=10_000, ttl_seconds=60, sizeof=lambda value: 1)
+    cache.set("default", 1)
+    cache.set("short", 2, ttl_seconds=5)
+
+    clock.advance(5)
+    assert cache.get("short") is None
+    assert cache.get("default") == 1
+
+    clock.advance(55)
+    assert cache.get("default") is None
+    assert cache.stats()["expirations"] == 2
+    assert len(cache) == 0
+
+def test_sweep_drops_only_expired_entries(app_module, clock):
+    cache = app_module.TTLCache(max_entries=10, max_bytes=10_000, ttl_seconds=60, sizeof=lambda value: 1)
+    cache.set("short", 1, ttl_seconds=5)
+    cache.set("long", 2)
+
+    clock.advance(10)
+
+    assert cache.sweep() == 1
+    assert cache.get("long") == 2
+
+def test_byte_budget_evicts_and_rejects_oversized_values(app_module):
+    cache = app_module.TTLCache(max_entries=100, max_bytes=100, ttl_seconds=60, sizeof=len)
+    cache.set("a", "x" * 40)
+    cache.set("b", "x" * 40)
+    cache.set("c", "x" * 40)  # 120 bytes: "a" has to go
+
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 80
+
+    assert cache.set("huge", "x" * 101) is False
+    assert cache.get("huge") is None
+    assert cache.stats()["bytes"] == 80
+
+    cache.set("b", "x" * 10)  # replacing a value releases its old size
+    assert cache.stats()["bytes"] == 50
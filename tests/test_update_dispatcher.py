@@ -0,0 +1,52 @@
+import threading
+import time
+from types import SimpleNamespace
+
+def chat_update(update_id, chat_id):
+    return SimpleNamespace(update_id=update_id, message=SimpleNamespace(chat=SimpleNamespace(id=chat_id)))
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_redelivered_updates_are_processed_once(app_module):
+    processed = []
+    dispatcher = app_module.UpdateDispatcher(processed.extend, workers=2, max_pending=100, batch_size=10, dedupe_size=100)
+    dispatcher.start()
+
+    for update_id in (1, 2, 1, 3, 2):
+        assert dispatcher.submit(chat_update(update_id, chat_id=update_id))
+
+    wait_until(lambda: dispatcher.stats()["processed"] == 3)
+    assert sorted(update.update_id for update in processed) == [1, 2, 3]
+    assert dispatcher.stats()["duplicates"] == 2
+
+def test_updates_of_one_chat_are_processed_in_order(app_module):
+    processed = {}
+    lock = threading.Lock()
+
+    def process(updates):
+        time.sleep(0.001)  # let the other workers interleave
+        with lock:
+            for update in updates:
+                processed.setdefault(update.message.chat.id, []).append(update.update_id)
+
+    dispatcher = app_module.UpdateDispatcher(process, workers=4, max_pending=1000, batch_size=3, dedupe_size=1000)
+    dispatcher.start()
+    for update_id in range(300):
+        dispatcher.submit(chat_update(update_id, chat_id=update_id % 7))
+
+    wait_until(lambda: dispatcher.stats()["processed"] == 300)
+    assert set(processed) == set(range(7))
+    for chat_id, update_ids in processed.items():
+        assert update_ids == list(range(chat_id, 300, 7))
+
+def test_updates_beyond_max_pending_are_rejected(app_module):
+    dispatcher = app_module.UpdateDispatcher(lambda updates: None, workers=1, max_pending=2, batch_size=1, dedupe_size=100)
+    # Not started: nothing drains the queue
+    assert dispatcher.submit(chat_update(1, chat_id=1))
+    assert dispatcher.submit(chat_update(2, chat_id=1))
+    assert not dispatcher.submit(chat_update(3, chat_id=1))
+    assert dispatcher.stats()["rejected"] == 1
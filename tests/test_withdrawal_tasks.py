@@ -0,0 +1,82 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+def add_task(app, **values):
+    db = app.SessionLocal()
+    try:
+        task = app.WithdrawalTask(task_id=str(uuid.uuid4()), inventory_id=values.pop("inventory_id"), telegram_id=1,
+                                  gift_name="Bear", gift_slug="bear-1", **values)
+        db.add(task)
+        db.commit()
+        return task.task_id
+    finally:
+        db.close()
+
+def task_status(app, task_id):
+    db = app.SessionLocal()
+    try:
+        return db.query(app.WithdrawalTask).filter(app.WithdrawalTask.task_id == task_id).one().status
+    finally:
+        db.close()
+
+def test_task_whose_lease_keeps_expiring_is_failed_after_max_attempts(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "GIFT_DEPOSIT_API_KEY", "test-key")
+    expired = datetime.now(timezone.utc) - timedelta(seconds=1)
+    exhausted = add_task(app_module, inventory_id=9001, status="leased", lease_expires_at=expired,
+                         attempts=app_module.WITHDRAWAL_MAX_ATTEMPTS)
+    retryable = add_task(app_module, inventory_id=9002, status="leased", lease_expires_at=expired,
+                         attempts=app_module.WITHDRAWAL_MAX_ATTEMPTS - 1)
+    headers = {"X-API-Key": "test-key"}
+
+    claimed = client.get("/api/get_withdrawal_tasks?limit=100", headers=headers).get_json()["tasks"]
+
+    assert [task["task_id"] for task in claimed if task["task_id"] in (exhausted, retryable)] == [retryable]
+    assert task_status(app_module, exhausted) == "failed"
+    failed = client.get("/api/withdrawal_tasks/failed", headers=headers).get_json()["tasks"]
+    assert exhausted in [task["task_id"] for task in failed]
+
+def expire_lease(app, task_id):
+    db = app.SessionLocal()
+    try:
+        db.query(app.WithdrawalTask).filter(app.WithdrawalTask.task_id == task_id).update(
+            {"lease_expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)})
+        db.commit()
+    finally:
+        db.close()
+
+def claim(client, headers, task_id):
+    tasks = client.get("/api/get_withdrawal_tasks?limit=100", headers=headers).get_json()["tasks"]
+    return next(task for task in tasks if task["task_id"] == task_id)
+
+def test_only_the_current_lease_holder_can_ack(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "GIFT_DEPOSIT_API_KEY", "test-key")
+    headers = {"X-API-Key": "test-key"}
+    task_id = add_task(app_module, inventory_id=9101, status="queued")
+
+    queued_ack = client.post("/api/ack_withdrawal_task", headers=headers,
+                             json={"task_id": task_id, "lease_token": "guess", "status": "done"})
+    assert queued_ack.status_code == 409
+
+    stale = claim(client, headers, task_id)
+    expire_lease(app_module, task_id)
+    current = claim(client, headers, task_id)
+    assert stale["lease_token"] != current["lease_token"]
+
+    stale_ack = client.post("/api/ack_withdrawal_task", headers=headers,
+                            json={"task_id": task_id, "lease_token": stale["lease_token"], "status": "done"})
+    assert stale_ack.status_code == 409
+    assert task_status(app_module, task_id) == "leased"
+
+    current_ack = client.post("/api/ack_withdrawal_task", headers=headers,
+                              json={"task_id": task_id, "lease_token": current["lease_token"], "status": "done"})
+    assert current_ack.status_code == 200
+    assert task_status(app_module, task_id) == "done"
+    again = client.post("/api/ack_withdrawal_task", headers=headers,
+                        json={"task_id": task_id, "lease_token": current["lease_token"], "status": "done"})
+    assert again.status_code == 409
+
+def test_ack_without_a_lease_token_is_rejected(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "GIFT_DEPOSIT_API_KEY", "test-key")
+    response = client.post("/api/ack_withdrawal_task", headers={"X-API-Key": "test-key"},
+                           json={"task_id": "whatever", "status": "done"})
+    assert response.status_code == 400